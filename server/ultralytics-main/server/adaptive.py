@@ -0,0 +1,152 @@
+# server/adaptive.py  —— 按实测推理耗时自动降级 / 恢复的工作点控制
+#
+# 每路共享流（stream_hub.CameraStream）一个 AdaptiveController，沿一张降级阶梯上下移动：
+#   降级：推理耗时超过当前 tick 周期，或全局推理积压超过后端的并行能力，连续 ADAPTIVE_UP_TICKS 次
+#   恢复：即使退回上一级（更高 fps）也仍有余量，且全局不拥挤，连续 ADAPTIVE_DOWN_TICKS 次
+# 每级同时决定：有效 fps、掩膜发送间隔倍数、两个模型 imgsz 的下调量。
+# 全局负载 INFER_LOAD：推理后端登记的实时帧“排队数 / 并行通道数”（见 infer_dispatch.live_pressure），
+# 后端有余量时不会排队，摄像头再多也不降级；真正积压时所有流一起退让。
+import os
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+ADAPTIVE = (os.getenv("ADAPTIVE", "1") == "1")
+# 没有登记后端负载来源时（单元测试 / 脚本），同时在途的推理数超过该值视为全局拥挤
+ADAPTIVE_INFER_CAPACITY = int(os.getenv("ADAPTIVE_INFER_CAPACITY", "4"))
+ADAPTIVE_UP_TICKS = int(os.getenv("ADAPTIVE_UP_TICKS", "3"))
+ADAPTIVE_DOWN_TICKS = int(os.getenv("ADAPTIVE_DOWN_TICKS", "20"))
+ADAPTIVE_HIGH = float(os.getenv("ADAPTIVE_HIGH", "1.0"))
+ADAPTIVE_LOW = float(os.getenv("ADAPTIVE_LOW", "0.7"))
+MIN_IMGSZ = 320
+
+# 降级阶梯：(fps 系数, 掩膜间隔倍数, imgsz 下调像素)
+LADDER = [
+    (1.0, 1, 0),
+    (0.75, 2, 0),
+    (0.5, 4, 0),
+    (0.5, 4, 128),
+    (0.33, 8, 128),
+    (0.25, 8, 256),
+]
+
+
+class InferLoad:
+    """
+    全局推理负载：在途计数（只在事件循环线程里增减，不需要锁）+ 后端登记的积压压力
+    """
+
+    def __init__(self, capacity: int = ADAPTIVE_INFER_CAPACITY):
+        self.capacity = max(1, int(capacity))
+        self.inflight = 0
+        self.peak = 0
+        self._source: Optional[Callable[[], float]] = None
+
+    def set_source(self, fn: Optional[Callable[[], float]]) -> None:
+        """登记返回“排队中的实时帧数 / 并行通道数”的函数，替代按在途数估算"""
+        self._source = fn
+
+    @contextmanager
+    def track(self):
+        self.inflight += 1
+        self.peak = max(self.peak, self.inflight)
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+
+    def pressure(self) -> float:
+        if self._source is not None:
+            try:
+                return float(self._source())
+            except Exception:
+                return 0.0
+        return self.inflight / self.capacity
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "peak": self.peak,
+            "capacity": self.capacity,
+            "pressure": round(self.pressure(), 2),
+            "source": "backend" if self._source is not None else "inflight",
+        }
+
+
+# 进程内唯一的全局负载
+INFER_LOAD = InferLoad()
+
+
+def _scaled_imgsz(base: int, drop: int) -> int:
+    base = int(base or 640)
+    if drop <= 0 or base <= MIN_IMGSZ:
+        return base
+    return max(MIN_IMGSZ, (base - drop) // 32 * 32)
+
+
+class AdaptiveController:
+    def __init__(self):
+        self.level = 0
+        self.infer_ms = 0.0
+        self._hi = 0
+        self._lo = 0
+        self._ema = 0.2
+
+    @staticmethod
+    def _fps_at(level: int, base_fps: int) -> int:
+        return max(1, int(round(base_fps * LADDER[level][0])))
+
+    def observe(self, infer_ms: float, base_fps: int) -> None:
+        """每个 tick 推理完成后调用一次"""
+        self.infer_ms = infer_ms if self.infer_ms == 0.0 else (
+            (1 - self._ema) * self.infer_ms + self._ema * infer_ms)
+        if not ADAPTIVE:
+            return
+
+        load = INFER_LOAD.pressure()
+        period_ms = 1000.0 / self._fps_at(self.level, base_fps)
+        pressure = max(self.infer_ms / period_ms, load)
+
+        if pressure > ADAPTIVE_HIGH and self.level < len(LADDER) - 1:
+            self._lo = 0
+            self._hi += 1
+            if self._hi >= ADAPTIVE_UP_TICKS:
+                self.level += 1
+                self._hi = 0
+                print(f"[ADAPT] degrade -> level {self.level} (infer={self.infer_ms:.0f}ms load={load:.2f})")
+        elif self.level > 0:
+            self._hi = 0
+            # 按上一级（更高 fps）的周期算，确保恢复后不会马上又超
+            prev_period_ms = 1000.0 / self._fps_at(self.level - 1, base_fps)
+            if max(self.infer_ms / prev_period_ms, load) < ADAPTIVE_LOW:
+                self._lo += 1
+                if self._lo >= ADAPTIVE_DOWN_TICKS:
+                    self.level -= 1
+                    self._lo = 0
+                    print(f"[ADAPT] restore -> level {self.level} (infer={self.infer_ms:.0f}ms load={load:.2f})")
+            else:
+                self._lo = 0
+        else:
+            self._hi = self._lo = 0
+
+    @property
+    def mask_scale(self) -> int:
+        return LADDER[self.level][1]
+
+    def effective(self, params: dict) -> Dict[str, int]:
+        """当前工作点下实际生效的 fps / imgsz（params 为整路设定值）"""
+        _, _, drop = LADDER[self.level]
+        return {
+            "fps": self._fps_at(self.level, int(params.get("fps") or 10)),
+            "imgsz_water": _scaled_imgsz(params.get("imgsz_water", 640), drop),
+            "imgsz_risk": _scaled_imgsz(params.get("imgsz_risk", 640), drop),
+        }
+
+    def snapshot(self, params: dict) -> dict:
+        """随 tick 下发的工作点"""
+        return {
+            "level": self.level,
+            **self.effective(params),
+            "mask_scale": self.mask_scale,
+            "infer_ms": round(self.infer_ms, 1),
+            "load": round(INFER_LOAD.pressure(), 2),
+        }
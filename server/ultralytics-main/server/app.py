@@ -1,8 +1,14 @@
 # server/app.py，，，挂载启动逻辑 + 引入 router
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from .startup import init_model_on_startup
+from .infer_dispatch import shutdown_backend, start_backend
+from .tick_writer import TICK_WRITER
+from .database import POOL
+from .db_detect import ensure_detect_tick_index
+from .db_rollup import ensure_rollup_table
 from .routes_infer import router as infer_router
 from .routes_ws import router as ws_router
 from .routes_cameras import router as cameras_router
@@ -10,6 +16,7 @@ from .routes_export import router as export_router
 from .routes_ezviz import router as ezviz_router
 from pathlib import Path
 from .routes_history import router as history_router
+from .utils.upload_spool import UploadTooLarge, request_limit
 import mimetypes
 import uvicorn
 
@@ -34,6 +41,17 @@ async def disable_cache(request: Request, call_next):
     return response
 
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # 上传接口按 Content-Length 提前拒绝超限请求（此时请求体还没被读取 / 解析）
+    limit = request_limit(request.url.path)
+    length = request.headers.get("content-length")
+    if limit is not None and length and length.isdigit() and int(length) > limit:
+        e = UploadTooLarge(limit)
+        return JSONResponse({"error": "upload too large", "msg": str(e)}, status_code=e.status_code)
+    return await call_next(request)
+
+
 # 修复 MIME 类型，确保返回视频头
 mimetypes.add_type("video/mp4", ".mp4")
 
@@ -51,6 +69,27 @@ app.add_middleware(
 def _startup():
     # 启动即加载模型，避免首请求卡顿
     init_model_on_startup()
+    # DUAL_INFER_BACKEND=process 时拉起推理 worker 进程
+    start_backend()
+
+    # 预聚合表不存在就建一张（数据库连不上不影响启动）
+    try:
+        ensure_rollup_table()
+    except Exception as e:
+        print("[DB] ensure_rollup_table error:", e)
+    # 分页 / 流式 / 降采样查询要用的 detect_tick 索引
+    try:
+        ensure_detect_tick_index()
+    except Exception as e:
+        print("[DB] ensure_detect_tick_index error:", e)
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    # 退出前把还没写库的 detect_tick 刷掉，再关掉连接池
+    TICK_WRITER.stop()
+    POOL.close_all()
+    shutdown_backend()
 
 
 # 挂载REST推理接口
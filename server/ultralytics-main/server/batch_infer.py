@@ -0,0 +1,175 @@
+# server/batch_infer.py  —— 跨摄像头的双模型微批调度
+#
+# 所有实时会话把帧丢进同一个队列，调度线程攒几毫秒（或攒满 max_batch）后，
+# 把参数相同的帧堆成一批，分别跑一次积水模型和风险模型，
+# 再逐帧做后处理，通过 Future 把结果还给各自的调用方。
+# 队列和 thread 后端一样受 infer_sched 的 live 上限约束：排满时丢掉最旧的帧，
+# 等待超过 INFER_SCHED_LIVE_MAX_WAIT_MS 的帧不再推理（都以 InferShed 失败，调用方沿用上次结果）。
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .infer_sched import INFER_SCHED_LIVE_MAX_WAIT_MS, INFER_SCHED_MAX_QUEUED, PRIORITY_LIVE, InferShed
+from .pipeline_dual import load_dual_models, build_dual_output, predict_dual, _dual_options
+
+# 一批最多多少帧 / 第一帧到达后最多等多久（毫秒）
+BATCH_MAX = int(os.getenv("DUAL_BATCH_MAX", "8"))
+BATCH_WAIT_MS = float(os.getenv("DUAL_BATCH_WAIT_MS", "5"))
+
+
+class _Job:
+    __slots__ = ("frame", "opts", "rgb", "future", "t_submit")
+
+    def __init__(self, frame: np.ndarray, opts: dict, rgb: bool = False):
+        self.frame = frame
+        self.opts = opts
+        self.rgb = rgb
+        self.future: Future = Future()
+        self.t_submit = time.perf_counter()
+
+    def shed(self, msg: str) -> None:
+        # 调用方可能已经取消了这个 future
+        if self.future.done():
+            return
+        try:
+            self.future.set_exception(InferShed(msg, PRIORITY_LIVE))
+        except InvalidStateError:
+            pass
+
+    def batch_key(self) -> Tuple:
+        # 只有模型超参一致的帧才能放进同一次 predict
+        o = self.opts
+        return (o["imgsz_water"], o["conf_water"], o["imgsz_risk"], o["conf_risk"], o["parallel"],
+                o["run_water"], o["run_risk"])
+
+
+class DualBatchScheduler:
+    """
+    微批调度器：submit() 线程安全，返回 concurrent.futures.Future
+    """
+
+    def __init__(self, max_batch: int = BATCH_MAX, max_wait_ms: float = BATCH_WAIT_MS,
+                 max_queued: int = INFER_SCHED_MAX_QUEUED[PRIORITY_LIVE]):
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queued = max(1, int(max_queued))
+        self._queue: "queue.Queue[_Job]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # 统计
+        self.batches = 0
+        self.frames = 0
+        self.shed = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="dual-batch", daemon=True)
+            self._thread.start()
+
+    def submit(self, frame: np.ndarray, params: dict = None, rgb: bool = False) -> Future:
+        """rgb=True：frame 已是 RGB，调度线程里不再转换"""
+        self.start()
+        job = _Job(frame, _dual_options(params), rgb)
+        # 队列满：丢掉最旧的帧给新帧让位（反正已经过时）
+        while self._queue.qsize() >= self.max_queued:
+            try:
+                old = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shed += 1
+            old.shed("superseded by a newer frame")
+        self._queue.put(job)
+        return job.future
+
+    def backlog(self) -> int:
+        """还在排队、没进 batch 的帧数（登记给 INFER_SCHED，积压时 image / video 让路）"""
+        return self._queue.qsize()
+
+    # ---------- 调度线程 ----------
+    def _collect(self) -> List[_Job]:
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            groups = {}
+            now = time.perf_counter()
+            for job in batch:
+                if (now - job.t_submit) * 1000.0 > INFER_SCHED_LIVE_MAX_WAIT_MS:
+                    self.shed += 1
+                    job.shed("live frame waited too long")
+                    continue
+                # 调用方已取消（流退订）的帧不再推理；其余标记为运行中，之后就不会再被取消
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                groups.setdefault(job.batch_key(), []).append(job)
+            for jobs in groups.values():
+                self._run_group(jobs)
+
+    def _run_group(self, jobs: List[_Job]) -> None:
+        try:
+            water_m, risk_m = load_dual_models()
+            opts = jobs[0].opts
+            rgbs = [j.frame if j.rgb else cv2.cvtColor(j.frame, cv2.COLOR_BGR2RGB) for j in jobs]
+
+            res_water, res_risk = predict_dual(water_m, risk_m, rgbs, opts)
+            self.batches += 1
+            self.frames += len(jobs)
+        except Exception as e:
+            for j in jobs:
+                if not j.future.done():
+                    j.future.set_exception(e)
+            return
+
+        for j, rw, rr in zip(jobs, res_water, res_risk):
+            if j.future.done():
+                continue
+            try:
+                h, w = j.frame.shape[:2]
+                out = build_dual_output(rw, rr, h, w, j.opts)
+            except Exception as e:
+                j.future.set_exception(e)
+            else:
+                j.future.set_result(out)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "pending": self._queue.qsize(),
+            "max_queued": self.max_queued,
+            "shed": self.shed,
+            "batches": self.batches,
+            "frames": self.frames,
+            "avg_batch": round(self.frames / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+_SCHEDULER: Optional[DualBatchScheduler] = None
+
+
+def get_batch_scheduler() -> DualBatchScheduler:
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = DualBatchScheduler()
+    return _SCHEDULER
@@ -1,13 +1,252 @@
+# server/database.py  —— MySQL 连接池（所有路由 / 写库线程 / 导出工具共用）
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Optional
+
 import pymysql
+from anyio import to_thread, CapacityLimiter
+
+DB_CONFIG = {
+    "host": os.getenv("MYSQL_HOST", "127.0.0.1"),
+    "port": int(os.getenv("MYSQL_PORT", "3306")),
+    "user": os.getenv("MYSQL_USER", "root"),
+    "password": os.getenv("MYSQL_PASSWORD", "123456"),
+    "database": os.getenv("MYSQL_DATABASE", "city_flood_monitor"),
+    "charset": "utf8mb4",
+    "cursorclass": pymysql.cursors.DictCursor,
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # 借连接最多等多久（秒）
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # 连接最长存活（秒）
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "5"))       # 闲置超过多久借出前先 ping（秒）
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class _PoolEntry:
+    __slots__ = ("conn", "created", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+class PooledConnection:
+    """
+    借出的连接：用法与 pymysql 连接一致，close() 时归还到池里而不是断开
+    """
+
+    def __init__(self, pool: "ConnectionPool", entry: _PoolEntry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        entry = self.__dict__.get("_entry")
+        if entry is None:
+            raise AttributeError(name)
+        return getattr(entry.conn, name)
+
+    def close(self):
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool.release(entry)
+
+    def discard(self):
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self._pool.release(entry, discard=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    有上限的 pymysql 连接池：
+    - 最多 max_size 条连接，借不到时最多等 timeout 秒
+    - 借出前闲置超过 ping_idle 秒就先 ping（pre-ping），不通则丢弃换新
+    - 存活超过 max_lifetime 秒的连接归还时直接关闭
+    """
+
+    def __init__(self, config: dict,
+                 max_size: int = DB_POOL_SIZE,
+                 timeout: float = DB_POOL_TIMEOUT,
+                 max_lifetime: float = DB_POOL_MAX_LIFETIME,
+                 ping_idle: float = DB_POOL_PING_IDLE):
+        self.config = config
+        self.max_size = max(1, int(max_size))
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_idle = ping_idle
+        # LIFO：优先复用最近用过的热连接，冷连接自然过期
+        self._idle: "queue.LifoQueue[_PoolEntry]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+
+        # 统计
+        self.created = 0
+        self.recycled = 0
+        self.ping_failures = 0
+        self.timeouts = 0
+
+    # ---------- 借 / 还 ----------
+    def _expired(self, entry: _PoolEntry) -> bool:
+        return self.max_lifetime > 0 and time.monotonic() - entry.created > self.max_lifetime
+
+    def _open(self) -> _PoolEntry:
+        try:
+            conn = pymysql.connect(**self.config)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+            raise
+        self.created += 1
+        return _PoolEntry(conn)
+
+    def _drop(self, entry: _PoolEntry) -> None:
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+
+    def _healthy(self, entry: _PoolEntry) -> bool:
+        if self._expired(entry):
+            self.recycled += 1
+            return False
+        if time.monotonic() - entry.last_used < self.ping_idle:
+            return True
+        try:
+            entry.conn.ping(reconnect=False)
+            return True
+        except Exception:
+            self.ping_failures += 1
+            return False
+
+    def acquire(self) -> PooledConnection:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                entry = None
+
+            if entry is not None:
+                if self._healthy(entry):
+                    return PooledConnection(self, entry)
+                self._drop(entry)
+                continue
+
+            with self._lock:
+                can_open = self._size < self.max_size
+                if can_open:
+                    self._size += 1
+            if can_open:
+                return PooledConnection(self, self._open())
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                raise PoolTimeout(f"no free MySQL connection within {self.timeout}s")
+            try:
+                # 小步等待：别的线程丢弃坏连接腾出名额时也能及时新建
+                entry = self._idle.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                continue
+            if self._healthy(entry):
+                return PooledConnection(self, entry)
+            self._drop(entry)
+
+    def release(self, entry: _PoolEntry, discard: bool = False) -> None:
+        if discard or not entry.conn.open or self._expired(entry):
+            if not discard and self._expired(entry):
+                self.recycled += 1
+            self._drop(entry)
+            return
+        try:
+            # 清掉调用方没提交的事务，避免下一个借用者看到脏状态
+            entry.conn.rollback()
+        except Exception:
+            self._drop(entry)
+            return
+        entry.last_used = time.monotonic()
+        self._idle.put(entry)
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._drop(entry)
+
+    def health(self) -> dict:
+        """借一条连接跑 SELECT 1，顺带返回池的统计"""
+        ok, err = True, None
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                    cur.fetchone()
+        except Exception as e:
+            ok, err = False, str(e)
+        return {"ok": ok, "error": err, **self.stats()}
+
+    def stats(self) -> dict:
+        return {
+            "size": self._size,
+            "idle": self._idle.qsize(),
+            "max_size": self.max_size,
+            "created": self.created,
+            "recycled": self.recycled,
+            "ping_failures": self.ping_failures,
+            "timeouts": self.timeouts,
+        }
+
+
+# 进程内唯一的连接池
+POOL = ConnectionPool(DB_CONFIG)
+
+# 异步门面：同时在线程里跑的 DB 调用不超过池大小，多出来的在事件循环外排队
+_DB_LIMITER: Optional[CapacityLimiter] = None
+
+
+def get_conn() -> PooledConnection:
+    """
+    从连接池借一条连接；调用方用完 conn.close() 即归还
+    """
+    return POOL.acquire()
+
+
+@contextmanager
+def pooled_conn():
+    """
+    with pooled_conn() as conn: ...   结束时归还（未提交的事务在归还时回滚）
+    """
+    conn = POOL.acquire()
+    try:
+        yield conn
+    finally:
+        conn.close()
 
 
-def get_conn():
-    return pymysql.connect(
-        host="localhost",
-        port=3306,
-        user="root",
-        password="123456",
-        database="city_flood_monitor",
-        charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor
-    )
+async def run_db(func, *args, **kwargs):
+    """
+    在 FastAPI 的 async 路由里调用同步 DB 函数，不阻塞事件循环
+    """
+    global _DB_LIMITER
+    if _DB_LIMITER is None:
+        _DB_LIMITER = CapacityLimiter(POOL.max_size)
+    return await to_thread.run_sync(partial(func, *args, **kwargs), limiter=_DB_LIMITER)
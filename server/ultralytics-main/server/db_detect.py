@@ -1,28 +1,17 @@
 # server/db_detect.py
 import json
-import pymysql
-from contextlib import contextmanager
+import os
 from typing import List, Optional, Dict
 from datetime import datetime
 
-DB_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 3306,
-    "user": "root",
-    "password": "123456",
-    "database": "city_flood_monitor",  # 比如 flood_monitor
-    "charset": "utf8mb4",
-    "cursorclass": pymysql.cursors.DictCursor,
-}
+# 连接配置与连接池统一放在 database.py，这里保留旧名字
+from .database import DB_CONFIG, pooled_conn as get_conn  # noqa: F401
+from .utils import geom_codec
 
-
-@contextmanager
-def get_conn():
-    conn = pymysql.connect(**DB_CONFIG)
-    try:
-        yield conn
-    finally:
-        conn.close()
+# detect_tick.water_polys / risk_boxes 的存储格式：
+#   json（默认）: 原来的 JSON 文本
+#   q16         : uint16 量化后打包的紧凑编码（"q16:<base64>"，读取时自动兼容两种）
+TICK_GEOM_ENCODING = (os.getenv("TICK_GEOM_ENCODING") or "json").strip().lower()
 
 
 def create_detect_session(camera_id: str,
@@ -64,6 +53,56 @@ def create_detect_session(camera_id: str,
             return cur.lastrowid
 
 
+TICK_INSERT_SQL = """
+    INSERT INTO detect_tick (
+      session_id, ts_ms, video_sec,
+      water_percent, risk_level,
+      mask_h, mask_w, water_polys, risk_boxes
+    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+    """
+
+
+def _geom_text(encode, value) -> Optional[str]:
+    """几何字段入库的文本：TICK_GEOM_ENCODING=q16 时紧凑编码，个数超出 uint16 时退回 JSON"""
+    if not value:
+        return None
+    if TICK_GEOM_ENCODING == "q16":
+        try:
+            return geom_codec.to_text(encode(value))
+        except geom_codec.GeomOverflow as e:
+            print("[DB] geometry too large for q16, stored as JSON:", e)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def build_tick_row(session_id: int,
+                   ts_ms: int,
+                   video_sec: float,
+                   result: dict,
+                   water: dict,
+                   risk: dict) -> tuple:
+    """
+    把一次 tick 的推理结果转成 detect_tick 的一行（与 TICK_INSERT_SQL 的列顺序一致）
+    """
+    water_percent = int(round(result.get("pct", 0.0)))
+    risk_level = int(result.get("level", 0))
+
+    # 对齐 pipeline_dual.py 的字段名 image_h / image_w / polygons
+    mask_h = water.get("image_h")
+    mask_w = water.get("image_w")
+    polys = water.get("polygons")
+    det = (risk or {}).get("det") or {}
+    boxes_norm = det.get("boxes_norm") or []
+
+    polys_json = _geom_text(geom_codec.encode_polys, polys)
+    boxes_json = _geom_text(geom_codec.encode_boxes, boxes_norm)
+
+    return (
+        session_id, ts_ms, video_sec,
+        water_percent, risk_level,
+        mask_h, mask_w, polys_json, boxes_json
+    )
+
+
 def save_detect_tick(session_id: int,
                      ts_ms: int,
                      video_sec: float,
@@ -73,35 +112,35 @@ def save_detect_tick(session_id: int,
     if not session_id:
         return
 
-    water_percent = int(round(result.get("pct", 0.0)))
-    risk_level = int(result.get("level", 0))
+    row = build_tick_row(session_id, ts_ms, video_sec, result, water, risk)
 
-    # 对齐 pipeline_dual.py 的字段名 image_h / image_w / polygons
-    mask_h = water.get("image_h")
-    mask_w = water.get("image_w")
-    polys = water.get("polygons")
-    polys_json = json.dumps(polys, ensure_ascii=False) if polys else None
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(TICK_INSERT_SQL, row)
+            conn.commit()
 
-    det = (risk or {}).get("det") or {}
-    boxes_norm = det.get("boxes_norm") or []
-    boxes_json = json.dumps(boxes_norm, ensure_ascii=False) if boxes_norm else None
 
-    sql = """
-    INSERT INTO detect_tick (
-      session_id, ts_ms, video_sec,
-      water_percent, risk_level,
-      mask_h, mask_w, water_polys, risk_boxes
-    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+def save_detect_ticks(conn, rows: List[tuple]) -> int:
+    """
+    用调用方给的连接一次性写入多行 detect_tick（executemany 会合并成多值 INSERT）
     """
+    if not rows:
+        return 0
+    with conn.cursor() as cur:
+        cur.executemany(TICK_INSERT_SQL, rows)
+    conn.commit()
+    return len(rows)
 
+
+def get_session_started_at(session_id: int):
+    """
+    detect_session.started_at（插入时由数据库填）；分钟 / 小时聚合以它 + video_sec 为时间基准
+    """
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, (
-                session_id, ts_ms, video_sec,
-                water_percent, risk_level,
-                mask_h, mask_w, polys_json, boxes_json
-            ))
-            conn.commit()
+            cur.execute("SELECT started_at FROM detect_session WHERE id = %s", (session_id,))
+            row = cur.fetchone()
+    return row.get("started_at") if row else None
 
 
 def update_detect_record_path(session_id: int, record_path: str) -> None:
@@ -203,19 +242,22 @@ def list_detect_sessions(
 # 删除数据
 def delete_detect_session(session_id: int) -> bool:
     """
-    删除一条 detect_session 记录及其对应的 detect_tick 记录。
+    删除一条 detect_session 记录及其对应的 detect_tick / detect_rollup 记录。
     返回 True 表示确实删掉了 session 记录，False 表示没有找到该 id。
     """
     if not session_id:
         return False
 
     sql_tick = "DELETE FROM detect_tick WHERE session_id = %s"
+    # 预聚合也要一起删，否则按摄像头看趋势时还会算上已删除的 session
+    sql_rollup = "DELETE FROM detect_rollup WHERE session_id = %s"
     sql_sess = "DELETE FROM detect_session WHERE id = %s"
 
     with get_conn() as conn:
         with conn.cursor() as cur:
             # 先删子表，避免外键约束问题
             cur.execute(sql_tick, (session_id,))
+            cur.execute(sql_rollup, (session_id,))
             cur.execute(sql_sess, (session_id,))
             affected = cur.rowcount  # 只看删 session 的结果
         conn.commit()
@@ -260,3 +302,142 @@ def list_detect_ticks(session_id: int, limit: Optional[int] = None) -> List[Dict
                 rows.append(r)
 
     return rows
+
+
+# ---------- detect_tick 分页 / 流式 / 降采样 ----------
+# 以下查询都依赖索引 (session_id, video_sec, id)，启动时由 ensure_detect_tick_index 补建
+DETECT_TICK_INDEX = "idx_session_vsec_id"
+
+
+def ensure_detect_tick_index() -> bool:
+    """
+    detect_tick 上没有 (session_id, video_sec, id) 索引就建一个（MySQL 不支持 CREATE INDEX IF NOT EXISTS，
+    先查 information_schema）。返回 True 表示本次新建了索引；大表上建索引可能要一段时间
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*) AS n FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = 'detect_tick' AND index_name = %s
+                """,
+                (DETECT_TICK_INDEX,),
+            )
+            if (cur.fetchone() or {}).get("n"):
+                return False
+            cur.execute(f"ALTER TABLE detect_tick ADD INDEX {DETECT_TICK_INDEX} (session_id, video_sec, id)")
+        conn.commit()
+    print("[DB] created index detect_tick.", DETECT_TICK_INDEX)
+    return True
+
+
+_TICK_COLS_FULL = """
+            id, session_id, ts_ms, video_sec,
+            water_percent, risk_level,
+            mask_h, mask_w, water_polys, risk_boxes
+"""
+_TICK_COLS_LITE = """
+            id, session_id, ts_ms, video_sec,
+            water_percent, risk_level
+"""
+
+
+def list_detect_ticks_page(session_id: int,
+                           after_id: Optional[int] = None,
+                           limit: int = 1000,
+                           with_geom: bool = True) -> List[Dict]:
+    """
+    键集分页：按 (video_sec, id) 排序，返回严格排在 after_id 那一行之后的 limit 条。
+    游标只带 id，那一行的 video_sec 在 MySQL 里现查：浮点数经过 Python / JSON 来回一趟
+    可能和库里存的值不再相等，用它做 video_sec = ? 比较会漏行或重复。
+    不用 OFFSET，翻到多深都只走一次索引范围扫描；after_id 不属于该 session 时返回空列表。
+    """
+    cols = _TICK_COLS_FULL if with_geom else _TICK_COLS_LITE
+    if after_id is None:
+        sql = f"SELECT {cols} FROM detect_tick WHERE session_id = %s"
+        params: list = [session_id]
+    else:
+        # 单行派生表被优化器当常量，仍然是 (session_id, video_sec, id) 索引上的范围扫描
+        sql = (
+            f"SELECT {cols} FROM detect_tick"
+            " JOIN (SELECT video_sec AS cur_sec FROM detect_tick WHERE id = %s AND session_id = %s) AS cur"
+            " WHERE session_id = %s AND (video_sec > cur_sec OR (video_sec = cur_sec AND id > %s))"
+        )
+        params = [after_id, session_id, session_id, after_id]
+    sql += " ORDER BY video_sec ASC, id ASC LIMIT %s"
+    params.append(limit)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return list(cur.fetchall())
+
+
+def iter_detect_ticks(session_id: int, page_size: int = 2000, with_geom: bool = True):
+    """
+    逐页拉取整个 session 的 tick（生成器），每页借一次连接，不长时间占着连接
+    """
+    after_id = None
+    while True:
+        rows = list_detect_ticks_page(session_id, after_id, page_size, with_geom)
+        for r in rows:
+            yield r
+        if len(rows) < page_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+def downsample_detect_ticks(session_id: int, resolution: int) -> Dict:
+    """
+    服务端降采样：把整个 session 按 video_sec 均分成 resolution 个桶，
+    每桶返回 water_percent 的 min / max / mean 和 risk_level 的 max（不带多边形）
+    """
+    resolution = max(1, int(resolution))
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT MIN(video_sec) AS t0, MAX(video_sec) AS t1, COUNT(*) AS n "
+                "FROM detect_tick WHERE session_id = %s",
+                (session_id,),
+            )
+            span = cur.fetchone() or {}
+            if not span.get("n"):
+                return {"t0": None, "t1": None, "bucket_sec": 0.0, "total": 0, "items": []}
+
+            t0 = float(span["t0"])
+            t1 = float(span["t1"])
+            bucket_sec = (t1 - t0) / resolution if t1 > t0 else 1.0
+
+            cur.execute(
+                """
+                SELECT
+                    LEAST(FLOOR((video_sec - %s) / %s), %s) AS bucket,
+                    COUNT(*) AS n,
+                    MIN(video_sec) AS t_start,
+                    MAX(video_sec) AS t_end,
+                    MIN(water_percent) AS water_min,
+                    MAX(water_percent) AS water_max,
+                    AVG(water_percent) AS water_mean,
+                    MAX(risk_level) AS risk_max
+                FROM detect_tick
+                WHERE session_id = %s
+                GROUP BY bucket
+                ORDER BY bucket
+                """,
+                (t0, bucket_sec, resolution - 1, session_id),
+            )
+            rows = cur.fetchall()
+
+    items = []
+    for r in rows:
+        items.append({
+            "bucket": int(r["bucket"]),
+            "n": int(r["n"]),
+            "t_start": float(r["t_start"]),
+            "t_end": float(r["t_end"]),
+            "water_min": r["water_min"],
+            "water_max": r["water_max"],
+            "water_mean": float(r["water_mean"]) if r["water_mean"] is not None else None,
+            "risk_max": r["risk_max"],
+        })
+    return {"t0": t0, "t1": t1, "bucket_sec": bucket_sec, "total": int(span["n"]), "items": items}
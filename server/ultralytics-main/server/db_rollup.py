@@ -0,0 +1,190 @@
+# server/db_rollup.py  —— detect_tick 的分钟 / 小时级预聚合
+#
+# detect_rollup 每行 = (粒度, 时间桶, session) 的统计，并带上 camera_id：
+#   - 按 session 看趋势：主键范围扫描
+#   - 按摄像头看趋势：idx_cam_time 索引上按时间桶再合并各 session
+# 数据来源：tick_writer 每次刷盘时顺带 upsert；历史数据用 rebuild_session_rollups 回填。
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .db_detect import get_conn
+
+GRANULARITIES = ("minute", "hour")
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS detect_rollup (
+  granularity   VARCHAR(8)  NOT NULL,
+  bucket_start  DATETIME    NOT NULL,
+  session_id    BIGINT      NOT NULL,
+  camera_id     VARCHAR(64) NOT NULL DEFAULT '',
+  n             INT         NOT NULL DEFAULT 0,
+  water_sum     DOUBLE      NOT NULL DEFAULT 0,
+  water_min     INT         NULL,
+  water_max     INT         NULL,
+  risk_max      INT         NULL,
+  PRIMARY KEY (granularity, session_id, bucket_start),
+  KEY idx_cam_time (granularity, camera_id, bucket_start)
+) DEFAULT CHARSET=utf8mb4
+"""
+
+_UPSERT_SQL = """
+INSERT INTO detect_rollup (
+  granularity, bucket_start, session_id, camera_id,
+  n, water_sum, water_min, water_max, risk_max
+) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+ON DUPLICATE KEY UPDATE
+  n = n + VALUES(n),
+  water_sum = water_sum + VALUES(water_sum),
+  water_min = LEAST(COALESCE(water_min, VALUES(water_min)), VALUES(water_min)),
+  water_max = GREATEST(COALESCE(water_max, VALUES(water_max)), VALUES(water_max)),
+  risk_max = GREATEST(COALESCE(risk_max, VALUES(risk_max)), VALUES(risk_max))
+"""
+
+# 按 session 开始时间 + video_sec 折算成墙钟时间（实时写入的 tick_writer 用同一时间基准）
+_BUCKET_EXPR = {
+    "minute": "DATE_FORMAT(s.started_at + INTERVAL FLOOR(t.video_sec) SECOND, '%%Y-%%m-%%d %%H:%%i:00')",
+    "hour": "DATE_FORMAT(s.started_at + INTERVAL FLOOR(t.video_sec) SECOND, '%%Y-%%m-%%d %%H:00:00')",
+}
+
+
+def ensure_rollup_table() -> None:
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(_DDL)
+        conn.commit()
+
+
+def bucket_start(ts: float, granularity: str) -> datetime:
+    dt = datetime.fromtimestamp(ts).replace(second=0, microsecond=0)
+    if granularity == "hour":
+        dt = dt.replace(minute=0)
+    return dt
+
+
+def aggregate_ticks(ticks: Iterable[Tuple[int, str, float, int, int]]) -> List[tuple]:
+    """
+    ticks: (session_id, camera_id, ts, water_percent, risk_level)
+      ts = started_at + FLOOR(video_sec) 的时间戳，与 _BUCKET_EXPR 一致，实时写入和回填分到同一个桶
+    返回可直接喂给 _UPSERT_SQL 的行（每个粒度 × 时间桶 × session 一行）
+    """
+    acc: Dict[tuple, list] = {}
+    for session_id, camera_id, ts, water, risk in ticks:
+        for gran in GRANULARITIES:
+            key = (gran, bucket_start(ts, gran), session_id)
+            a = acc.get(key)
+            if a is None:
+                acc[key] = [camera_id or "", 1, water, water, water, risk]
+            else:
+                a[1] += 1
+                a[2] += water
+                a[3] = min(a[3], water)
+                a[4] = max(a[4], water)
+                a[5] = max(a[5], risk)
+    return [
+        (gran, bucket, session_id, a[0], a[1], float(a[2]), a[3], a[4], a[5])
+        for (gran, bucket, session_id), a in acc.items()
+    ]
+
+
+def upsert_rollups(conn, rows: List[tuple]) -> int:
+    """用调用方的连接写入（tick_writer 和 detect_tick 同一次刷盘）"""
+    if not rows:
+        return 0
+    with conn.cursor() as cur:
+        cur.executemany(_UPSERT_SQL, rows)
+    conn.commit()
+    return len(rows)
+
+
+def rebuild_session_rollups(session_id: int) -> int:
+    """
+    从 detect_tick 全量重算一个 session 的聚合（回填历史数据 / 修正用）
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM detect_rollup WHERE session_id = %s", (session_id,))
+            total = 0
+            for gran in GRANULARITIES:
+                cur.execute(
+                    f"""
+                    INSERT INTO detect_rollup (
+                      granularity, bucket_start, session_id, camera_id,
+                      n, water_sum, water_min, water_max, risk_max
+                    )
+                    SELECT
+                      %s AS granularity,
+                      {_BUCKET_EXPR[gran]} AS bucket,
+                      t.session_id,
+                      MAX(COALESCE(s.camera_id, '')),
+                      COUNT(*),
+                      SUM(t.water_percent),
+                      MIN(t.water_percent),
+                      MAX(t.water_percent),
+                      MAX(t.risk_level)
+                    FROM detect_tick t
+                    JOIN detect_session s ON s.id = t.session_id
+                    WHERE t.session_id = %s
+                    GROUP BY t.session_id, bucket
+                    """,
+                    (gran, session_id),
+                )
+                total += cur.rowcount
+        conn.commit()
+    return total
+
+
+def query_trends(granularity: str = "minute",
+                 camera_id: Optional[str] = None,
+                 session_id: Optional[int] = None,
+                 start: Optional[datetime] = None,
+                 end: Optional[datetime] = None,
+                 limit: int = 5000) -> List[Dict]:
+    """
+    时间范围内的趋势：每个时间桶一行（按摄像头查时合并该摄像头所有 session）
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {GRANULARITIES}")
+
+    sql = """
+    SELECT
+        bucket_start,
+        SUM(n) AS n,
+        SUM(water_sum) / SUM(n) AS water_mean,
+        MIN(water_min) AS water_min,
+        MAX(water_max) AS water_max,
+        MAX(risk_max) AS risk_max
+    FROM detect_rollup
+    WHERE granularity = %s
+    """
+    params: list = [granularity]
+    if session_id:
+        sql += " AND session_id = %s"
+        params.append(session_id)
+    if camera_id:
+        sql += " AND camera_id = %s"
+        params.append(camera_id)
+    if start:
+        sql += " AND bucket_start >= %s"
+        params.append(start)
+    if end:
+        sql += " AND bucket_start < %s"
+        params.append(end)
+    sql += " GROUP BY bucket_start ORDER BY bucket_start LIMIT %s"
+    params.append(limit)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+    return [
+        {
+            "t": r["bucket_start"].isoformat(timespec="seconds") if isinstance(r["bucket_start"], datetime) else r["bucket_start"],
+            "n": int(r["n"] or 0),
+            "water_mean": float(r["water_mean"]) if r["water_mean"] is not None else None,
+            "water_min": r["water_min"],
+            "water_max": r["water_max"],
+            "risk_max": r["risk_max"],
+        }
+        for r in rows
+    ]
@@ -0,0 +1,320 @@
+# server/export_jobs.py  —— 带掩膜视频导出的后台任务
+#
+# 导出在独立的线程池里跑，请求只负责提交任务、查询进度、取结果文件。
+# 缓存文件名由 (session_id, detect_tick 校验和, 源视频大小/修改时间, 渲染选项) 算出，
+# tick 有改动或选项不同都会生成新文件；相同请求并发提交时复用同一个任务。
+# 同一 session + 选项的新文件导出完成后删掉被它取代的旧文件，目录总大小超过 EXPORT_CACHE_MAX_MB 时按最近使用淘汰；
+# 还在 EXPORT_JOB_TTL 内的任务引用的文件不删，保证客户端拿到 done 之后还能取到文件。
+# 缓存未命中时整段视频重新渲染（不做按分段的增量复用）：tick 改动通常分散在整段时间轴上，
+# 且 libx264 分段拼接需要对齐关键帧，收益不抵复杂度。
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Dict, Optional
+
+from .database import get_conn
+from .utils.export_video import EXPORT_BACKENDS, X264_PRESETS, export_video_with_ticks
+
+BASE_DIR = Path(__file__).resolve().parent
+RECORD_DIR = BASE_DIR / "records"
+EXPORT_DIR = BASE_DIR / "exports"
+EXPORT_DIR.mkdir(exist_ok=True)
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+# 旧的同步导出接口最多等多久（秒），超时返回 202 + job，由客户端改为轮询
+EXPORT_SYNC_WAIT = float(os.getenv("EXPORT_SYNC_WAIT_SEC", "20"))
+# 已结束的任务在内存里保留多久（秒）
+EXPORT_JOB_TTL = float(os.getenv("EXPORT_JOB_TTL", "3600"))
+# 导出目录的总大小上限（MB），超出后删掉最久没用过的文件
+EXPORT_CACHE_MAX_MB = float(os.getenv("EXPORT_CACHE_MAX_MB", "20480"))
+# 渲染逻辑有改动时调高，让旧缓存自动失效
+RENDER_VERSION = 2
+
+# 渲染选项及默认值：只有登记在这里的键才会进入缓存 key
+#   backend: auto / ffmpeg / filter / opencv（见 utils/export_video.py）
+#   preset / crf: libx264 的速度档位与质量（crf 越小越清晰、文件越大）
+DEFAULT_OPTIONS = {
+    "backend": os.getenv("EXPORT_BACKEND", "auto"),
+    "preset": os.getenv("EXPORT_X264_PRESET", "veryfast"),
+    "crf": int(os.getenv("EXPORT_X264_CRF", "23")),
+}
+
+
+class ExportError(RuntimeError):
+    """导出前置检查失败（session / 源视频 / tick 不存在），status_code 给路由用"""
+
+    def __init__(self, msg: str, status_code: int = 500):
+        super().__init__(msg)
+        self.status_code = status_code
+
+
+@dataclass
+class ExportJob:
+    id: str
+    session_id: int
+    cache_key: str
+    options: dict
+    out_path: str
+    status: str = "queued"      # queued / running / done / error
+    progress: float = 0.0
+    error: Optional[str] = None
+    cached: bool = False
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        d = asdict(self)
+        d["file_name"] = Path(self.out_path).name
+        d.pop("out_path")
+        return d
+
+
+def resolve_record_path(rel_path: str) -> Path:
+    """
+    detect_session.record_path 可能是 "records/cam/x.mp4" 也可能是 "cam/x.mp4"，统一映射到 RECORD_DIR 下
+    """
+    web_path = (rel_path or "").replace("\\", "/").lstrip("./")
+    if web_path.startswith("records/"):
+        web_path = web_path[len("records/"):]
+    return RECORD_DIR / web_path
+
+
+def normalize_options(options: Optional[dict]) -> dict:
+    opts = dict(DEFAULT_OPTIONS)
+    for k, v in (options or {}).items():
+        if k in DEFAULT_OPTIONS and v is not None:
+            try:
+                opts[k] = type(DEFAULT_OPTIONS[k])(v)
+            except (TypeError, ValueError):
+                raise ExportError(f"invalid option {k}={v!r}", 400)
+    if opts["backend"] not in EXPORT_BACKENDS:
+        raise ExportError(f"backend must be one of {EXPORT_BACKENDS}", 400)
+    if opts["preset"] not in X264_PRESETS:
+        raise ExportError(f"preset must be one of {X264_PRESETS}", 400)
+    if not 0 <= opts["crf"] <= 51:
+        raise ExportError("crf must be in [0, 51]", 400)
+    return opts
+
+
+def _load_session(session_id: int) -> dict:
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT record_path, camera_name FROM detect_session WHERE id = %s",
+                (session_id,),
+            )
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def tick_checksum(session_id: int) -> str:
+    """
+    detect_tick 内容的校验和（在 MySQL 里算，不把多边形拉回来）
+    """
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    COUNT(*) AS n,
+                    COALESCE(MAX(id), 0) AS max_id,
+                    COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        id, video_sec, water_percent, risk_level,
+                        COALESCE(water_polys, ''), COALESCE(risk_boxes, '')))), 0) AS crc
+                FROM detect_tick
+                WHERE session_id = %s
+                """,
+                (session_id,),
+            )
+            r = cur.fetchone() or {}
+    finally:
+        conn.close()
+    return f"{r.get('n', 0)}:{r.get('max_id', 0)}:{r.get('crc', 0)}"
+
+
+def make_cache_key(session_id: int, checksum: str, src_path: Path, options: dict) -> str:
+    st = src_path.stat()
+    raw = json.dumps({
+        "session_id": session_id,
+        "ticks": checksum,
+        "src": [str(src_path), st.st_size, int(st.st_mtime)],
+        "options": options,
+        "render": RENDER_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def make_variant(session_id: int, options: dict) -> str:
+    """同一 session + 渲染选项的标识：文件名里带上它，新文件完成后据此找到被取代的旧文件"""
+    raw = json.dumps({"session_id": session_id, "options": options}, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:8]
+
+
+def _is_part(path: Path) -> bool:
+    return path.name.endswith(".part" + path.suffix)
+
+
+class ExportJobManager:
+    def __init__(self, workers: int = EXPORT_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ExportJob] = {}
+        self._active_by_key: Dict[str, ExportJob] = {}
+
+    def submit(self, session_id: int, options: Optional[dict] = None) -> ExportJob:
+        """
+        同步做完前置检查（session / 源视频 / 校验和），命中缓存直接返回 done 的任务
+        """
+        row = _load_session(session_id)
+        if not row:
+            raise ExportError("session not found", 404)
+
+        src_path = resolve_record_path(row.get("record_path"))
+        if not row.get("record_path") or not src_path.exists():
+            raise ExportError("源视频不存在", 404)
+
+        opts = normalize_options(options)
+        checksum = tick_checksum(session_id)
+        if checksum.startswith("0:"):
+            raise ExportError("该 session 没有 detect_tick 数据", 404)
+
+        key = make_cache_key(session_id, checksum, src_path, opts)
+        out_path = EXPORT_DIR / f"{src_path.stem}_mask_{make_variant(session_id, opts)}_{key[:16]}.mp4"
+
+        self._prune()
+        with self._lock:
+            active = self._active_by_key.get(key)
+            if active is not None:
+                return active
+
+            job = ExportJob(
+                id=uuid.uuid4().hex,
+                session_id=session_id,
+                cache_key=key,
+                options=opts,
+                out_path=str(out_path),
+            )
+            self._jobs[job.id] = job
+
+            if out_path.exists():
+                job.status, job.progress, job.cached = "done", 1.0, True
+                job.finished_at = time.time()
+                # 按 mtime 做 LRU：命中缓存算一次使用
+                try:
+                    os.utime(out_path)
+                except OSError:
+                    pass
+                return job
+
+            self._active_by_key[key] = job
+
+        self._pool.submit(self._run, job, str(src_path))
+        return job
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        return self._jobs.get(job_id)
+
+    def wait(self, job: ExportJob, timeout: Optional[float] = None) -> ExportJob:
+        deadline = None if timeout is None else time.time() + timeout
+        while job.status in ("queued", "running"):
+            if deadline is not None and time.time() > deadline:
+                break
+            time.sleep(0.2)
+        return job
+
+    def _run(self, job: ExportJob, src_path: str) -> None:
+        job.status = "running"
+        out_path = Path(job.out_path)
+        # 先写临时文件，完成后原子替换，半成品永远不会被当成缓存
+        tmp_path = out_path.with_name(f"{out_path.stem}.{job.id[:8]}.part{out_path.suffix}")
+
+        def on_progress(frac: float):
+            job.progress = round(float(frac), 4)
+
+        try:
+            export_video_with_ticks(job.session_id, src_path, str(tmp_path),
+                                    progress_cb=on_progress, **job.options)
+            os.replace(tmp_path, out_path)
+            job.status, job.progress = "done", 1.0
+            self._evict(out_path)
+        except Exception as e:
+            job.status, job.error = "error", str(e)
+            print("[EXPORT] job error:", job.id, e)
+            try:
+                tmp_path.unlink()
+            except Exception:
+                pass
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active_by_key.pop(job.cache_key, None)
+
+    def _evict(self, out_path: Path) -> None:
+        """
+        新文件完成后清理导出目录：
+        1) 同一 session + 选项的旧文件（tick / 源视频 / RENDER_VERSION 变了之后留下的）直接删；
+        2) 总大小超过 EXPORT_CACHE_MAX_MB 时按 mtime 从旧到新删
+        正在导出的、以及 self._jobs 里还没过期的任务引用的文件都不动（客户端可能正要来取）
+        """
+        self._prune()
+        with self._lock:
+            busy = {Path(j.out_path) for j in self._jobs.values()}
+            busy.update(Path(j.out_path) for j in self._active_by_key.values())
+        busy.add(out_path)
+
+        prefix = out_path.name.rsplit("_", 1)[0] + "_"   # {stem}_mask_{variant}_
+        for p in EXPORT_DIR.glob(glob.escape(prefix) + "*" + out_path.suffix):
+            if p not in busy and not _is_part(p):
+                self._remove(p, "superseded")
+
+        files = []
+        for p in EXPORT_DIR.glob("*.mp4"):
+            if _is_part(p):
+                continue
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in files)
+        limit = EXPORT_CACHE_MAX_MB * 1024 * 1024
+        for _, size, p in sorted(files):
+            if total <= limit:
+                break
+            if p in busy:
+                continue
+            if self._remove(p, "over size limit"):
+                total -= size
+
+    @staticmethod
+    def _remove(path: Path, reason: str) -> bool:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            print("[EXPORT] remove cache error:", path, e)
+            return False
+        print(f"[EXPORT] removed cached export ({reason}):", path.name)
+        return True
+
+    def _prune(self) -> None:
+        now = time.time()
+        with self._lock:
+            for jid in [j.id for j in self._jobs.values()
+                        if j.finished_at and now - j.finished_at > EXPORT_JOB_TTL]:
+                del self._jobs[jid]
+
+
+# 进程内唯一的导出任务管理器
+EXPORT_JOBS = ExportJobManager()
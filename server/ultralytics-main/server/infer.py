@@ -1,6 +1,6 @@
 # server/infer.py
-from typing import List, Dict, Any, Optional
-import os, cv2, numpy as np
+from typing import List, Dict, Any, Optional, Tuple
+import os, queue, threading, cv2, numpy as np
 from ultralytics import YOLO
 from pathlib import Path
 
@@ -13,6 +13,13 @@ CONF = float(os.getenv("YOLO_CONF", "0.25"))
 IOU = float(os.getenv("YOLO_IOU", "0.45"))
 RETINA = (os.getenv("YOLO_RETINA", "1") == "1")  # 默认 True
 BASE_DIR = Path(__file__).resolve().parent.parent
+# 视频分析：一次 predict 的帧数 / 解码线程最多提前解好多少帧
+VIDEO_BATCH = int(os.getenv("INFER_VIDEO_BATCH", "8"))
+# 批量图片接口每次 predict 的张数（按显存调整）
+IMAGE_BATCH = int(os.getenv("INFER_IMAGE_BATCH", "16"))
+VIDEO_DECODE_AHEAD = int(os.getenv("INFER_VIDEO_DECODE_AHEAD", "32"))
+# 抽帧间隔不小于该值时直接 seek 到下一帧，否则逐帧 grab 跳过（grab 只解码、不做格式转换）
+VIDEO_SEEK_STRIDE = int(os.getenv("INFER_VIDEO_SEEK_STRIDE", "120"))
 
 
 def load_model(weights: Optional[str] = None, device: Optional[str] = None) -> YOLO:
@@ -68,6 +75,15 @@ def _predict_frame(model: YOLO, frame_bgr: np.ndarray):
     )[0]
 
 
+def _predict_frames(model: YOLO, frames_bgr: List[np.ndarray]):
+    """一批帧一次 predict，预处理 / 超参与 _predict_frame 相同"""
+    frames_rgb = [cv2.cvtColor(f, cv2.COLOR_BGR2RGB) for f in frames_bgr]
+    return model.predict(
+        frames_rgb, imgsz=IMGSZ, conf=CONF, iou=IOU,
+        retina_masks=RETINA, verbose=False
+    )
+
+
 def _results_to_objects(result, min_conf: float = 0.25):
     """
         统一把 result 转成 [{cls, conf, bbox?, poly?}, ...]
@@ -112,24 +128,129 @@ def infer_image(img_bgr: np.ndarray, min_conf: float = 0.25) -> Dict[str, Any]:
     return {"image_meta": {"width": w, "height": h}, "objects": objs}
 
 
-def infer_video(path: str, every_nth: int = 5, min_conf: float = 0.25):
+def infer_images(imgs_bgr: List[np.ndarray], min_conf: float = 0.25) -> List[Dict[str, Any]]:
+    """一批图片一次 predict，每张的结果格式与 infer_image 相同"""
+    model = load_model()
+    results = model.predict(list(imgs_bgr), verbose=False)
+    out = []
+    for img, res in zip(imgs_bgr, results):
+        h, w = img.shape[:2]
+        out.append({"image_meta": {"width": w, "height": h}, "objects": _results_to_objects(res, min_conf=min_conf)})
+    return out
+
+
+def infer_frames(frames_bgr: List[np.ndarray], min_conf: float = 0.25) -> List[list]:
+    """一批帧 → 每帧的 objects 列表"""
     model = load_model()
-    cap = cv2.VideoCapture(path)
-    if not cap.isOpened(): raise RuntimeError("cannot open video")
-    fps = cap.get(cv2.CAP_PROP_FPS) or 25
-    w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    dur = int((cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps) * 1000)
-
-    frames, idx = [], 0
-    while True:
-        ok, frame = cap.read()
-        if not ok: break
-        if idx % max(1, every_nth) != 0: idx += 1; continue
-        t_ms = int(cap.get(cv2.CAP_PROP_POS_MSEC))
-        res = _predict_frame(model, frame)
-        objs = _results_to_objects(res, min_conf=min_conf)
-        frames.append({"t_ms": t_ms, "objects": objs})
-        idx += 1
-    cap.release()
-    return {"video_meta": {"fps": fps, "duration_ms": dur, "width": w, "height": h}, "frames": frames}
+    return [_results_to_objects(r, min_conf=min_conf) for r in _predict_frames(model, frames_bgr)]
+
+
+class VideoFrameSampler:
+    """
+    后台线程按 every_nth 抽帧：没抽中的帧只 grab（或大间隔时直接 seek），抽中的才 retrieve，
+    解好的帧放进有界队列，推理端按批取走。meta 与旧版 infer_video 的 video_meta 相同。
+    seekable=False：源是管道（边上传边解码），只能顺序 grab
+    """
+
+    def __init__(self, path: str, every_nth: int = 5, ahead: int = VIDEO_DECODE_AHEAD, seekable: bool = True):
+        # 管道只能打开一次：固定用 FFMPEG 后端，避免打开失败时换别的后端重新 open 而永远阻塞
+        self.cap = cv2.VideoCapture(path) if seekable else cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+        if not self.cap.isOpened():
+            raise RuntimeError("cannot open video")
+        fps = self.cap.get(cv2.CAP_PROP_FPS) or 25
+        self.meta = {
+            "fps": fps,
+            "duration_ms": int((self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps) * 1000),
+            "width": int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        }
+        self.step = max(1, int(every_nth))
+        self.seekable = seekable
+        self._q: "queue.Queue[Optional[Tuple[int, int, np.ndarray]]]" = queue.Queue(maxsize=max(1, ahead))
+        self._stop = threading.Event()
+        self._eof = False
+        self._thread = threading.Thread(target=self._decode, name="video-decode", daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self) -> None:
+        cap = self.cap
+        seek = self.seekable and self.step >= VIDEO_SEEK_STRIDE
+        pos = target = 0
+        try:
+            while not self._stop.is_set():
+                if seek and target > pos:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                    pos = target
+                while pos < target:
+                    if not cap.grab():
+                        return
+                    pos += 1
+                if not cap.grab():
+                    return
+                ok, frame = cap.retrieve()
+                pos += 1
+                if not ok:
+                    return
+                if not self._put((target, int(cap.get(cv2.CAP_PROP_POS_MSEC)), frame)):
+                    return
+                target += self.step
+        finally:
+            cap.release()
+            self._put(None)
+
+    def next_batch(self, n: int = VIDEO_BATCH) -> List[Tuple[int, int, np.ndarray]]:
+        """
+        阻塞到至少有一帧，再顺手带上已解好的帧（最多 n 帧）；读完返回 []
+        返回 [(frame_idx, t_ms, frame_bgr), ...]
+        """
+        if self._eof:
+            return []
+        item = self._q.get()
+        if item is None:
+            self._eof = True
+            return []
+        batch = [item]
+        while len(batch) < n:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._eof = True
+                break
+            batch.append(item)
+        return batch
+
+    def close(self) -> None:
+        self._stop.set()
+        # 放掉队列里的帧，让解码线程能从 put 里出来
+        while True:
+            try:
+                self._q.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join(timeout=2.0)
+
+
+def infer_video(path: str, every_nth: int = 5, min_conf: float = 0.25):
+    sampler = VideoFrameSampler(path, every_nth)
+    frames = []
+    try:
+        while True:
+            batch = sampler.next_batch(VIDEO_BATCH)
+            if not batch:
+                break
+            objs = infer_frames([f for _, _, f in batch], min_conf)
+            frames.extend({"t_ms": t_ms, "objects": o} for (_, t_ms, _), o in zip(batch, objs))
+    finally:
+        sampler.close()
+    return {"video_meta": sampler.meta, "frames": frames}
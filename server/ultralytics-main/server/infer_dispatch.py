@@ -0,0 +1,120 @@
+# server/infer_dispatch.py  —— 实时双模型推理的后端选择
+#
+# DUAL_INFER_BACKEND:
+#   thread（默认）: 每帧作为 live 优先级任务交给 infer_sched 的专用线程池跑 infer_dual_on_frame
+#   batch         : 交给 batch_infer 的跨摄像头微批调度器
+#   process       : 交给 infer_workers 的多进程 worker 池（每个进程一套模型，绕开 GIL）
+# batch / process 同样按 live 的队列上限 / 最长等待丢帧，并把排队中的实时帧数登记给 INFER_SCHED，
+# 让同一块 GPU 上的 image / video 任务在有实时帧积压时让路
+import asyncio
+import os
+from typing import Optional
+
+from .adaptive import INFER_LOAD
+from .infer_sched import INFER_SCHED, INFER_SCHED_MAX_RUNNING, PRIORITY_LIVE, InferRejected, InferShed
+from .pipeline_dual import infer_dual_on_frame
+
+DUAL_INFER_BACKEND = (os.getenv("DUAL_INFER_BACKEND") or "thread").strip().lower()
+
+
+async def infer_dual_async(frame, params: dict, rgb: bool = False, key: Optional[str] = None) -> dict:
+    """
+    在事件循环里等待一帧的双模型推理结果，不阻塞其他连接
+    rgb=True：frame 已是 RGB（如 ffmpeg 直接输出 rgb24），跳过颜色转换
+    key：流 / 会话标识（process 后端据此把同一路流固定在同一个 worker 上）
+    """
+    if DUAL_INFER_BACKEND == "batch":
+        from .batch_infer import get_batch_scheduler
+        fut = get_batch_scheduler().submit(frame, params, rgb=rgb)
+        return await asyncio.wrap_future(fut)
+
+    if DUAL_INFER_BACKEND == "process":
+        return await _infer_process(frame, params, rgb, key)
+
+    # 队列满 / 排队太久时抛 InferRejected（InferShed），由调用方沿用上次结果
+    return await INFER_SCHED.run(PRIORITY_LIVE, key, infer_dual_on_frame, frame, params, rgb)
+
+
+async def _infer_process(frame, params: dict, rgb: bool, key: Optional[str]) -> dict:
+    """
+    worker 中途挂了：换一个活着的 worker 重试一次；
+    重试还失败、worker 全在重启、或 worker 里推理报错，都转成 InferShed，
+    调用方按丢帧处理（沿用上次结果），不让一路流因此断掉
+    """
+    from .infer_workers import NoWorkerAvailable, WorkerCrashed, get_worker_pool
+    pool = get_worker_pool()
+    for attempt in range(2):
+        try:
+            return await asyncio.wrap_future(pool.submit(frame, params, rgb=rgb, key=key))
+        except WorkerCrashed as e:
+            if attempt:
+                raise InferShed(f"worker crashed twice: {e}", PRIORITY_LIVE) from e
+            print("[INFER] worker crashed, retry once:", e)
+        except NoWorkerAvailable as e:
+            raise InferShed(str(e), PRIORITY_LIVE) from e
+        except InferRejected:
+            # 队列满 / 排队过久被丢弃，原样交给调用方
+            raise
+        except RuntimeError as e:
+            print("[INFER] worker inference error:", e)
+            raise InferShed(f"worker inference error: {e}", PRIORITY_LIVE) from e
+
+
+def live_pressure() -> float:
+    """
+    自适应控制的全局负载：排队中（还没开始算）的实时帧数 / 后端能同时算的帧数。
+    后端有余量时帧不会排队，压力为 0，与同时开着多少路摄像头无关
+    """
+    if DUAL_INFER_BACKEND == "batch":
+        from .batch_infer import get_batch_scheduler
+        sched = get_batch_scheduler()
+        return sched.backlog() / sched.max_batch
+    if DUAL_INFER_BACKEND == "process":
+        from .infer_workers import get_worker_pool
+        pool = get_worker_pool()
+        lanes = sum(1 for w in pool.workers if w.routable)
+        return pool.backlog() / lanes if lanes else 1.0
+    return INFER_SCHED.queued(PRIORITY_LIVE) / max(1, min(INFER_SCHED.threads, INFER_SCHED_MAX_RUNNING[PRIORITY_LIVE]))
+
+
+INFER_LOAD.set_source(live_pressure)
+
+
+def release_session(key: str) -> None:
+    """一路流结束时调用（目前只有 process 后端需要释放 worker 上的占位）"""
+    if DUAL_INFER_BACKEND == "process":
+        from .infer_workers import get_worker_pool
+        get_worker_pool().release(key)
+
+
+def start_backend() -> None:
+    """
+    应用启动时调用：process 后端提前拉起 worker（各自加载模型），避免首帧等很久；
+    batch / process 后端把实时帧积压登记给 INFER_SCHED
+    """
+    if DUAL_INFER_BACKEND == "batch":
+        from .batch_infer import get_batch_scheduler
+        INFER_SCHED.set_live_backlog(get_batch_scheduler().backlog)
+    elif DUAL_INFER_BACKEND == "process":
+        from .infer_workers import get_worker_pool
+        pool = get_worker_pool().start()
+        INFER_SCHED.set_live_backlog(pool.backlog)
+
+
+def shutdown_backend() -> None:
+    if DUAL_INFER_BACKEND in ("batch", "process"):
+        INFER_SCHED.set_live_backlog(None)
+    if DUAL_INFER_BACKEND == "process":
+        from .infer_workers import shutdown_worker_pool
+        shutdown_worker_pool()
+
+
+def backend_stats() -> dict:
+    stats = {"backend": DUAL_INFER_BACKEND, "sched": INFER_SCHED.stats()}
+    if DUAL_INFER_BACKEND == "batch":
+        from .batch_infer import get_batch_scheduler
+        stats["batch"] = get_batch_scheduler().stats()
+    elif DUAL_INFER_BACKEND == "process":
+        from .infer_workers import get_worker_pool
+        stats["process"] = get_worker_pool().stats()
+    return stats
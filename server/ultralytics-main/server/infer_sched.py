@@ -0,0 +1,319 @@
+# server/infer_sched.py  —— 进程内推理任务的有界优先级调度
+#
+# 实时 tick、临时上传的单图、整段视频分析原来都丢进默认线程池，互不设限，
+# 一个大视频就能把所有线程占满、拖慢全部摄像头。这里统一走一个专用线程池：
+# - 三个优先级：live（实时 tick）> image（单图 / 批量图片）> video（视频分析）
+#   空闲线程总是先取高优先级的任务；image / video 各自另有并发上限，给 live 留出线程
+# - 同一优先级内按会话轮转（每个会话一个 FIFO），一个会话排再多任务也只能轮到自己那份
+# - 队列深度有上限：超出时 image / video 直接拒绝（路由返回 503），
+#   live 则丢掉同会话最旧的那一帧（反正已经过时），排队超过 INFER_SCHED_LIVE_MAX_WAIT_MS 的也丢
+# - stats() 给出各级排队 / 运行 / 拒绝 / 丢弃数和等待时间，挂在 /api/streams 里
+# - DUAL_INFER_BACKEND=batch / process 时实时帧走各自的后端（同样按下面的 live 队列上限和最长等待丢帧），
+#   它们通过 set_live_backlog 报告还在排队的实时帧数，积压不为 0 时本调度器不开始新的 image / video 任务
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, Deque, Dict, List, Optional
+
+PRIORITY_LIVE = "live"
+PRIORITY_IMAGE = "image"
+PRIORITY_VIDEO = "video"
+PRIORITIES = (PRIORITY_LIVE, PRIORITY_IMAGE, PRIORITY_VIDEO)
+
+INFER_SCHED_THREADS = int(os.getenv("INFER_SCHED_THREADS", "4"))
+# 各优先级最多同时占几个线程（live 不设限）
+INFER_SCHED_MAX_RUNNING = {
+    PRIORITY_LIVE: INFER_SCHED_THREADS,
+    PRIORITY_IMAGE: int(os.getenv("INFER_SCHED_IMAGE_RUNNING", "2")),
+    PRIORITY_VIDEO: int(os.getenv("INFER_SCHED_VIDEO_RUNNING", "1")),
+}
+# 各优先级总排队上限 / 单个会话排队上限
+INFER_SCHED_MAX_QUEUED = {
+    PRIORITY_LIVE: int(os.getenv("INFER_SCHED_LIVE_QUEUE", "64")),
+    PRIORITY_IMAGE: int(os.getenv("INFER_SCHED_IMAGE_QUEUE", "32")),
+    PRIORITY_VIDEO: int(os.getenv("INFER_SCHED_VIDEO_QUEUE", "8")),
+}
+INFER_SCHED_SESSION_QUEUE = {
+    PRIORITY_LIVE: int(os.getenv("INFER_SCHED_LIVE_SESSION_QUEUE", "2")),
+    PRIORITY_IMAGE: int(os.getenv("INFER_SCHED_IMAGE_SESSION_QUEUE", "8")),
+    PRIORITY_VIDEO: int(os.getenv("INFER_SCHED_VIDEO_SESSION_QUEUE", "2")),
+}
+# 实时帧排队超过这么久就不再推理（结果出来也已经过时）
+INFER_SCHED_LIVE_MAX_WAIT_MS = float(os.getenv("INFER_SCHED_LIVE_MAX_WAIT_MS", "1000"))
+# 拒绝时建议客户端多久后重试（秒）
+INFER_SCHED_RETRY_AFTER = int(os.getenv("INFER_SCHED_RETRY_AFTER", "2"))
+# 外部后端有实时帧积压时，隔多久再看一次积压是否清空（秒）
+_BACKLOG_POLL_SEC = 0.02
+
+
+class InferRejected(RuntimeError):
+    """队列已满，任务没有被接收（路由层转成 503）"""
+
+    def __init__(self, msg: str, priority: str):
+        super().__init__(msg)
+        self.priority = priority
+        self.status_code = 503
+        self.retry_after = INFER_SCHED_RETRY_AFTER
+
+
+class InferShed(InferRejected):
+    """任务已入队，但因过时 / 被更新的帧挤掉而放弃执行"""
+
+
+def _settle(future: Future, result=None, exc: Optional[BaseException] = None) -> None:
+    """
+    交付结果 / 异常；future 已被调用方取消（流退订时 wrap_future 会连带取消）就直接跳过，
+    不能让调度线程因为 InvalidStateError 退出
+    """
+    if future.done():
+        return
+    try:
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _Job:
+    __slots__ = ("seq", "priority", "session", "fn", "args", "kwargs", "future", "t_submit")
+
+    def __init__(self, seq: int, priority: str, session: str, fn: Callable, args, kwargs):
+        self.seq = seq
+        self.priority = priority
+        self.session = session
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.t_submit = time.perf_counter()
+
+
+class _ClassStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.shed = 0
+        self.running = 0
+        self.waits: Deque[float] = deque(maxlen=256)   # 最近的排队时间（毫秒）
+        self.run_ms = 0.0
+
+    def snapshot(self, queued: int, sessions: int) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "queued": queued,
+            "sessions": sessions,
+            "running": self.running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "wait_ms_avg": round(sum(waits) / len(waits), 1) if waits else 0.0,
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95) - 1], 1) if len(waits) >= 20 else None,
+            "run_ms_avg": round(self.run_ms, 1),
+        }
+
+
+class InferScheduler:
+    """
+    submit() 线程安全，返回 concurrent.futures.Future；协程里用 await run(...)
+    """
+
+    def __init__(self, threads: int = INFER_SCHED_THREADS):
+        self.threads = max(1, int(threads))
+        self._cond = threading.Condition()
+        # priority -> OrderedDict(session -> deque[_Job])，OrderedDict 的顺序即轮转顺序
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Job]]"] = {p: OrderedDict() for p in PRIORITIES}
+        self._queued = {p: 0 for p in PRIORITIES}
+        self._stats = {p: _ClassStats() for p in PRIORITIES}
+        self._seq = itertools.count()
+        self._workers: List[threading.Thread] = []
+        self._live_backlog: Optional[Callable[[], int]] = None
+
+    def start(self) -> None:
+        with self._cond:
+            if self._workers:
+                return
+            for i in range(self.threads):
+                t = threading.Thread(target=self._loop, name=f"infer-sched-{i}", daemon=True)
+                t.start()
+                self._workers.append(t)
+
+    # ---------- 提交 ----------
+    def submit(self, priority: str, session: Optional[str], fn: Callable, *args, **kwargs) -> Future:
+        if priority not in PRIORITIES:
+            raise ValueError(f"unknown priority: {priority}")
+        self.start()
+        session = session or "-"
+        job = _Job(next(self._seq), priority, session, fn, args, kwargs)
+        shed: List[_Job] = []
+        st = self._stats[priority]
+        try:
+            with self._cond:
+                queues = self._queues[priority]
+                q = queues.get(session)
+                if q is not None and len(q) >= INFER_SCHED_SESSION_QUEUE[priority]:
+                    if priority != PRIORITY_LIVE:
+                        st.rejected += 1
+                        raise InferRejected(f"too many pending {priority} jobs for this session", priority)
+                    # 实时帧：同会话最旧的一帧让位给新帧
+                    shed.append(q.popleft())
+                    self._queued[priority] -= 1
+                if self._queued[priority] >= INFER_SCHED_MAX_QUEUED[priority]:
+                    if priority != PRIORITY_LIVE or not self._shed_oldest_live(shed):
+                        st.rejected += 1
+                        raise InferRejected(f"{priority} inference queue is full", priority)
+                q = queues.get(session)
+                if q is None:
+                    q = queues[session] = deque()
+                q.append(job)
+                self._queued[priority] += 1
+                st.submitted += 1
+                self._cond.notify()
+        finally:
+            if shed:
+                with self._cond:
+                    st.shed += len(shed)
+                for old in shed:
+                    _settle(old.future, exc=InferShed("superseded by a newer frame", priority))
+        return job.future
+
+    async def run(self, priority: str, session: Optional[str], fn: Callable, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(priority, session, fn, *args, **kwargs))
+
+    def set_live_backlog(self, fn: Optional[Callable[[], int]]) -> None:
+        """
+        登记外部后端（batch / process）里排队中的实时帧数；fn 会在持锁时调用，必须便宜、不能反过来碰调度器
+        """
+        with self._cond:
+            self._live_backlog = fn
+            self._cond.notify_all()
+
+    def _external_live_backlog(self) -> int:
+        fn = self._live_backlog
+        if fn is None:
+            return 0
+        try:
+            return int(fn())
+        except Exception:
+            return 0
+
+    def _shed_oldest_live(self, shed: List[_Job]) -> bool:
+        """live 总队列满：丢掉全局最旧的那一帧腾位置（调用方持锁）"""
+        queues = self._queues[PRIORITY_LIVE]
+        oldest = min((q[0] for q in queues.values() if q), key=lambda j: j.seq, default=None)
+        if oldest is None:
+            return False
+        q = queues[oldest.session]
+        q.popleft()
+        if not q:
+            del queues[oldest.session]
+        self._queued[PRIORITY_LIVE] -= 1
+        shed.append(oldest)
+        return True
+
+    # ---------- 取任务 ----------
+    def _next_locked(self, expired: List[_Job]) -> Optional[_Job]:
+        now = time.perf_counter()
+        backlog = self._external_live_backlog()
+        for priority in PRIORITIES:
+            if priority != PRIORITY_LIVE and backlog:
+                # 外部后端里还有实时帧在等 GPU：image / video 先不开始新任务
+                break
+            if self._stats[priority].running >= INFER_SCHED_MAX_RUNNING[priority]:
+                continue
+            queues = self._queues[priority]
+            while queues:
+                # 轮转：取队首会话的第一个任务，该会话还有剩余就挪到队尾
+                session, q = next(iter(queues.items()))
+                if not q:
+                    del queues[session]
+                    continue
+                job = q.popleft()
+                if q:
+                    queues.move_to_end(session)
+                else:
+                    del queues[session]
+                self._queued[priority] -= 1
+                if (priority == PRIORITY_LIVE
+                        and (now - job.t_submit) * 1000.0 > INFER_SCHED_LIVE_MAX_WAIT_MS):
+                    expired.append(job)
+                    continue
+                return job
+        return None
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                # 兜底：单个任务出任何问题都不能让调度线程退出
+                print("[INFER_SCHED] worker loop error:", e)
+
+    def _step(self) -> None:
+        expired: List[_Job] = []
+        with self._cond:
+            job = self._next_locked(expired)
+            while job is None:
+                if expired:
+                    break
+                # 外部后端的积压清空时不会通知这里，登记了就定时再看一眼
+                self._cond.wait(_BACKLOG_POLL_SEC if self._live_backlog is not None else None)
+                job = self._next_locked(expired)
+            if job is not None:
+                st = self._stats[job.priority]
+                st.running += 1
+                st.waits.append((time.perf_counter() - job.t_submit) * 1000.0)
+            self._stats[PRIORITY_LIVE].shed += len(expired)
+        for old in expired:
+            _settle(old.future, exc=InferShed("live frame waited too long", PRIORITY_LIVE))
+        if job is None:
+            return
+
+        if not job.future.set_running_or_notify_cancel():
+            self._finish(job, ok=False, run_ms=0.0)
+            return
+        t0 = time.perf_counter()
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except BaseException as e:
+            self._finish(job, ok=False, run_ms=(time.perf_counter() - t0) * 1000.0)
+            _settle(job.future, exc=e)
+        else:
+            self._finish(job, ok=True, run_ms=(time.perf_counter() - t0) * 1000.0)
+            _settle(job.future, result)
+
+    def _finish(self, job: _Job, ok: bool, run_ms: float) -> None:
+        with self._cond:
+            st = self._stats[job.priority]
+            st.running -= 1
+            if ok:
+                st.completed += 1
+            else:
+                st.failed += 1
+            st.run_ms = run_ms if st.run_ms == 0.0 else 0.8 * st.run_ms + 0.2 * run_ms
+            # 释放了一个并发名额：可能有被上限卡住的低优先级任务可以跑了
+            self._cond.notify()
+
+    def queued(self, priority: str) -> int:
+        return self._queued[priority]
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "threads": self.threads,
+                "live_backlog_external": self._external_live_backlog(),
+                **{p: self._stats[p].snapshot(self._queued[p], len(self._queues[p])) for p in PRIORITIES},
+            }
+
+
+# 进程内唯一的调度器
+INFER_SCHED = InferScheduler()
@@ -0,0 +1,442 @@
+# server/infer_workers.py  —— 多进程推理 worker 池
+#
+# DUAL_INFER_BACKEND=process 时启用。起 INFER_WORKERS 个子进程，每个进程自己加载一套
+# 积水 + 风险模型（INFER_WORKER_DEVICES 可把 worker 分到不同 GPU 上），
+# 前后处理都在子进程里做，不再和 uvicorn 主进程抢 GIL。
+#
+# - 帧：主进程拷进该 worker 专属的共享内存槽位（INFER_WORKER_SLOTS 个），管道里只传槽号 + 形状；
+#       槽位用完或帧超过槽位大小时退回直接 pickle 整帧
+# - 结果：infer_dual_on_frame 的输出 dict 走管道 pickle 回来（几 KB，掩膜几十 KB）
+# - 负载均衡：同一路流（key）粘在同一个 worker 上，新流分给承担流数最少的 worker；
+#             不带 key 的请求给在途最少的 worker
+# - 健康检查：后台线程定期看进程是否还活着、正在算的那一帧是否超过 INFER_WORKER_TIMEOUT_SEC，
+#             挂掉 / 卡死的 worker 在途任务以 WorkerCrashed 失败，随后自动重启；
+#             worker 发回 ready（模型加载完）之后才参与分配，加载超过 INFER_WORKER_LOAD_TIMEOUT_SEC 也按卡死处理
+# - 实时帧的限额与 thread 后端相同：排队帧总数超过 live 队列上限时拒收新帧，
+#   worker 取到时已等了 INFER_SCHED_LIVE_MAX_WAIT_MS 以上的帧直接丢弃（都以 InferShed 失败）
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .infer_sched import (
+    INFER_SCHED_LIVE_MAX_WAIT_MS,
+    INFER_SCHED_MAX_QUEUED,
+    PRIORITY_LIVE,
+    InferRejected,
+    InferShed,
+)
+
+INFER_WORKERS = int(os.getenv("INFER_WORKERS", "2"))
+# 逗号分隔的 GPU 编号，worker i 用第 i % len 块卡（设置子进程的 CUDA_VISIBLE_DEVICES）；空 = 继承主进程
+INFER_WORKER_DEVICES = [d.strip() for d in (os.getenv("INFER_WORKER_DEVICES") or "").split(",") if d.strip()]
+INFER_WORKER_SLOTS = int(os.getenv("INFER_WORKER_SLOTS", "4"))
+# 共享内存槽位能放下的最大帧（宽x高，RGB/BGR 三通道）
+INFER_WORKER_MAX_FRAME = os.getenv("INFER_WORKER_MAX_FRAME", "1920x1080")
+INFER_WORKER_HEALTH_SEC = float(os.getenv("INFER_WORKER_HEALTH_SEC", "2"))
+INFER_WORKER_TIMEOUT_SEC = float(os.getenv("INFER_WORKER_TIMEOUT_SEC", "30"))
+INFER_WORKER_LOAD_TIMEOUT_SEC = float(os.getenv("INFER_WORKER_LOAD_TIMEOUT_SEC", "300"))
+
+
+class WorkerCrashed(RuntimeError):
+    """worker 进程在任务完成前退出 / 被判定卡死"""
+
+
+class NoWorkerAvailable(RuntimeError):
+    """所有 worker 都不可用（正在重启）"""
+
+
+# worker 端丢弃过期帧时的回复内容
+_SHED = "__shed__"
+
+
+def _slot_bytes() -> int:
+    w, h = (int(v) for v in INFER_WORKER_MAX_FRAME.lower().split("x"))
+    return w * h * 3
+
+
+# ---------- 子进程 ----------
+def _worker_main(idx: int, conn, shm_name: str, slot_bytes: int, device: Optional[str], threads: int):
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+    # 模型在这里才导入 / 加载：每个 worker 各有一份
+    from .pipeline_dual import infer_dual_on_frame, load_dual_models
+    try:
+        import torch
+        torch.set_num_threads(max(1, threads))
+    except Exception:
+        pass
+
+    # 共享内存由主进程创建 / 删除；spawn 出来的子进程和主进程共用同一个 resource_tracker，这里只 attach
+    shm = shared_memory.SharedMemory(name=shm_name)
+
+    load_dual_models()
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg is None:
+            break
+        job_id, slot, shape, inline, params, rgb, deadline = msg
+        if time.time() > deadline:
+            # 在管道里排得太久的实时帧：结果出来也已经过时，不再推理
+            conn.send((job_id, False, _SHED))
+            continue
+        frame = None
+        try:
+            if inline is not None:
+                frame = inline
+            else:
+                frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot * slot_bytes)
+            out = infer_dual_on_frame(frame, params, rgb)
+            conn.send((job_id, True, out))
+        except Exception as e:
+            conn.send((job_id, False, f"{type(e).__name__}: {e}"))
+        finally:
+            # 释放对共享内存的引用，否则 shm.close() 会报 BufferError
+            frame = None
+    shm.close()
+
+
+# ---------- 主进程侧 ----------
+class _Worker:
+    def __init__(self, pool: "InferWorkerPool", idx: int, device: Optional[str]):
+        self.pool = pool
+        self.idx = idx
+        self.device = device
+        self.shm = shared_memory.SharedMemory(create=True, size=pool.slot_bytes * pool.slots)
+        self.free_slots: List[int] = list(range(pool.slots))
+        # job_id -> (future, slot, 提交时刻)
+        self.pending: Dict[int, Tuple[Future, Optional[int], float]] = {}
+        self.lock = threading.Lock()
+        self.proc = None
+        self.conn = None
+        self.alive = False        # 进程在跑
+        self.ready = False        # 模型已加载完，可以分配任务
+        self.spawned_at = 0.0
+        # 队头那一帧开始算的时刻（worker 一次只算一帧）；没有在途任务时为 None
+        self.busy_since: Optional[float] = None
+        self.pid: Optional[int] = None
+        self.sessions = 0
+
+        # 统计
+        self.jobs = 0
+        self.errors = 0
+        self.shed = 0
+        self.inline = 0
+        self.restarts = 0
+        self.avg_ms = 0.0
+
+    @property
+    def inflight(self) -> int:
+        return len(self.pending)
+
+    @property
+    def routable(self) -> bool:
+        return self.alive and self.ready
+
+    def spawn(self) -> None:
+        ctx = self.pool.ctx
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(
+            target=_worker_main,
+            args=(self.idx, child_conn, self.shm.name, self.pool.slot_bytes, self.device, self.pool.threads),
+            name=f"infer-worker-{self.idx}",
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+        with self.lock:
+            self.proc, self.conn, self.alive, self.pid = proc, parent_conn, True, None
+            self.ready, self.busy_since, self.spawned_at = False, None, time.perf_counter()
+        threading.Thread(target=self._reader, args=(proc, parent_conn),
+                         name=f"infer-worker-{self.idx}-rx", daemon=True).start()
+        print(f"[WORKER] #{self.idx} started pid={proc.pid} device={self.device}")
+
+    def submit(self, job_id: int, frame: np.ndarray, params: dict, rgb: bool) -> Future:
+        fut: Future = Future()
+        frame = np.ascontiguousarray(frame)
+        with self.lock:
+            if not self.routable:
+                raise WorkerCrashed(f"worker #{self.idx} is down")
+            slot = None
+            if frame.dtype == np.uint8 and frame.nbytes <= self.pool.slot_bytes and self.free_slots:
+                slot = self.free_slots.pop()
+                np.ndarray(frame.shape, dtype=np.uint8, buffer=self.shm.buf,
+                           offset=slot * self.pool.slot_bytes)[...] = frame
+                inline = None
+            else:
+                inline = frame
+                self.inline += 1
+            now = time.perf_counter()
+            if not self.pending:
+                self.busy_since = now
+            self.pending[job_id] = (fut, slot, now)
+            deadline = time.time() + INFER_SCHED_LIVE_MAX_WAIT_MS / 1000.0
+            try:
+                self.conn.send((job_id, slot, frame.shape, inline, params, rgb, deadline))
+            except Exception as e:
+                self.pending.pop(job_id, None)
+                if not self.pending:
+                    self.busy_since = None
+                if slot is not None:
+                    self.free_slots.append(slot)
+                raise WorkerCrashed(f"worker #{self.idx} send failed: {e}") from e
+        return fut
+
+    def _reader(self, proc, conn) -> None:
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == "ready":
+                with self.lock:
+                    if proc is self.proc:
+                        self.pid, self.ready = msg[1], True
+                print(f"[WORKER] #{self.idx} ready pid={self.pid}")
+                continue
+            job_id, ok, payload = msg
+            with self.lock:
+                entry = self.pending.pop(job_id, None)
+                if entry is not None and entry[1] is not None:
+                    self.free_slots.append(entry[1])
+                # 下一帧从现在开始算
+                self.busy_since = time.perf_counter() if self.pending else None
+            if entry is None:
+                continue
+            fut, _, t0 = entry
+            self.jobs += 1
+            self.avg_ms = 0.8 * self.avg_ms + 0.2 * (time.perf_counter() - t0) * 1000.0
+            shed = not ok and payload == _SHED
+            if shed:
+                self.shed += 1
+            elif not ok:
+                self.errors += 1
+            # 调用方可能已取消（流退订时 wrap_future 连带取消），不能让读线程因此退出
+            if fut.done():
+                continue
+            try:
+                if ok:
+                    fut.set_result(payload)
+                elif shed:
+                    fut.set_exception(InferShed("live frame waited too long", PRIORITY_LIVE))
+                else:
+                    fut.set_exception(RuntimeError(payload))
+            except InvalidStateError:
+                pass
+        self._mark_dead(proc)
+
+    def _mark_dead(self, proc) -> None:
+        """进程退出（或被健康检查杀掉）：在途任务全部失败，槽位收回，等健康检查线程重启"""
+        with self.lock:
+            if proc is not self.proc or not self.alive:
+                return
+            self.alive = self.ready = False
+            self.busy_since = None
+            pending, self.pending = self.pending, {}
+            self.free_slots = list(range(self.pool.slots))
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        if not self.pool.closing:
+            print(f"[WORKER] #{self.idx} died (exit={proc.exitcode}), failing {len(pending)} jobs")
+        for fut, _, _ in pending.values():
+            if not fut.done():
+                try:
+                    fut.set_exception(WorkerCrashed(f"worker #{self.idx} exited"))
+                except InvalidStateError:
+                    pass
+
+    def check(self) -> None:
+        """
+        健康检查：进程没了 → 标记死亡；模型加载太久 / 当前帧算太久 → 杀掉（reader 线程随后收到 EOF）。
+        计时从 ready / 帧开始算起，排队等待和模型加载不算进 INFER_WORKER_TIMEOUT_SEC
+        """
+        proc = self.proc
+        if proc is None:
+            return
+        if self.alive and not proc.is_alive():
+            self._mark_dead(proc)
+            return
+        if not self.alive:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            ready, busy_since = self.ready, self.busy_since
+        if not ready:
+            if now - self.spawned_at > INFER_WORKER_LOAD_TIMEOUT_SEC:
+                print(f"[WORKER] #{self.idx} not ready after {INFER_WORKER_LOAD_TIMEOUT_SEC:.0f}s, killing pid={proc.pid}")
+                proc.kill()
+        elif busy_since is not None and now - busy_since > INFER_WORKER_TIMEOUT_SEC:
+            print(f"[WORKER] #{self.idx} stuck > {INFER_WORKER_TIMEOUT_SEC:.0f}s, killing pid={proc.pid}")
+            proc.kill()
+
+    def stop(self, timeout: float = 2.0) -> None:
+        proc = self.proc
+        if proc is not None:
+            try:
+                with self.lock:
+                    self.conn.send(None)
+            except Exception:
+                pass
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.kill()
+                proc.join(timeout)
+            self._mark_dead(proc)
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "idx": self.idx,
+            "pid": self.pid,
+            "alive": self.alive,
+            "ready": self.ready,
+            "device": self.device,
+            "sessions": self.sessions,
+            "inflight": self.inflight,
+            "jobs": self.jobs,
+            "errors": self.errors,
+            "shed": self.shed,
+            "inline": self.inline,
+            "restarts": self.restarts,
+            "avg_ms": round(self.avg_ms, 1),
+        }
+
+
+class InferWorkerPool:
+    """
+    submit() 线程安全，返回 concurrent.futures.Future（结果同 infer_dual_on_frame）
+    """
+
+    def __init__(self, workers: int = INFER_WORKERS, slots: int = INFER_WORKER_SLOTS):
+        self.ctx = mp.get_context("spawn")   # 子进程里要用 CUDA，不能 fork
+        self.n = max(1, int(workers))
+        self.slots = max(1, int(slots))
+        self.slot_bytes = _slot_bytes()
+        # 每个 worker 的 torch 线程数：按核数均分，避免 N 个进程各开满线程互相抢
+        self.threads = max(1, (os.cpu_count() or 1) // self.n)
+        self.workers: List[_Worker] = []
+        self.closing = False
+        self._sticky: Dict[str, _Worker] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._monitor: Optional[threading.Thread] = None
+        self.rejected = 0
+
+    def start(self) -> "InferWorkerPool":
+        with self._lock:
+            if self.workers:
+                return self
+            for i in range(self.n):
+                device = INFER_WORKER_DEVICES[i % len(INFER_WORKER_DEVICES)] if INFER_WORKER_DEVICES else None
+                w = _Worker(self, i, device)
+                w.spawn()
+                self.workers.append(w)
+            self._monitor = threading.Thread(target=self._health_loop, name="infer-worker-health", daemon=True)
+            self._monitor.start()
+        return self
+
+    # ---------- 分配 ----------
+    def _pick(self, key: Optional[str]) -> _Worker:
+        with self._lock:
+            alive = [w for w in self.workers if w.routable]
+            if not alive:
+                raise NoWorkerAvailable("no inference worker available")
+            if key is None:
+                return min(alive, key=lambda w: w.inflight)
+            w = self._sticky.get(key)
+            if w is None or not w.routable:
+                if w is not None:
+                    w.sessions -= 1
+                w = min(alive, key=lambda x: (x.sessions, x.inflight))
+                w.sessions += 1
+                self._sticky[key] = w
+            return w
+
+    def submit(self, frame: np.ndarray, params: dict = None, rgb: bool = False,
+               key: Optional[str] = None) -> Future:
+        """
+        key：会话 / 流标识，同一 key 的帧尽量落在同一个 worker 上
+        """
+        self.start()
+        if self.backlog() >= INFER_SCHED_MAX_QUEUED[PRIORITY_LIVE]:
+            self.rejected += 1
+            raise InferRejected("live worker queue is full", PRIORITY_LIVE)
+        return self._pick(key).submit(next(self._ids), frame, params or {}, rgb)
+
+    def backlog(self) -> int:
+        """
+        已提交、worker 还没开始算的帧数（每个 worker 一次只算一帧）；
+        登记给 INFER_SCHED，积压时 image / video 让路
+        """
+        return sum(max(0, w.inflight - 1) for w in self.workers if w.routable)
+
+    def release(self, key: str) -> None:
+        """流结束时调用，释放它在 worker 上的占位"""
+        with self._lock:
+            w = self._sticky.pop(key, None)
+            if w is not None:
+                w.sessions -= 1
+
+    # ---------- 健康检查 / 重启 ----------
+    def _health_loop(self) -> None:
+        while not self.closing:
+            time.sleep(INFER_WORKER_HEALTH_SEC)
+            for w in list(self.workers):
+                if self.closing:
+                    break
+                w.check()
+                if not w.alive and not self.closing:
+                    w.restarts += 1
+                    try:
+                        w.spawn()
+                    except Exception as e:
+                        print(f"[WORKER] #{w.idx} restart failed:", e)
+
+    def close(self) -> None:
+        self.closing = True
+        for w in self.workers:
+            w.stop()
+
+    def stats(self) -> dict:
+        return {
+            "workers": [w.stats() for w in self.workers],
+            "slots": self.slots,
+            "slot_bytes": self.slot_bytes,
+            "sessions": len(self._sticky),
+            "backlog": self.backlog(),
+            "rejected": self.rejected,
+        }
+
+
+_POOL: Optional[InferWorkerPool] = None
+
+
+def get_worker_pool() -> InferWorkerPool:
+    global _POOL
+    if _POOL is None:
+        _POOL = InferWorkerPool()
+    return _POOL
+
+
+def shutdown_worker_pool() -> None:
+    global _POOL
+    if _POOL is not None:
+        _POOL.close()
+        _POOL = None
@@ -0,0 +1,92 @@
+# server/motion_gate.py  —— 静止画面跳过推理
+#
+# 每帧先缩成 64x36 灰度小图，和“上一次真正推理的那一帧”比较：
+# 变化像素占比低于阈值（motion_gate）就直接复用上次的推理结果，
+# 但最多连续复用 MOTION_REFRESH_SEC 秒，到点强制重跑一次（光线渐变、积水缓慢上涨）。
+# 推理相关参数变了、或这次需要掩膜而上次结果没带掩膜时，也一律重跑。
+import os
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from .pipeline_dual import has_masks
+
+# 变化像素占比阈值（0~1），0 表示关闭门控。默认关闭，需要时显式打开（例如 0.02），
+# 或由 WS 的 motion_gate 参数按连接打开
+MOTION_GATE = float(os.getenv("MOTION_GATE", "0"))
+# 强制刷新间隔（秒）
+MOTION_REFRESH_SEC = float(os.getenv("MOTION_REFRESH_SEC", "10"))
+# 单个像素灰度差超过该值才算“变化”（压掉噪点 / 码流抖动）
+MOTION_PIXEL_DIFF = int(os.getenv("MOTION_PIXEL_DIFF", "25"))
+THUMB_SIZE = (64, 36)
+
+# 会影响推理结果的参数：变了就不能复用
+_RESULT_KEYS = ("conf_water", "iou_water", "conf_risk", "iou_risk", "imgsz_water", "imgsz_risk")
+
+
+def _thumb(frame: np.ndarray, rgb: bool) -> np.ndarray:
+    small = cv2.resize(frame, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(gray, (3, 3), 0)
+
+
+class MotionGate:
+    def __init__(self):
+        self._ref: Optional[np.ndarray] = None   # 上次推理帧的小图
+        self._ref_t = 0.0
+        self._ref_sig = None
+        self._pending: Optional[np.ndarray] = None
+        self.result: Optional[dict] = None       # 上次推理结果
+        self.last_score: Optional[float] = None
+
+        # 统计
+        self.inferred = 0
+        self.skipped = 0
+
+    def check(self, frame: np.ndarray, params: dict, rgb: bool = False) -> Optional[dict]:
+        """
+        画面基本没变时返回可复用的上次结果，否则返回 None（调用方去推理，再调 update）
+        """
+        threshold = float(params.get("motion_gate", MOTION_GATE) or 0.0)
+        thumb = _thumb(frame, rgb)
+        self._pending = thumb
+
+        if threshold <= 0 or self._ref is None or self.result is None:
+            self.last_score = None
+            return None
+        if time.perf_counter() - self._ref_t >= MOTION_REFRESH_SEC:
+            self.last_score = None
+            return None
+        if self._ref_sig != tuple(params.get(k) for k in _RESULT_KEYS):
+            self.last_score = None
+            return None
+        if params.get("return_mask") and not has_masks(self.result.get("water"), params.get("mask_formats") or ("png",)):
+            self.last_score = None
+            return None
+
+        diff = cv2.absdiff(thumb, self._ref)
+        self.last_score = float(np.count_nonzero(diff > MOTION_PIXEL_DIFF)) / diff.size
+        if self.last_score >= threshold:
+            return None
+
+        self.skipped += 1
+        return self.result
+
+    def update(self, result: dict, params: dict) -> None:
+        """推理完成后记下参考帧和结果"""
+        self._ref = self._pending
+        self._ref_t = time.perf_counter()
+        self._ref_sig = tuple(params.get(k) for k in _RESULT_KEYS)
+        self.result = result
+        self.inferred += 1
+
+    def stats(self) -> dict:
+        total = self.inferred + self.skipped
+        return {
+            "inferred": self.inferred,
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skipped / total, 3) if total else 0.0,
+            "last_score": None if self.last_score is None else round(self.last_score, 4),
+        }
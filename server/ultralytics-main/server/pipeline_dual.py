@@ -1,6 +1,7 @@
 # server/pipeline_dual.py
 from typing import Dict, Any, Optional, Tuple
-import os, cv2, numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import os, threading, cv2, numpy as np
 from ultralytics import YOLO
 from .infer import _results_to_objects  # 复用你已有的统一结果转换函数
 import base64
@@ -12,6 +13,20 @@ _WATER_MODEL: Optional[YOLO] = None
 _RISK_MODEL: Optional[YOLO] = None
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# 并行模式：积水 / 风险两个模型同时跑（GPU 上各用一条 CUDA stream，CPU 上各占一个线程）
+DUAL_PARALLEL = (os.getenv("DUAL_PARALLEL", "0") == "1")
+# 实时流里两个模型的默认节奏（每 N 个 tick 跑一次），WS 的 water_every / risk_every 可覆盖
+DUAL_WATER_EVERY = int(os.getenv("DUAL_WATER_EVERY", "1"))
+DUAL_RISK_EVERY = int(os.getenv("DUAL_RISK_EVERY", "1"))
+# 积水掩膜后处理：覆盖率直接在模型输出的掩膜上算，多边形 / PNG 在长边为
+# WATER_MASK_WORK 的工作分辨率上提取，不再栅格化回原图尺寸。
+# WATER_RETINA_MASKS 默认开（与原来一致，掩膜为原图分辨率）；设为 0 时用模型输出的低分辨率掩膜，
+# 后处理更快，但覆盖率 / 边缘精度会有小幅偏差（长边 640 时通常在 0.5 个百分点以内）
+WATER_MASK_WORK = int(os.getenv("WATER_MASK_WORK", "640"))
+WATER_RETINA_MASKS = (os.getenv("WATER_RETINA_MASKS", "1") == "1")
+_PAIR_POOL: Optional[ThreadPoolExecutor] = None
+_STREAM_LOCAL = threading.local()
+
 def load_dual_models() -> Tuple[YOLO, YOLO]:
     """
     两个模型：
@@ -28,20 +43,73 @@ def load_dual_models() -> Tuple[YOLO, YOLO]:
     return _WATER_MODEL, _RISK_MODEL
 
 
-def _predict(model: YOLO, frame_bgr: np.ndarray, *, imgsz=640, conf=0.25, iou=0.45, retina_masks=True):
-    rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-    return model.predict(rgb, imgsz=imgsz, conf=conf, iou=iou, retina_masks=retina_masks, verbose=False)[0]
+def _predict_rgb(model: YOLO, source, *, imgsz=640, conf=0.25, iou=0.45, retina_masks=True):
+    """
+    source 已是 RGB（单帧或一批帧的 list），返回 Results 列表
+    """
+    return model.predict(source, imgsz=imgsz, conf=conf, iou=iou, retina_masks=retina_masks, verbose=False)
 
 
-def _water_coverage_pct(result, h: int, w: int) -> float:
-    """把分割多边形填充成二值图，计算覆盖百分比"""
-    mask = np.zeros((h, w), dtype=np.uint8)
-    polys = getattr(result, "masks", None)
-    if polys is not None and getattr(polys, "xy", None) is not None:
-        pts = [np.asarray(p, dtype=np.int32) for p in polys.xy if p is not None]
-        if pts:
-            cv2.fillPoly(mask, pts, 255)
-    return float(mask.mean() / 255.0 * 100.0)
+def _cuda_stream(model: YOLO):
+    """
+    模型在 GPU 上时，给当前线程返回一条独立的 CUDA stream；否则返回 None
+    """
+    try:
+        import torch
+        device = next(model.model.parameters()).device
+    except Exception:
+        return None
+    if device.type != "cuda":
+        return None
+    streams = getattr(_STREAM_LOCAL, "streams", None)
+    if streams is None:
+        streams = _STREAM_LOCAL.streams = {}
+    if device not in streams:
+        streams[device] = torch.cuda.Stream(device=device)
+    return streams[device]
+
+
+def _predict_on_stream(model: YOLO, source, **kw):
+    stream = _cuda_stream(model)
+    if stream is None:
+        return _predict_rgb(model, source, **kw)
+    import torch
+    with torch.cuda.stream(stream):
+        res = _predict_rgb(model, source, **kw)
+    stream.synchronize()
+    return res
+
+
+def _pair_pool() -> ThreadPoolExecutor:
+    global _PAIR_POOL
+    if _PAIR_POOL is None:
+        _PAIR_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dual-water")
+    return _PAIR_POOL
+
+
+def predict_dual(water_m: YOLO, risk_m: YOLO, source, opts: Dict[str, Any]):
+    """
+    source 为已转好 RGB 的单帧或帧列表（两个模型共用同一份预处理输入），
+    返回 (water_results, risk_results)。
+    opts["parallel"] 为真时积水模型丢到旁路线程、风险模型在当前线程，两者并行。
+    opts["run_water"] / opts["run_risk"] 为假时跳过该模型，对应结果为 [None, ...]。
+    """
+    water_kw = dict(imgsz=opts["imgsz_water"], conf=opts["conf_water"], retina_masks=WATER_RETINA_MASKS)
+    risk_kw = dict(imgsz=opts["imgsz_risk"], conf=opts["conf_risk"], retina_masks=False)
+
+    run_water, run_risk = opts.get("run_water", True), opts.get("run_risk", True)
+    if not (run_water and run_risk):
+        n = len(source) if isinstance(source, list) else 1
+        res_water = _predict_rgb(water_m, source, **water_kw) if run_water else [None] * n
+        res_risk = _predict_rgb(risk_m, source, **risk_kw) if run_risk else [None] * n
+        return res_water, res_risk
+
+    if not opts.get("parallel"):
+        return _predict_rgb(water_m, source, **water_kw), _predict_rgb(risk_m, source, **risk_kw)
+
+    fut_water = _pair_pool().submit(_predict_on_stream, water_m, source, **water_kw)
+    res_risk = _predict_on_stream(risk_m, source, **risk_kw)
+    return fut_water.result(), res_risk
 
 
 def _risk_level_from_result(result) -> Tuple[int, Dict[str, Any]]:
@@ -130,13 +198,11 @@ def _risk_level_from_result(result) -> Tuple[int, Dict[str, Any]]:
 def mask_to_polygons(mask_bin: "np.ndarray", *, min_area_px: int = 64, epsilon_px: float = 2.0):
     """
     mask_bin: 二值(0/255)或(0/1)的 HxW 掩膜
-    min_area_px: 过滤小碎片
-    epsilon_px: 多边形简化强度（像素单位）
+    min_area_px: 过滤小碎片（mask_bin 的像素单位）
+    epsilon_px: 多边形简化强度（mask_bin 的像素单位）
     return: [{ "outer": [[x,y],...], "holes": [ [[x,y],...], ... ] }, ...]  均为归一化坐标
     """
-    import cv2, numpy as np
-
-    m = (mask_bin > 0).astype("uint8")
+    m = mask_bin if mask_bin.dtype == np.uint8 else (mask_bin > 0).astype(np.uint8)
     h, w = m.shape[:2]
     if h == 0 or w == 0:
         return []
@@ -146,33 +212,49 @@ def mask_to_polygons(mask_bin: "np.ndarray", *, min_area_px: int = 64, epsilon_p
         return []
     hier = hier[0]  # [next, prev, child, parent]
 
-    polys = []
-    outers = [i for i, h4 in enumerate(hier) if h4[3] == -1]  # parent == -1
+    # 一次遍历建好 parent -> children 索引（RETR_CCOMP 只有两层：外轮廓 / 洞）
+    outers = []
+    children: Dict[int, list] = {}
+    for i, (_, _, _, parent) in enumerate(hier):
+        if parent == -1:
+            outers.append(i)
+        else:
+            children.setdefault(int(parent), []).append(i)
 
+    norm = np.array([1.0 / w, 1.0 / h], dtype=np.float64)
+
+    def _ring(c):
+        return (cv2.approxPolyDP(c, epsilon_px, True).reshape(-1, 2) * norm).tolist()
+
+    polys = []
     for oi in outers:
         cnt = contours[oi]
         if cv2.contourArea(cnt) < min_area_px:
             continue
-        # 简化外轮廓
-        cnt = cv2.approxPolyDP(cnt, epsilon_px, True)
-        outer = [[float(x) / w, float(y) / h] for [[x, y]] in cnt]
-
-        # 收集该外轮廓的所有子洞
-        holes = []
-        for ci, h4 in enumerate(hier):
-            if h4[3] == oi:  # parent == oi
-                c = contours[ci]
-                if cv2.contourArea(c) < min_area_px:
-                    continue
-                c = cv2.approxPolyDP(c, epsilon_px, True)
-                hole = [[float(x) / w, float(y) / h] for [[x, y]] in c]
-                holes.append(hole)
-
-        polys.append({"outer": outer, "holes": holes})
+        holes = [
+            _ring(contours[ci])
+            for ci in children.get(oi, ())
+            if cv2.contourArea(contours[ci]) >= min_area_px
+        ]
+        polys.append({"outer": _ring(cnt), "holes": holes})
 
     return polys
 
 
+MASK_KEYS = {"png": "mask_png_b64", "raw": "mask_raw"}
+
+
+def has_masks(water: Optional[dict], formats) -> bool:
+    """water 里是否已带齐 formats 要求的所有掩膜"""
+    water = water or {}
+    return all(water.get(MASK_KEYS[f]) is not None for f in formats)
+
+
+def strip_masks(water: dict, keep: Optional[str] = None) -> dict:
+    """去掉（除 keep 以外的）掩膜字段，返回新 dict"""
+    return {k: v for k, v in water.items() if k not in MASK_KEYS.values() or k == keep}
+
+
 def encode_mask_png_b64(mask_rgba):
     # 建议先缩小后编码：例如最长边 <= 640
     import cv2, base64
@@ -186,90 +268,140 @@ def encode_mask_png_b64(mask_rgba):
     return base64.b64encode(buf).decode()
 
 
-def infer_dual_on_frame(frame_bgr: "np.ndarray", params: dict = None) -> Dict[str, Any]:
+def _dual_options(params: dict) -> Dict[str, Any]:
     """
-    单帧双模型推理（适配 WebSocket 调参）
-    params 来自 WS，可包含：
-      - conf_water / iou_water / conf_risk / imgsz_water / imgsz_risk ...
+    从 WS 参数里取出双模型推理用到的超参（否则用默认值）
     """
     params = params or {}
+    return {
+        "conf_water": float(params.get("conf_water", 0.25)),
+        "conf_risk": float(params.get("conf_risk", 0.25)),
+        "return_mask": bool(params.get("return_mask", True)),
+        # 模型输入尺寸，前端滑块可控
+        "imgsz_water": int(params.get("imgsz_water", 640) or 640),
+        "imgsz_risk": int(params.get("imgsz_risk", 640) or 640),
+        # 两个模型是否并行（WS 参数优先，其次环境变量）
+        "parallel": bool(params.get("parallel", DUAL_PARALLEL)),
+        # 本次是否跑该模型（按各自节奏跳过时由调用方沿用上次结果）
+        "run_water": bool(params.get("run_water", True)),
+        "run_risk": bool(params.get("run_risk", True)),
+        # 掩膜输出格式：png = mask_png_b64（JSON 协议），raw = mask_raw 原始 0/255 数组（二进制协议）
+        "mask_formats": tuple(params.get("mask_formats") or ("png",)),
+    }
 
-    # === 从 params 中取参数（否则用默认值） ===
-    conf_water = float(params.get("conf_water", 0.25))
-    conf_risk = float(params.get("conf_risk", 0.25))
-    return_mask = bool(params.get("return_mask", True))
 
-    # 新增：模型输入尺寸，前端滑块可控
-    imgsz_water = int(params.get("imgsz_water", 640) or 640)
-    imgsz_risk = int(params.get("imgsz_risk", 640) or 640)
+def build_dual_output(res_water, res_risk, h: int, w: int, opts: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把两个模型的 Results 组装成 WS / 存库统一使用的输出结构
+    （单帧推理和批量调度共用这一段后处理）
+    某个模型本次没跑（结果为 None）时，输出里不带它那一半（pct/water 或 level/risk）
+    """
+    out: Dict[str, Any] = {}
+
+    if res_water is not None:
+        water_objs = _results_to_objects(res_water, min_conf=opts["conf_water"])
+        water_mask, pct, scale = _water_mask_and_pct(res_water, h, w)
+        # 阈值按原图像素给出，换算到工作分辨率
+        polys = mask_to_polygons(water_mask, min_area_px=64 * scale * scale, epsilon_px=2.0 * scale)
+        out["pct"] = pct
+        out["water"] = {
+            "objects": water_objs,
+            "image_h": h,
+            "image_w": w,
+            "polygons": polys,
+        }
+        if opts["return_mask"]:
+            if "png" in opts["mask_formats"]:
+                out["water"]["mask_png_b64"] = encode_mask_png_b64(water_mask)
+            if "raw" in opts["mask_formats"]:
+                out["water"]["mask_raw"] = water_mask
+
+    if res_risk is not None:
+        level, risk_detail = _risk_level_from_result(res_risk)
+        out["level"] = level
+        out["risk"] = risk_detail
+
+    return out
+
+
+def infer_dual_on_frame(frame_bgr: "np.ndarray", params: dict = None, rgb: bool = False) -> Dict[str, Any]:
+    """
+    单帧双模型推理（适配 WebSocket 调参）
+    params 来自 WS，可包含：
+      - conf_water / iou_water / conf_risk / imgsz_water / imgsz_risk ...
+    rgb=True 时 frame 已是 RGB，直接送进模型（不拷贝、不转换）
+    """
+    opts = _dual_options(params)
 
     # === 加载两套模型 ===
     water_m, risk_m = load_dual_models()
 
     h, w = frame_bgr.shape[:2]
 
-    # === 积水分割 ===
-    res_water = _predict(
-        water_m, frame_bgr,
-        imgsz=imgsz_water,  # 尺寸
-        conf=conf_water,
-        retina_masks=True
-    )
-    water_objs = _results_to_objects(res_water, min_conf=conf_water)
-    water_mask, pct = _water_mask_and_pct(res_water, h, w)
-
-    # === 风险等级 ===
-    res_risk = _predict(
-        risk_m, frame_bgr,
-        imgsz=imgsz_risk,
-        conf=conf_risk,
-        retina_masks=False
-    )
-
-    level, risk_detail = _risk_level_from_result(res_risk)
-    polys = mask_to_polygons(water_mask, min_area_px=64, epsilon_px=2.0)
-
-    out = {
-        "pct": pct,
-        "level": level,
-        "water": {
-            "objects": water_objs,
-            "image_h": h,
-            "image_w": w,
-            "polygons": polys,
-        },
-        "risk": risk_detail,
-    }
+    # === 一次颜色转换，积水分割 + 风险等级共用 ===
+    frame_rgb = frame_bgr if rgb else cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+    res_water, res_risk = predict_dual(water_m, risk_m, frame_rgb, opts)
 
-    if return_mask:
-        out["water"]["mask_png_b64"] = encode_mask_png_b64(water_mask)
+    return build_dual_output(res_water[0], res_risk[0], h, w, opts)
 
-    return out
+
+def _work_size(h: int, w: int) -> Tuple[int, int, float]:
+    """工作分辨率 (wh, ww, scale)：长边不超过 WATER_MASK_WORK，不放大"""
+    scale = min(1.0, float(WATER_MASK_WORK) / max(h, w)) if WATER_MASK_WORK > 0 else 1.0
+    return max(1, int(round(h * scale))), max(1, int(round(w * scale))), scale
+
+
+def _union_mask_lowres(result, h: int, w: int) -> Optional[np.ndarray]:
+    """
+    所有实例掩膜取并集（在模型输出的分辨率上、在 GPU 上做完再拷回来），
+    并裁掉 letterbox 补边，得到和原图同宽高比的 0/1 掩膜；没有 masks.data 时返回 None
+    """
+    masks = getattr(result, "masks", None)
+    data = getattr(masks, "data", None) if masks is not None else None
+    if data is None or len(data) == 0:
+        return None
+    union = data.amax(0) if hasattr(data, "amax") else np.asarray(data).max(0)
+    union = union.cpu().numpy() if hasattr(union, "cpu") else np.asarray(union)
+    union = (union > 0.5).astype(np.uint8)
+
+    mh, mw = union.shape[:2]
+    if (mh, mw) != (h, w):
+        # 与 ultralytics scale_masks 相同的补边计算（居中 letterbox）
+        gain = min(mh / h, mw / w)
+        ch, cw = int(round(h * gain)), int(round(w * gain))
+        top = max(0, int(round((mh - ch) / 2 - 0.1)))
+        left = max(0, int(round((mw - cw) / 2 - 0.1)))
+        union = union[top:top + ch, left:left + cw]
+    return union
 
 
 def _water_mask_and_pct(result, h: int, w: int):
-    """把分割结果栅格化到原图尺寸，得到 0/255 的二值掩膜和覆盖百分比"""
-    import numpy as np, cv2
-    mask = np.zeros((h, w), dtype=np.uint8)
-    polys = getattr(result, "masks", None)
-
-    # 1) 优先用多边形
-    if polys is not None and getattr(polys, "xy", None) is not None:
-        pts = [np.asarray(p, dtype=np.int32) for p in polys.xy if p is not None]
+    """
+    一次得到：覆盖百分比 + 工作分辨率下 0/255 的二值掩膜 + 工作分辨率相对原图的缩放比
+    - 覆盖率：低分辨率掩膜上每个像素对应原图面积相同，直接取均值
+    - 掩膜：低分辨率掩膜缩放到工作分辨率（多边形 / PNG 都用它）
+    """
+    wh, ww, scale = _work_size(h, w)
+    union = _union_mask_lowres(result, h, w)
+
+    if union is not None and union.size:
+        pct = float(np.count_nonzero(union)) / union.size * 100.0
+        if union.shape[:2] == (wh, ww):
+            mask = union * np.uint8(255)
+        else:
+            upscale = ww > union.shape[1]
+            interp = cv2.INTER_LINEAR if upscale else cv2.INTER_AREA
+            mask = cv2.resize(union * np.uint8(255), (ww, wh), interpolation=interp)
+            # 双线性放大后重新二值化，边缘比最近邻平滑
+            cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY, dst=mask)
+        return mask, pct, scale
+
+    # 没有 data 时退化用 masks.xy（原图坐标）直接在工作分辨率上填充
+    mask = np.zeros((wh, ww), dtype=np.uint8)
+    masks = getattr(result, "masks", None)
+    if masks is not None and getattr(masks, "xy", None) is not None:
+        pts = [np.asarray(np.asarray(p) * scale, dtype=np.int32) for p in masks.xy if p is not None and len(p)]
         if pts:
             cv2.fillPoly(mask, pts, 255)
-
-    # 2) 若没有 xy，退化用 data（需 resize 回原图）
-    elif polys is not None and getattr(polys, "data", None) is not None:
-        m = polys.data
-        try:
-            m = m.cpu().numpy()  # (N, Hm, Wm)
-            m = (m.max(axis=0) > 0.5).astype("uint8") * 255
-            if m.shape[:2] != (h, w):
-                m = cv2.resize(m, (w, h), interpolation=cv2.INTER_NEAREST)
-            mask = m
-        except Exception:
-            pass
-
-    pct = float(mask.mean() / 255.0 * 100.0)
-    return mask, pct
+    pct = float(np.count_nonzero(mask)) / mask.size * 100.0
+    return mask, pct, scale
@@ -1,22 +1,10 @@
 # server/routes_cameras.py----地图上的监控摄像头
 from fastapi import APIRouter
-import pymysql
+from .database import get_conn
 
 router = APIRouter(prefix="/api/cameras", tags=["cameras"])
 
 
-def get_conn():
-    return pymysql.connect(
-        host="localhost",
-        port=3306,
-        user="root",
-        password="123456",
-        database="city_flood_monitor",
-        charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor
-    )
-
-
 @router.get("/")
 def list_cameras():
     conn = get_conn()
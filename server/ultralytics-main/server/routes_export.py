@@ -1,18 +1,17 @@
 # server/routes_export.py
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import Any, Dict, List, Optional
 from io import BytesIO
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import quote
 from docx import Document
 from docx.opc.exceptions import PackageNotFoundError
-from starlette.responses import FileResponse
 
-from .database import get_conn
-from .utils.export_video import export_video_with_ticks
+from .export_jobs import EXPORT_JOBS, EXPORT_SYNC_WAIT, ExportError
+from .utils.range_file import range_file_response
 
 router = APIRouter(tags=["export"])
 
@@ -150,51 +149,86 @@ async def export_word(req: ExportRequest):
 
 
 # 导出视频
-# ====== 导出带掩膜的视频 ======
+# ====== 导出带掩膜的视频（后台任务 + 缓存） ======
 
-BASE_DIR = Path(__file__).resolve().parent
-RECORD_DIR = BASE_DIR / "records"
-EXPORT_DIR = BASE_DIR / "exports"
-EXPORT_DIR.mkdir(exist_ok=True)
+class ExportVideoRequest(BaseModel):
+    options: Dict[str, Any] = {}
 
-@router.get("/api/history/{session_id}/exportVideo")
-def export_history_video(session_id: int):
+
+def _submit_export(session_id: int, options: Optional[dict] = None):
+    try:
+        return EXPORT_JOBS.submit(session_id, options)
+    except ExportError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+@router.post("/api/history/{session_id}/exportVideo/jobs")
+def create_export_job(session_id: int, req: Optional[ExportVideoRequest] = None):
     """
-    1. 从 detect_session 里查出视频相对路径
-    2. 用 export_video_with_ticks 生成带掩膜的视频
-    3. 返回 mp4 文件
+    提交导出任务，立即返回 job（命中缓存时 status 直接是 done）
     """
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            sql = """
-                SELECT record_path, camera_name
-                FROM detect_session
-                WHERE id = %s
-            """
-            cur.execute(sql, (session_id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="session not found")
-    finally:
-        conn.close()
-
-    rel_path = row["record_path"]
-    src_path = RECORD_DIR / rel_path
-    if not src_path.exists():
-        raise HTTPException(status_code=404, detail="源视频不存在")
-
-    out_path = EXPORT_DIR / (src_path.stem + "_mask.mp4")
-
-    # 没生成过就生成一次，生成过就直接返回
-    if not out_path.exists():
-        try:
-            export_video_with_ticks(session_id, str(src_path), str(out_path))
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"导出失败: {e}")
-
-    return FileResponse(
-        path=out_path,
-        media_type="video/mp4",
-        filename=out_path.name,
+    job = _submit_export(session_id, req.options if req else None)
+    return job.to_dict()
+
+
+@router.get("/api/export/jobs/{job_id}")
+def get_export_job(job_id: str):
+    """
+    查询导出进度：status = queued / running / done / error，progress = 0~1
+    """
+    job = EXPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+
+def _pending_response(job):
+    """任务还没结束：202 + job，客户端轮询 Location"""
+    return JSONResponse(
+        job.to_dict(),
+        status_code=202,
+        headers={"Location": f"/api/export/jobs/{job.id}"},
     )
+
+
+def _serve_export(job, request: Request):
+    """
+    返回 done 任务的导出文件；文件已被清理（缓存淘汰 / 手工删除）时按原选项重新提交一次，
+    EXPORT_SYNC_WAIT 秒内完成照样返回文件，否则返回 202 + 新 job
+    """
+    out_path = Path(job.out_path)
+    if not out_path.exists():
+        job = EXPORT_JOBS.wait(_submit_export(job.session_id, job.options), timeout=EXPORT_SYNC_WAIT)
+        if job.status in ("queued", "running"):
+            return _pending_response(job)
+        if job.status != "done":
+            raise HTTPException(status_code=500, detail=f"导出失败: {job.error}")
+        out_path = Path(job.out_path)
+    return range_file_response(out_path, request, media_type="video/mp4", filename=out_path.name)
+
+
+@router.get("/api/export/jobs/{job_id}/file")
+def download_export_job(job_id: str, request: Request):
+    """
+    下载 / 在线播放导出结果（支持 Range，可拖动进度条）
+    """
+    job = EXPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"job not finished: {job.status}")
+    return _serve_export(job, request)
+
+
+@router.get("/api/history/{session_id}/exportVideo")
+def export_history_video(session_id: int, request: Request):
+    """
+    兼容旧接口：提交（或复用缓存的）导出任务，EXPORT_SYNC_WAIT 秒内完成就直接返回 mp4 文件；
+    否则返回 202 + job，客户端改为轮询 /api/export/jobs/{job_id}，完成后取 /file
+    """
+    job = EXPORT_JOBS.wait(_submit_export(session_id), timeout=EXPORT_SYNC_WAIT)
+    if job.status in ("queued", "running"):
+        return _pending_response(job)
+    if job.status != "done":
+        raise HTTPException(status_code=500, detail=f"导出失败: {job.error}")
+    return _serve_export(job, request)
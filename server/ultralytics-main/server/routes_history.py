@@ -1,28 +1,76 @@
 # server/routes_history.py  —— 历史视频查看（MySQL detect_session）
 
 from fastapi import APIRouter, Query, Request, HTTPException
+from fastapi.responses import StreamingResponse
 from typing import Optional
 from datetime import datetime, timedelta
-from .db_detect import list_detect_sessions, delete_detect_session, list_detect_ticks
+from decimal import Decimal
+import json
+from .db_detect import (
+    list_detect_sessions,
+    delete_detect_session,
+    list_detect_ticks,
+    list_detect_ticks_page,
+    iter_detect_ticks,
+    downsample_detect_ticks,
+)
+from .tick_writer import TICK_WRITER
+from .db_rollup import query_trends, rebuild_session_rollups, GRANULARITIES
+from .database import POOL, run_db
+from .utils.geom_codec import to_json_text
 
 router = APIRouter(prefix="/api/detect", tags=["detect"])
 
 
+_DATE_FMT = "%Y-%m-%d"
+
+
 def _parse_datetime(s: Optional[str]) -> Optional[datetime]:
     """
     支持几种常见格式：
     - YYYY-MM-DD
     - YYYY-MM-DDTHH:MM
     - YYYY-MM-DD HH:MM:SS
+    都解析不了时返回 400，而不是悄悄当成“不限”
     """
     if not s:
         return None
-    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S"):
+    for fmt in (_DATE_FMT, "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S"):
         try:
             return datetime.strptime(s, fmt)
         except ValueError:
             continue
-    return None
+    raise HTTPException(
+        status_code=400,
+        detail=f"无法解析的时间: {s!r}，支持 YYYY-MM-DD / YYYY-MM-DDTHH:MM / YYYY-MM-DD HH:MM:SS",
+    )
+
+
+def _is_date_only(s: Optional[str]) -> bool:
+    try:
+        datetime.strptime(s or "", _DATE_FMT)
+        return True
+    except ValueError:
+        return False
+
+
+def _parse_range(start: Optional[str], end: Optional[str], same_day: bool = False):
+    """
+    解析 [start, end) 查询区间，/sessions 和 /trends 共用同一套口径：
+    - end 只写日期（YYYY-MM-DD）时包含那一整天，换成次日 00:00；带时分的 end 原样作为上界（不含）
+    - same_day：只传了一边时，另一边补成同一天（/sessions 的老行为）；否则那一边不限
+    """
+    start_dt = _parse_datetime(start)
+    end_dt = _parse_datetime(end)
+    if end_dt is not None and _is_date_only(end):
+        end_dt += timedelta(days=1)
+
+    if same_day:
+        if start_dt is not None and end_dt is None:
+            end_dt = datetime.combine(start_dt.date(), datetime.min.time()) + timedelta(days=1)
+        elif end_dt is not None and start_dt is None:
+            start_dt = datetime.combine((end_dt - timedelta(microseconds=1)).date(), datetime.min.time())
+    return start_dt, end_dt
 
 
 # 查询历史数据接口
@@ -34,22 +82,12 @@ async def api_list_sessions(
         limit: int = Query(100, ge=1, le=500),
         request: Request = None,
 ):
-    # 1. 解析时间
-    start_dt = _parse_datetime(start)
-    end_dt = _parse_datetime(end)
-
-    # 只传了一边的情况，给个兜底：另一边补成同一天
-    if start_dt and not end_dt:
-        end_dt = start_dt
-    elif end_dt and not start_dt:
-        start_dt = end_dt
-
-    # 如果都有，则把 end 扩展到“结束那天的次日 00:00”，方便包含整天
-    if start_dt and end_dt:
-        end_dt = end_dt + timedelta(days=1)
+    # 1. 解析时间：end 只写日期时包含整天；只传了一边时另一边补成同一天
+    start_dt, end_dt = _parse_range(start, end, same_day=True)
 
     # 2. 调用 MySQL 查询（不传 start/end 时，就是查全部，按 limit 限制条数）
-    rows = list_detect_sessions(
+    rows = await run_db(
+        list_detect_sessions,
         camera_id=camera_id,
         start=start_dt,
         end=end_dt,
@@ -120,7 +158,7 @@ async def api_delete_session(session_id: int):
     删除一条 detect_session 历史记录（以及对应的 detect_tick 记录）
     URL: DELETE /api/detect/sessions/{session_id}
     """
-    ok = delete_detect_session(session_id)
+    ok = await run_db(delete_detect_session, session_id)
     if not ok:
         # 没有这条记录
         raise HTTPException(status_code=404, detail="detect_session not found")
@@ -128,11 +166,30 @@ async def api_delete_session(session_id: int):
     return {"success": True, "id": session_id}
 
 
+def _tick_item(row, geom: str = "json") -> dict:
+    item = dict(row)
+    if geom != "raw" and "water_polys" in item:
+        # 紧凑编码的行转回 JSON 文本，旧前端照常 JSON.parse
+        item["water_polys"] = to_json_text(item.get("water_polys"), "polys")
+        item["risk_boxes"] = to_json_text(item.get("risk_boxes"), "boxes")
+    return item
+
+
+def _json_default(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, datetime):
+        return v.isoformat(timespec="seconds")
+    return str(v)
+
+
 # 查询 detect_tick
 @router.get("/ticks")
 async def api_list_ticks(
         session_id: int = Query(..., description="detect_session.id"),
-        limit: int = Query(0, ge=0, le=20000, description="最多返回多少条记录，0 表示不限制")
+        limit: int = Query(0, ge=0, le=20000, description="最多返回多少条记录，0 表示不限制"),
+        geom: str = Query("json", description="json：几何字段统一转成 JSON 文本；raw：按库里存的原样返回（可能是 q16 紧凑编码）"),
+        resolution: int = Query(0, ge=0, le=5000, description="大于 0 时按时间均分成 N 个桶降采样，只返回统计值不带多边形"),
 ):
     """
     查询某个 session 对应的 detect_tick 时序数据。
@@ -149,17 +206,127 @@ async def api_list_ticks(
       - risk_level
       - mask_h
       - mask_w
-      - water_polys   (TEXT: JSON 字符串，前端自己 JSON.parse)
-      - risk_boxes    (TEXT: JSON 字符串，前端自己 JSON.parse)
+      - water_polys   (TEXT: JSON 字符串，前端自己 JSON.parse；geom=raw 时可能是 "q16:..." 紧凑编码)
+      - risk_boxes    (TEXT: 同上)
     """
+    # 降采样：历史曲线一次拿到整段 session 的走势
+    if resolution:
+        series = await run_db(downsample_detect_ticks, session_id, resolution)
+        return {**series, "count": len(series["items"])}
+
     # 调用 db_detect 的查询函数
-    rows = list_detect_ticks(session_id=session_id, limit=(limit or None))
+    rows = await run_db(list_detect_ticks, session_id=session_id, limit=(limit or None))
 
     # 统一包装成 { items: [...] } 结构，跟 /sessions 风格一致
-    items = [dict(r) for r in rows]
+    items = [_tick_item(r, geom) for r in rows]
 
     return {
         "items": items,
         "count": len(items),
     }
 
+
+# detect_tick 键集分页
+@router.get("/ticks/page")
+async def api_list_ticks_page(
+        session_id: int = Query(..., description="detect_session.id"),
+        after_id: Optional[int] = Query(None, description="上一页最后一条的 id（即上一页返回的 next.after_id）"),
+        limit: int = Query(1000, ge=1, le=5000),
+        geom: str = Query("json", description="json / raw / none（none 不返回多边形和风险框）"),
+):
+    """
+    按 (video_sec, id) 键集分页，返回 next 游标；next 为 null 表示已到末尾。
+    游标只看 after_id（旧客户端多带的 after_sec 会被忽略）。
+
+    前端调用：
+      GET /api/detect/ticks/page?session_id=123
+      GET /api/detect/ticks/page?session_id=123&after_id=4567
+    """
+    rows = await run_db(
+        list_detect_ticks_page,
+        session_id, after_id, limit, geom != "none",
+    )
+    items = [_tick_item(r, geom) for r in rows]
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = {"after_id": last["id"]}
+
+    return {"items": items, "count": len(items), "next": next_cursor}
+
+
+# detect_tick NDJSON 流式返回
+@router.get("/ticks/stream")
+def api_stream_ticks(
+        session_id: int = Query(..., description="detect_session.id"),
+        geom: str = Query("json", description="json / raw / none（none 不返回多边形和风险框）"),
+):
+    """
+    整个 session 的 tick 按行输出（application/x-ndjson，每行一个 JSON 对象），
+    服务端逐页查库逐行写出，内存占用与 session 长度无关。
+    """
+    def gen():
+        for r in iter_detect_ticks(session_id, with_geom=(geom != "none")):
+            yield json.dumps(_tick_item(r, geom), ensure_ascii=False, default=_json_default) + "\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
+# 分钟 / 小时级趋势（预聚合）
+@router.get("/trends")
+async def api_trends(
+        granularity: str = Query("minute", description="minute / hour"),
+        camera_id: Optional[str] = Query(None),
+        session_id: Optional[int] = Query(None),
+        start: Optional[str] = Query(None, description="开始时间，例如 2025-11-18 或 2025-11-18T08:00"),
+        end: Optional[str] = Query(None, description="结束时间（不含）；只写日期时包含那一整天"),
+        limit: int = Query(5000, ge=1, le=50000),
+):
+    """
+    从 detect_rollup 读时间范围内的积水 / 风险趋势，不扫 detect_tick。
+
+    前端调用：
+      GET /api/detect/trends?camera_id=cam_1&granularity=hour&start=2025-11-18&end=2025-11-20
+    """
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity 只能是 {'/'.join(GRANULARITIES)}")
+    start_dt, end_dt = _parse_range(start, end)
+
+    items = await run_db(
+        query_trends,
+        granularity=granularity,
+        camera_id=camera_id,
+        session_id=session_id,
+        start=start_dt,
+        end=end_dt,
+        limit=limit,
+    )
+    return {"items": items, "count": len(items), "granularity": granularity}
+
+
+# 重算某个 session 的预聚合（回填历史数据）
+@router.post("/rollups/{session_id}/rebuild")
+async def api_rebuild_rollups(session_id: int):
+    rows = await run_db(rebuild_session_rollups, session_id)
+    return {"success": True, "id": session_id, "rows": rows}
+
+
+# detect_tick 写库线程状态
+@router.get("/writer")
+async def api_tick_writer_stats():
+    """
+    后台批量写库的积压 / 丢弃 / 刷盘统计
+    URL: GET /api/detect/writer
+    """
+    return TICK_WRITER.stats()
+
+
+# 连接池状态
+@router.get("/db")
+async def api_db_health():
+    """
+    连接池健康检查（SELECT 1）+ 池统计
+    URL: GET /api/detect/db
+    """
+    return await run_db(POOL.health)
@@ -1,11 +1,28 @@
 # server/routes_infer.py，REST 推理接口
-from fastapi import APIRouter, UploadFile, File, Form
-from fastapi.responses import JSONResponse
-from typing import Optional
-import os, tempfile, shutil
+from fastapi import APIRouter, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Callable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio, io, json, os, zipfile
+from pathlib import Path
 import cv2, numpy as np
-from anyio import to_thread
-from .infer import load_model, infer_image, infer_video, _MODEL_NAME
+from .infer import (
+    load_model, infer_image, infer_images, infer_frames, VideoFrameSampler, IMAGE_BATCH, VIDEO_BATCH, _MODEL_NAME
+)
+from .infer_sched import INFER_SCHED, PRIORITY_IMAGE, PRIORITY_VIDEO, InferRejected
+from .utils.upload_spool import (
+    MAX_IMAGE_BYTES,
+    MAX_IMAGES_COUNT,
+    MAX_VIDEO_BYTES,
+    UploadTooLarge,
+    abort_fifo,
+    is_progressive,
+    remove_quietly,
+    spool_path,
+    spool_stream,
+    spool_upload,
+    upload_view,
+)
 
 router = APIRouter(
     prefix="/api",  # 所有接口统一加 /api
@@ -29,56 +46,439 @@ def health():
     return {"ok": True}
 
 
+def _client_key(request: Request) -> str:
+    """调度器里的“会话”：按来源地址做公平轮转"""
+    return request.client.host if request.client else "-"
+
+
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+
+def _stream_format(stream: Optional[str], request: Request) -> Optional[str]:
+    """表单 stream 参数优先，其次看 Accept 头；None = 一次性返回整段 JSON"""
+    if stream:
+        stream = stream.strip().lower()
+        return stream if stream in STREAM_MEDIA_TYPES else None
+    accept = request.headers.get("accept", "")
+    for fmt, media_type in STREAM_MEDIA_TYPES.items():
+        if media_type in accept:
+            return fmt
+    return None
+
+
+def _encode_event(event: dict, fmt: str) -> str:
+    data = json.dumps(event, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+async def _infer_video_batch(batch, min_conf: float, key: str, retry: bool) -> list:
+    """一批抽出的帧 → [{"frame_idx", "t_ms", "objects"}, ...]"""
+    if not batch:
+        return []
+    frames = [f for _, _, f in batch]
+    while True:
+        try:
+            objs = await INFER_SCHED.run(PRIORITY_VIDEO, key, infer_frames, frames, min_conf)
+            break
+        except InferRejected as e:
+            if not retry:
+                raise
+            await asyncio.sleep(e.retry_after)
+    return [{"frame_idx": idx, "t_ms": t_ms, "objects": o} for (idx, t_ms, _), o in zip(batch, objs)]
+
+
+def _busy(e: InferRejected) -> JSONResponse:
+    return JSONResponse(
+        {"error": "busy", "msg": str(e), "priority": e.priority},
+        status_code=e.status_code,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def _decode_image(view: memoryview) -> Optional[np.ndarray]:
+    if not len(view):
+        return None
+    return cv2.imdecode(np.frombuffer(view, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _too_large(e: UploadTooLarge) -> JSONResponse:
+    return JSONResponse({"error": "upload too large", "msg": str(e)}, status_code=e.status_code)
+
+
 @router.post("/infer/image")
 async def api_infer_image(
+        request: Request,
         file: UploadFile = File(...),
         min_conf: float = Form(0.25)
 ):
-    # 读入为 numpy（BGR）
-    data = await file.read()
-    img_array = np.frombuffer(data, dtype=np.uint8)
-    img_bgr = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+    # 读入为 numpy（BGR）：直接从上传缓存解码，不再整份读进内存；解码放到线程里
+    loop = asyncio.get_running_loop()
+    try:
+        with upload_view(file, MAX_IMAGE_BYTES) as view:
+            img_bgr = await loop.run_in_executor(None, _decode_image, view)
+    except UploadTooLarge as e:
+        return _too_large(e)
     if img_bgr is None:
         return JSONResponse({"error": "bad image"}, status_code=400)
 
-    # 丢到线程池，避免阻塞事件循环
-    result = await to_thread.run_sync(infer_image, img_bgr, min_conf)
+    # 交给推理调度器（image 优先级，排在实时监控之后），避免阻塞事件循环
+    try:
+        result = await INFER_SCHED.run(PRIORITY_IMAGE, _client_key(request), infer_image, img_bgr, min_conf)
+    except InferRejected as e:
+        return _busy(e)
     return result
 
 
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+# 批量图片的解码线程（cv2.imdecode 会释放 GIL，多线程能并行）
+IMAGE_DECODE_THREADS = int(os.getenv("INFER_IMAGE_DECODE_THREADS", "4"))
+_DECODE_POOL = ThreadPoolExecutor(max_workers=max(1, IMAGE_DECODE_THREADS), thread_name_prefix="image-decode")
+
+# (文件名, 解码函数)；解码函数在线程里跑，返回 (BGR 图 或 None, 错误信息 或 None)
+ImageSource = Tuple[str, Callable[[], Tuple[Optional[np.ndarray], Optional[str]]]]
+
+
+def _detach_upload(upload: UploadFile):
+    """
+    取走 UploadFile 底下的缓存文件，换一个空的占位：
+    流式返回时框架会在处理函数返回后关闭上传文件，而图片要在响应体里才解码
+    """
+    f = upload.file
+    upload.file = io.BytesIO()
+    return f
+
+
+def _load_upload(f) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    try:
+        with upload_view(f, MAX_IMAGE_BYTES) as view:
+            img = _decode_image(view)
+    except UploadTooLarge as e:
+        return None, str(e)
+    return img, None if img is not None else "bad image"
+
+
+def _load_zip_entry(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    # 按解压后大小判断，防止压缩炸弹
+    if info.file_size > MAX_IMAGE_BYTES:
+        return None, str(UploadTooLarge(MAX_IMAGE_BYTES))
+    try:
+        data = zf.read(info)
+    except (zipfile.BadZipFile, RuntimeError, ValueError, OSError) as e:
+        # RuntimeError：加密条目；ValueError：zip 已关闭（请求提前结束）
+        return None, str(e)
+    img = _decode_image(memoryview(data))
+    return img, None if img is not None else "bad image"
+
+
+def _zip_sources(zf: zipfile.ZipFile) -> List[ImageSource]:
+    sources = []
+    for info in zf.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+            continue
+        if os.path.splitext(name)[1].lower() not in IMAGE_SUFFIXES:
+            continue
+        sources.append((name, lambda info=info: _load_zip_entry(zf, info)))
+    return sources
+
+
+async def _decode_images(sources: List[ImageSource]) -> list:
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(_DECODE_POOL, load) for _, load in sources))
+
+
+async def _infer_image_batch(sources: List[ImageSource], decoded: list, start: int, min_conf: float,
+                             key: str, retry: bool) -> list:
+    """一批图片 → [{"index", "name", "image_meta", "objects"} 或 {"index", "name", "error"}, ...]"""
+    ok = [i for i, (img, _) in enumerate(decoded) if img is not None]
+    results = {}
+    if ok:
+        while True:
+            try:
+                out = await INFER_SCHED.run(PRIORITY_IMAGE, key, infer_images, [decoded[i][0] for i in ok], min_conf)
+                break
+            except InferRejected as e:
+                if not retry:
+                    raise
+                await asyncio.sleep(e.retry_after)
+        results = dict(zip(ok, out))
+
+    items = []
+    for i, (name, _) in enumerate(sources):
+        item = {"index": start + i, "name": name}
+        if i in results:
+            item.update(results[i])
+        else:
+            item["error"] = decoded[i][1] or "bad image"
+        items.append(item)
+    return items
+
+
+@router.post("/infer/images")
+async def api_infer_images(
+        request: Request,
+        files: List[UploadFile] = File(...),
+        min_conf: float = Form(0.25),
+        stream: Optional[str] = Form(None),
+):
+    """
+    一次上传多张图片（多个 files 字段），或者 zip 压缩包（.zip 文件，里面的图片逐张处理，可与散图混传）。
+    多线程并行解码，按 INFER_IMAGE_BATCH 张一批推理，解码下一批与推理当前批重叠进行。
+    单张的结果与 /infer/image 相同，另带 index（上传 / 压缩包内顺序）和 name；解不开的图只给 error，不影响其它图。
+    stream=ndjson / sse（或 Accept 头）时逐张推送：
+      {"type": "meta", "count"} → {"type": "image", ...} ... → {"type": "done", "images", "failed"}
+    不带 stream 时返回 {"count", "images": [...]}。
+    """
+    fmt = _stream_format(stream, request)
+    owned = []      # 取下来的上传缓存 / 打开的 zip，响应结束后关闭
+    handed_off = False
+    next_decode: Optional[asyncio.Future] = None
+
+    async def close_all():
+        # 等正在跑的那批解码结束再关文件（线程里还可能在读）
+        if next_decode is not None:
+            await asyncio.gather(next_decode, return_exceptions=True)
+        for f in reversed(owned):
+            try:
+                f.close()
+            except Exception as e:
+                print("[INFER] close upload error:", e)
+
+    try:
+        sources: List[ImageSource] = []
+        for upload in files:
+            f = _detach_upload(upload)
+            owned.append(f)
+            name = upload.filename or f"image_{len(sources)}"
+            if os.path.splitext(name)[1].lower() == ".zip":
+                try:
+                    zf = zipfile.ZipFile(f)
+                except zipfile.BadZipFile:
+                    return JSONResponse({"error": "bad zip", "name": name}, status_code=400)
+                owned.append(zf)
+                sources.extend(_zip_sources(zf))
+            else:
+                sources.append((name, lambda f=f: _load_upload(f)))
+            if len(sources) > MAX_IMAGES_COUNT:
+                return JSONResponse({"error": "too many images", "limit": MAX_IMAGES_COUNT}, status_code=413)
+        if not sources:
+            return JSONResponse({"error": "no images"}, status_code=400)
+
+        key = _client_key(request)
+        batches = [sources[i:i + IMAGE_BATCH] for i in range(0, len(sources), IMAGE_BATCH)]
+
+        # 第一批同步算完再决定响应：调度器满时还能直接回 503
+        decoded = await _decode_images(batches[0])
+        if len(batches) > 1:
+            next_decode = asyncio.ensure_future(_decode_images(batches[1]))
+        try:
+            first = await _infer_image_batch(batches[0], decoded, 0, min_conf, key, retry=False)
+        except InferRejected as e:
+            return _busy(e)
+
+        async def images():
+            nonlocal next_decode
+            for item in first:
+                yield item
+            for b in range(1, len(batches)):
+                decoded = await next_decode
+                # 当前批推理时，下一批已经在解码
+                next_decode = asyncio.ensure_future(_decode_images(batches[b + 1])) if b + 1 < len(batches) else None
+                # 之后的批次遇到调度器满就等一会儿再提交（响应已经开始，不能再回 503）
+                for item in await _infer_image_batch(batches[b], decoded, b * IMAGE_BATCH, min_conf, key, retry=True):
+                    yield item
+
+        if fmt is None:
+            return {"count": len(sources), "images": [item async for item in images()]}
+
+        async def body():
+            n = failed = 0
+            try:
+                yield _encode_event({"type": "meta", "count": len(sources)}, fmt)
+                async for item in images():
+                    n += 1
+                    failed += "error" in item
+                    yield _encode_event({"type": "image", **item}, fmt)
+                yield _encode_event({"type": "done", "images": n, "failed": failed}, fmt)
+            except Exception as e:
+                yield _encode_event({"type": "error", "msg": str(e), "images": n}, fmt)
+            finally:
+                await close_all()
+
+        handed_off = True
+        return StreamingResponse(
+            body(),
+            media_type=STREAM_MEDIA_TYPES[fmt],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    finally:
+        if not handed_off:
+            await close_all()
+
+
 @router.post("/infer/video")
 async def api_infer_video(
+        request: Request,
         file: Optional[UploadFile] = File(None),
         video_url: Optional[str] = Form(None),
         every_nth: int = Form(5),
         min_conf: float = Form(0.25),
+        stream: Optional[str] = Form(None),
 ):
     """
     1) 可以直接上传视频文件；
     2) 或者给一个 video_url（本机/公网可达），后端用 OpenCV 读。
+    stream=ndjson / sse（或 Accept: application/x-ndjson / text/event-stream）时边算边推：
+      {"type": "meta", "video_meta": {...}} → {"type": "frame", "frame_idx", "t_ms", "objects"} ... → {"type": "done"}
+    不带 stream 时返回与以前相同的整段 JSON。
     """
     if not file and not video_url:
         return JSONResponse(
             {"error": "need file or video_url"},
             status_code=400
         )
+    fmt = _stream_format(stream, request)
+
+    spooled = None
+    if file:
+        # 上传内容分块拷进 spool 目录（不阻塞事件循环），超限返回 413
+        suffix = os.path.splitext(file.filename or "video.mp4")[1] or ".mp4"
+        try:
+            spooled = await spool_upload(file, MAX_VIDEO_BYTES, suffix)
+        except UploadTooLarge as e:
+            return _too_large(e)
+        path = str(spooled)
+    else:
+        # 让后端能直接读这个 URL（本机/公网可达）
+        path = video_url
+
+    return await _video_response(request, path, every_nth, min_conf, fmt, spooled=spooled)
+
+
+@router.post("/infer/video/raw")
+async def api_infer_video_raw(
+        request: Request,
+        filename: str = "video.mp4",
+        every_nth: int = 5,
+        min_conf: float = 0.25,
+        stream: Optional[str] = None,
+):
+    """
+    请求体直接是视频文件本身（Content-Type: video/* 或 application/octet-stream），参数走 query。
+    ts / mkv / webm / flv 等不依赖文件尾索引的容器边收边解码：请求体写进命名管道，
+    解码线程从另一头读，第一批结果在上传结束前就能推出来；mp4 等其它容器先完整落盘再处理。
+    """
+    fmt = _stream_format(stream, request)
+    suffix = os.path.splitext(filename)[1].lower() or ".mp4"
+    path = spool_path(suffix)
+
+    if is_progressive(suffix) and hasattr(os, "mkfifo"):
+        os.mkfifo(path)
+        feeder = asyncio.create_task(spool_stream(request.stream(), path, MAX_VIDEO_BYTES))
+        return await _video_response(request, str(path), every_nth, min_conf, fmt,
+                                     spooled=path, feeder=feeder)
 
-    tmp_path = None
     try:
-        # 2) 准备本地路径
-        if file:
-            suffix = os.path.splitext(file.filename or "video.mp4")[1] or ".mp4"
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-                shutil.copyfileobj(file.file, f)
-                tmp_path = f.name
-            path = tmp_path
-        else:
-            # 让后端能直接读这个 URL（本机/公网可达）
-            path = video_url
+        await spool_stream(request.stream(), path, MAX_VIDEO_BYTES)
+    except BaseException as e:
+        remove_quietly(path)
+        if isinstance(e, UploadTooLarge):
+            return _too_large(e)
+        raise
+    return await _video_response(request, str(path), every_nth, min_conf, fmt, spooled=path)
+
+
+async def _video_response(request: Request, path: str, every_nth: int, min_conf: float, fmt: Optional[str],
+                          spooled=None, feeder: Optional[asyncio.Task] = None):
+    """
+    抽帧 + 分批推理，按 fmt 一次性返回或流式推送
+    spooled：本次请求落盘 / 建的管道文件，响应结束后删除
+    feeder ：边上传边解码时往管道里写请求体的任务
+    """
+    loop = asyncio.get_running_loop()
+    handed_off = False  # 流式返回时由响应体负责收尾
+    sampler = None
+
+    async def finish_feeder():
+        """解码结束后确认上传本身是否正常（超限 / 断开会在这里抛出）"""
+        if feeder is None:
+            return
+        try:
+            await feeder
+        except BrokenPipeError:
+            # 解码端提前关了管道（客户端断开 / 出错），上传剩余部分不再需要
+            pass
+
+    async def close_all():
+        # 先停上传写入（关掉管道写端，解码线程才能读到 EOF 退出），再停解码线程
+        if feeder is not None:
+            if not feeder.done():
+                feeder.cancel()
+            await asyncio.gather(feeder, return_exceptions=True)
+        if sampler is not None:
+            await loop.run_in_executor(None, sampler.close)
+        remove_quietly(spooled)
+
+    try:
+        # 后台线程抽帧解码，推理按批交给调度器（video 优先级：并发受限，不会挤占实时监控）
+        try:
+            sampler = await loop.run_in_executor(
+                None, lambda: VideoFrameSampler(path, every_nth, seekable=feeder is None)
+            )
+        except RuntimeError as e:
+            if feeder is not None:
+                abort_fifo(Path(path))
+            return JSONResponse({"error": str(e)}, status_code=400)
+        key = _client_key(request)
 
-        # 3) 推理（线程池）
-        result = await to_thread.run_sync(infer_video, path, every_nth, min_conf)
-        return result
+        # 第一批同步算完再决定响应：调度器满时还能直接回 503
+        try:
+            batch = await loop.run_in_executor(None, sampler.next_batch, VIDEO_BATCH)
+            first = await _infer_video_batch(batch, min_conf, key, retry=False)
+        except InferRejected as e:
+            return _busy(e)
+
+        async def frames():
+            for item in first:
+                yield item
+            while True:
+                batch = await loop.run_in_executor(None, sampler.next_batch, VIDEO_BATCH)
+                if not batch:
+                    break
+                # 之后的批次遇到调度器满就等一会儿再提交（响应已经开始，不能再回 503）
+                for item in await _infer_video_batch(batch, min_conf, key, retry=True):
+                    yield item
+            await finish_feeder()
+
+        if fmt is None:
+            try:
+                out = [{"t_ms": f["t_ms"], "objects": f["objects"]} async for f in frames()]
+            except UploadTooLarge as e:
+                return _too_large(e)
+            return {"video_meta": sampler.meta, "frames": out}
+
+        async def body():
+            n = 0
+            try:
+                yield _encode_event({"type": "meta", "video_meta": sampler.meta}, fmt)
+                async for item in frames():
+                    n += 1
+                    yield _encode_event({"type": "frame", **item}, fmt)
+                yield _encode_event({"type": "done", "frames": n}, fmt)
+            except Exception as e:
+                yield _encode_event({"type": "error", "msg": str(e), "frames": n}, fmt)
+            finally:
+                await close_all()
+
+        handed_off = True
+        return StreamingResponse(
+            body(),
+            media_type=STREAM_MEDIA_TYPES[fmt],
+            # 禁止代理缓冲，保证每帧结果及时到达
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        if not handed_off:
+            await close_all()
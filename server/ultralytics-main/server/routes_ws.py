@@ -3,39 +3,37 @@ from typing import Optional
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from pathlib import Path
-import asyncio, json, cv2, time, subprocess
-import numpy as np
-from datetime import datetime
-from .pipeline_dual import infer_dual_on_frame
+import asyncio, json, time
 from .db_detect import (
     create_detect_session,
-    save_detect_tick,
     finish_detect_session,
+    get_session_started_at,
     update_detect_session_record_path,
 
 )
+from .adaptive import INFER_LOAD
+from .stream_hub import STREAM_HUB
+from .tick_writer import TICK_WRITER
+from .database import run_db
+from .infer_dispatch import backend_stats
+from .motion_gate import MOTION_GATE
+from .pipeline_dual import DUAL_PARALLEL, DUAL_RISK_EVERY, DUAL_WATER_EVERY, MASK_KEYS, strip_masks
+from .utils.ws_codec import PROTOCOL_BIN, MaskDeltaEncoder, encode_tick, negotiate
+from .utils.ffmpeg_io import start_ffmpeg_recorder, stop_process
 
 router = APIRouter(tags=["ws"])
 
 RECORD_ROOT = Path(__file__).resolve().parent / "records"
 RECORD_ROOT.mkdir(parents=True, exist_ok=True)
 
-# HLS 转帧的目标分辨率（可以按需调整）
-HLS_WIDTH = 640
-HLS_HEIGHT = 360
-
 # 允许更新的参数白名单
 ALLOWED_KEYS = {
     "fps", "conf_water", "iou_water", "conf_risk", "iou_risk",
-    "send_mask_every", "imgsz_water", "imgsz_risk"
+    "send_mask_every", "imgsz_water", "imgsz_risk", "parallel", "motion_gate",
+    "water_every", "risk_every",
 }
 
 
-def _get(params: dict, key: str, default):
-    v = params.get(key, default)
-    return type(default)(v) if v is not None else default
-
-
 VIDEO_ROOT = Path(__file__).resolve().parent / "demo_video/videos"
 
 
@@ -76,71 +74,44 @@ async def ws_safe_send(ws: WebSocket, payload: dict) -> bool:
         return False
 
 
-def start_ffmpeg_hls(url: str, width: int, height: int) -> subprocess.Popen:
-    """
-    用 ffmpeg 拉取 HLS(m3u8)，输出 BGR24 rawvideo 到 stdout
-    ffmpeg -i <url> -f rawvideo -pix_fmt bgr24 -vf scale=WxH -
+async def ws_safe_send_bytes(ws: WebSocket, data: bytes) -> bool:
+    """同 ws_safe_send，发二进制帧"""
+    try:
+        await ws.send_bytes(data)
+        return True
+    except Exception:
+        return False
+
+
+def new_record_path(camera_id: str) -> str:
+    """records/<camera_id>/<时间>.mp4"""
+    cam_dir = RECORD_ROOT / (camera_id or "unknown")
+    cam_dir.mkdir(parents=True, exist_ok=True)
+    ts_str = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+    return str(cam_dir / f"{ts_str}.mp4")
+
+
+def start_session_recorder(camera_id: str, video_url: str, fps: Optional[float]):
     """
-    cmd = [
-        "ffmpeg",
-        "-loglevel", "error",
-        "-i", url,
-        "-an",  # 不要音频
-        "-f", "rawvideo",
-        "-pix_fmt", "bgr24",
-        "-vf", f"scale={width}:{height}",
-        "-"
-    ]
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-
-def start_ffmpeg_recorder(input_url: str, out_path: str, fps: Optional[float] = None) -> subprocess.Popen:
+    为本次会话启动一个 ffmpeg 录制进程，返回 (record_proc, record_path)；失败返回 (None, None)
     """
-    用 ffmpeg 录制一份 H.264 + AAC 的 MP4 文件
+    try:
+        record_path = new_record_path(camera_id)
 
-    示例等价命令：
-    ffmpeg -y -i <input> -r <fps?> -c:v libx264 -pix_fmt yuv420p -c:a aac -b:a 128k -movflags +faststart out.mp4
-    """
-    cmd = [
-        "ffmpeg",
-        "-loglevel", "error",
-        "-y",               # 覆盖已有文件
-        "-i", input_url,
-    ]
-
-    # 可选：根据参数控制输出帧率（和前端设置的 fps 对齐）
-    if fps and fps > 0:
-        cmd += ["-r", str(float(fps))]
-
-    cmd += [
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-pix_fmt", "yuv420p",
-        "-c:a", "aac",
-        "-b:a", "128k",
-        "-movflags", "+faststart",
-        out_path,
-    ]
-
-    # 录制只要后台安静跑，不需要 stdout/stderr
-    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-
-def read_ffmpeg_frame(proc: subprocess.Popen, width: int, height: int):
+        record_proc = start_ffmpeg_recorder(video_url, record_path, fps=fps)
+        print("[REC] ffmpeg record start =>", record_path)
+        return record_proc, record_path
+    except Exception as re:
+        print("[REC] ffmpeg start error:", re)
+        return None, None
+
+
+@router.get("/api/streams")
+def api_list_streams():
     """
-    从 ffmpeg stdout 读一帧 rawvideo，返回 (ok, frame)
+    当前正在共享的视频源及订阅数 + 推理后端状态（调试 / 监控墙排查用）
     """
-    frame_size = width * height * 3
-    if proc.stdout is None:
-        return False, None
-    data = proc.stdout.read(frame_size)
-    if not data or len(data) < frame_size:
-        return False, None
-    frame = np.frombuffer(data, dtype=np.uint8)
-    if frame.size != frame_size:
-        return False, None
-    frame = frame.reshape((height, width, 3))
-    return True, frame
+    return {"items": STREAM_HUB.stats(), "infer": backend_stats(), "load": INFER_LOAD.stats()}
 
 
 @router.websocket("/ws")
@@ -148,6 +119,7 @@ async def ws_realtime(ws: WebSocket):
     await ws.accept()
 
     session_id = None
+    session_started_ts = None  # detect_session.started_at 的时间戳，预聚合按它 + video_sec 分桶
     session_status = "running"
     save_to_db = False
 
@@ -155,6 +127,7 @@ async def ws_realtime(ws: WebSocket):
     record_video = False    # 是否录制本次视频
     record_proc = None      # ffmpeg 录制子进程
     record_path = None      # 实际保存的文件路径（绝对路径）
+    record_shared = False   # True = 从共享拉流的分段里截取（HLS），不单独起录制进程
 
     # ===== 1. 收启动包（前端第一次 send） =====
     try:
@@ -201,6 +174,13 @@ async def ws_realtime(ws: WebSocket):
         "send_mask_every": int(cfg.get("send_mask_every") or 1),
         "imgsz_water": int(cfg.get("imgsz_water") or 640),
         "imgsz_risk": int(cfg.get("imgsz_risk") or 640),
+        # 积水 / 风险模型是否并行推理（不传则看环境变量 DUAL_PARALLEL）
+        "parallel": bool(cfg.get("parallel", DUAL_PARALLEL)),
+        # 静止画面门控阈值（变化像素占比），0 = 每帧都推理
+        "motion_gate": float(cfg.get("motion_gate", MOTION_GATE) or 0.0),
+        # 两个模型各自每隔几个 tick 跑一次（其余 tick 沿用上次结果，payload 里 stale 标出沿用了多久）
+        "water_every": int(cfg.get("water_every") or DUAL_WATER_EVERY),
+        "risk_every": int(cfg.get("risk_every") or DUAL_RISK_EVERY),
     }
     # 简单裁剪
     params["fps"] = max(1, min(30, params["fps"]))
@@ -209,17 +189,39 @@ async def ws_realtime(ws: WebSocket):
     params["send_mask_every"] = max(0, params["send_mask_every"])
     params["imgsz_water"] = max(64, params["imgsz_water"])
     params["imgsz_risk"] = max(64, params["imgsz_risk"])
+    params["motion_gate"] = max(0.0, min(1.0, params["motion_gate"]))
+    params["water_every"] = max(1, params["water_every"])
+    params["risk_every"] = max(1, params["risk_every"])
+
+    # ==== tick 协议：json（默认）/ bin1（二进制帧，见 utils/ws_codec.py） ====
+    protocol = negotiate(cfg.get("protocol"))
+    binary = (protocol == PROTOCOL_BIN)
+    # 二进制协议下可选掩膜差分：关键帧 + 与上一帧的 XOR（省带宽，远端网点链路窄时用）
+    mask_encoder = MaskDeltaEncoder() if (binary and cfg.get("mask_delta")) else None
+    if cfg.get("protocol") is not None:
+        await ws_safe_send(ws, {
+            "type": "protocol",
+            "protocol": protocol,
+            "mask_delta": mask_encoder is not None,
+        })
+
+    # ==== 订阅共享的解码 + 推理循环（同一路源只跑一份） ====
+    # 已有其他连接在看这一路时，沿用该路当前的共享参数
+    sub = STREAM_HUB.subscribe(video_url, params, mask_format="raw" if binary else "png")
+    stream = sub.stream
+    is_hls = stream.is_hls
 
     # ==== 如需存库，先建一条 detect_session ====
     if save_to_db:
         try:
-            session_id = create_detect_session(
+            session_id = await run_db(
+                create_detect_session,
                 camera_id=camera_id,
                 camera_name=camera_name,
                 location=location,
                 source_type=source_type,
                 source_url=raw_url,  # 存原始地址方便回看
-                params=params
+                params=sub.merged_params()
             )
             await ws_safe_send(ws, {
                 "type": "session_created",
@@ -230,9 +232,14 @@ async def ws_realtime(ws: WebSocket):
             print("[DB] create_detect_session error:", e)
             save_to_db = False
             session_id = None
+    if session_id:
+        try:
+            started_at = await run_db(get_session_started_at, session_id)
+            if started_at is not None:
+                session_started_ts = started_at.timestamp()
+        except Exception as e:
+            print("[DB] get_session_started_at error:", e)
 
-    # 是否 HLS 流（萤石云 HLS）
-    is_hls = video_url.startswith("http") and ".m3u8" in video_url.lower()
     stop_flag = False
 
     # ===== 2. 后台接收 set_params / stop =====
@@ -249,305 +256,153 @@ async def ws_realtime(ws: WebSocket):
                 continue
 
             if data.get("type") == "set_params":
-                updated = []
-                for key in ALLOWED_KEYS:
-                    if key in data:
-                        params[key] = _get(data, key, params[key])
-                        updated.append(key)
-
-                params["fps"] = max(1, min(30, int(params["fps"])))
+                # 订阅者级参数只影响本连接，其余参数对整路共享
+                updated = stream.update_params(data, sub, ALLOWED_KEYS)
 
                 await ws_safe_send(ws, {
                     "type": "ack",
                     "updated": updated,
-                    "params": params,
+                    "params": sub.merged_params(),
                 })
 
+            elif data.get("type") == "mask_keyframe":
+                # 客户端丢了参考帧（如切回前台重建画布），下一次发完整掩膜
+                if mask_encoder is not None:
+                    mask_encoder.force_key = True
+
             elif data.get("type") == "stop":
                 stop_flag = True
                 session_status = "stopped"
                 break
 
+        # 连接断开 / stop：唤醒正在等 tick 的主循环
+        sub.close()
+
     recv_task = asyncio.create_task(receiver())
 
     # 统计用
-    avg_read_ms = avg_infer_ms = avg_send_ms = 0.0
+    avg_send_ms = 0.0
     ema = 0.2
-    last_mask_b64 = None
-    t_start = time.perf_counter()
-    tick_idx = 0
-    frame_idx = 0
+    last_mask = None
+    mask_key = MASK_KEYS[sub.mask_format]
+    last_params = None
 
     try:
-        # ======================  HLS via FFmpeg 模式  ======================
-        if is_hls:
-            proc = start_ffmpeg_hls(video_url, HLS_WIDTH, HLS_HEIGHT)
-            if proc.stdout is None:
-                await ws_safe_send(ws, {"type": "error", "msg": "ffmpeg start failed"})
-                session_status = "error"
+        # 如需录像：HLS 源直接用共享拉流写出的分段（不再二次拉流 / 重新编码），
+        # 其它源单独启一个 ffmpeg 录制进程
+        if record_video and record_proc is None:
+            if sub.stream.begin_recording(sub):
+                record_shared = True
+                record_path = new_record_path(camera_id)
+                print("[REC] shared segments =>", record_path)
             else:
-                print("[HLS] using ffmpeg pipeline")
-
-                # ===== 只要需要录像，就单独启一个 ffmpeg 录制进程 =====
-                if record_video and record_proc is None:
-                    try:
-                        cam_dir = RECORD_ROOT / (camera_id or "unknown")
-                        cam_dir.mkdir(parents=True, exist_ok=True)
-                        ts_str = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-                        file_name = f"{ts_str}.mp4"
-                        record_path = str(cam_dir / file_name)
-
-                        record_proc = start_ffmpeg_recorder(
-                            video_url,
-                            record_path,
-                            fps=params.get("fps"),
-                        )
-                        print("[REC] ffmpeg record start =>", record_path)
-                    except Exception as re:
-                        print("[REC] ffmpeg start error:", re)
-                        record_proc = None
-                        record_path = None
-
-                # ===== 原来的推理循环保持不变 =====
-                while not stop_flag:
-                    # 1) 读一帧
-                    t0 = time.perf_counter()
-                    ok, frame = read_ffmpeg_frame(proc, HLS_WIDTH, HLS_HEIGHT)
-                    frame_idx += 1
-                    if not ok:
-                        await ws_safe_send(ws, {"type": "eof"})
-                        session_status = "done"
-                        break
-                    read_ms = (time.perf_counter() - t0) * 1000.0
-
-
-                    # 4) 推理
-                    t1 = time.perf_counter()
-                    loop = asyncio.get_event_loop()
-                    result = await loop.run_in_executor(
-                        None,
-                        infer_dual_on_frame,
-                        frame,
-                        {**params, "return_mask": True},  # HLS 下每帧都算 mask，再由 send_mask_every 控制发不发
-                    )
-                    infer_ms = (time.perf_counter() - t1) * 1000.0
-
-                    # 5) 掩膜缓存 & send_mask_every
-                    water = (result.get("water") or {}).copy()
-                    send_every = max(0, int(params.get("send_mask_every", 0)))
-                    if send_every <= 0:
-                        last_mask_b64 = None
-                        water.pop("mask_png_b64", None)
-                    else:
-                        cur_mask = water.get("mask_png_b64")
-                        if cur_mask:
-                            last_mask_b64 = cur_mask
-                        elif last_mask_b64:
-                            water["mask_png_b64"] = last_mask_b64
-                        # 控制“发不发”
-                        if tick_idx % send_every != 0:
-                            water.pop("mask_png_b64", None)
-
-                    # 6) 时间戳：用相对时间
-                    elapsed = time.perf_counter() - t_start
-                    video_sec = elapsed
-                    ts_ms = int(video_sec * 1000)
-
-                    payload = {
-                        "type": "tick",
-                        "tick_idx": tick_idx,
-                        "ts": ts_ms,
-                        "pct": result.get("pct", 0.0),
-                        "level": result.get("level", 0),
-                        "water": water,
-                        "risk": result.get("risk", {}),
-                        "params": params,
-                    }
-
-                    # 7) 写 detect_tick
-                    if session_id:
-                        try:
-                            save_detect_tick(
-                                session_id=session_id,
-                                ts_ms=ts_ms,
-                                video_sec=video_sec,
-                                result=result,
-                                water=water,
-                                risk=result.get("risk", {}),
-                            )
-                        except Exception as e:
-                            print("[DB] save_detect_tick error:", e)
-
-                    # 8) 发给前端
-                    t2 = time.perf_counter()
-                    ok = await ws_safe_send(ws, payload)
-                    send_ms = (time.perf_counter() - t2) * 1000.0
-                    if not ok:
-                        session_status = "stopped"
-                        break
-
-                    # 9) 打印性能
-                    avg_read_ms = (1 - ema) * avg_read_ms + ema * read_ms
-                    avg_infer_ms = (1 - ema) * avg_infer_ms + ema * infer_ms
-                    avg_send_ms = (1 - ema) * avg_send_ms + ema * send_ms
-                    if tick_idx % max(1, params["fps"]) == 0:
-                        print(
-                            f"[WS-HLS] fps~{params['fps']} read={avg_read_ms:.1f}ms "
-                            f"infer={avg_infer_ms:.1f}ms send={avg_send_ms:.1f}ms"
-                        )
-
-                    tick_idx += 1
-
-        # ======================  非 HLS：原 OpenCV 模式  ======================
-        else:
-            cap = cv2.VideoCapture(video_url)
-            if not cap.isOpened():
-                await ws_safe_send(ws, {"type": "error", "msg": "video open failed"})
-                if session_id:
-                    try:
-                        finish_detect_session(session_id, status="error")
-                    except Exception as e:
-                        print("[DB] finish_detect_session on open error:", e)
-                await ws.close()
-                return
-
-            # 打开成功后，如果需要录像，就启动 ffmpeg 录制进程（只启动一次）
-            if record_video and record_proc is None:
-                try:
-                    cam_dir = RECORD_ROOT / (camera_id or "unknown")
-                    cam_dir.mkdir(parents=True, exist_ok=True)
-                    ts_str = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-                    file_name = f"{ts_str}.mp4"
-                    record_path = str(cam_dir / file_name)
-
-                    record_proc = start_ffmpeg_recorder(
-                        video_url,
-                        record_path,
-                        fps=params.get("fps"),
-                    )
-                    print("[REC] ffmpeg record start =>", record_path)
-                except Exception as re:
-                    print("[REC] ffmpeg start error:", re)
-                    record_proc = None
-                    record_path = None
-
-            src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
-            tick_period = 1.0 / params["fps"]
-            next_wall = time.perf_counter()
-            frames_per_tick = max(1, int(round(src_fps / params["fps"])))
+                record_proc, record_path = start_session_recorder(
+                    camera_id, video_url, sub.merged_params().get("fps")
+                )
 
-            try:
-                cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
-            except Exception:
-                pass
-
-            while not stop_flag:
-                ...
-
-                # 1) 按墙钟限速
-                now = time.perf_counter()
-                if now < next_wall:
-                    await asyncio.sleep(next_wall - now)
-
-                # 2) 丢帧
-                t0 = time.perf_counter()
-                skips = max(0, frames_per_tick - 1)
-                for _ in range(skips):
-                    if not cap.grab():
-                        await ws_safe_send(ws, {"type": "eof"})
-                        stop_flag = True
-                        session_status = "done"
-                        break
-                    frame_idx += 1
-                if stop_flag:
-                    break
-
-                ok, frame = cap.read()
-                frame_idx += 1
-                if not ok:
-                    await ws_safe_send(ws, {"type": "eof"})
-                    session_status = "done"
-                    break
-
-                read_ms = (time.perf_counter() - t0) * 1000.0
-
-
-                # 3) 控制是否算掩膜
-                send_every = max(0, int(params.get("send_mask_every", 0)))
-                need_mask = send_every > 0 and (tick_idx % send_every == 0)
-
-                # 4) 推理
-                t1 = time.perf_counter()
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(
-                    None,
-                    infer_dual_on_frame,
-                    frame,
-                    {**params, "return_mask": need_mask},
+        while not stop_flag:
+            # 1) 等共享循环推来的事件
+            event = await sub.get()
+            etype = event.get("type")
+            if etype == "closed":
+                break
+            if etype == "eof":
+                await ws_safe_send(ws, {"type": "eof"})
+                session_status = "done"
+                break
+            if etype == "error":
+                await ws_safe_send(ws, {"type": "error", "msg": event.get("msg")})
+                session_status = "error"
+                break
+
+            result = event["result"]
+            tick_idx = sub.tick_idx
+            reuse_reason = event.get("reuse_reason")
+            if reuse_reason:
+                sub.reuse_counts[reuse_reason] += 1
+            params_now = sub.merged_params()
+
+            # 2) 掩膜缓存 & send_mask_every（按本连接自己的节奏发）
+            # 同一路上其他协议的连接可能让结果里带了别的格式的掩膜，只留本连接要的那种
+            water = strip_masks(result.get("water") or {}, keep=mask_key)
+            # 实际间隔 = 本连接的 send_mask_every × 当前降级倍数（与共享循环决定是否出掩膜的口径一致）
+            send_every = sub.mask_every()
+            if send_every <= 0:
+                last_mask = None
+                water.pop(mask_key, None)
+            else:
+                cur_mask = water.get(mask_key)
+                if cur_mask is not None:
+                    last_mask = cur_mask
+                elif last_mask is not None:
+                    water[mask_key] = last_mask
+                # 控制“发不发”
+                if tick_idx % send_every != 0:
+                    water.pop(mask_key, None)
+
+            # 3) 时间戳：直播流用本连接加入后的相对时间，文件用视频内时间
+            if event.get("video_sec") is None:
+                video_sec = event["wall"] - sub.t_join
+            else:
+                video_sec = event["video_sec"]
+            ts_ms = int(video_sec * 1000)
+
+            payload = {
+                "type": "tick",
+                "tick_idx": tick_idx,
+                "ts": ts_ms,
+                "pct": result.get("pct", 0.0),
+                "level": result.get("level", 0),
+                "water": water,
+                "risk": result.get("risk", {}),
+                "params": params_now,
+                # 当前实际工作点（自适应降级后的 fps / imgsz / 掩膜间隔倍数）
+                "op": event.get("op"),
+                # 本 tick 是否沿用上次推理结果及原因；reuse_counts 为本连接按原因累计的次数
+                "reused": reuse_reason is not None,
+                "reuse_reason": reuse_reason,        # motion / cadence / shed
+                "reuse_counts": dict(sub.reuse_counts),
+                # 积水 / 风险结果各自沿用了几个 tick、多少毫秒
+                "stale": event.get("stale"),
+            }
+
+            # 4) 写 detect_tick：只入队，由后台线程批量写库
+            if session_id:
+                TICK_WRITER.enqueue(
+                    session_id=session_id,
+                    ts_ms=ts_ms,
+                    video_sec=video_sec,
+                    result=result,
+                    water=strip_masks(water),
+                    risk=result.get("risk", {}),
+                    camera_id=camera_id,
+                    started_ts=session_started_ts,
                 )
-                infer_ms = (time.perf_counter() - t1) * 1000.0
 
-                water = (result.get("water") or {}).copy()
-                if send_every <= 0:
-                    last_mask_b64 = None
-                    water.pop("mask_png_b64", None)
+            # 5) 发给前端
+            t2 = time.perf_counter()
+            if binary:
+                # 二进制协议：params 只在变化时带上
+                if params_now == last_params:
+                    payload.pop("params")
                 else:
-                    cur_mask = water.get("mask_png_b64")
-                    if cur_mask:
-                        last_mask_b64 = cur_mask
-                    elif last_mask_b64:
-                        water["mask_png_b64"] = last_mask_b64
-
-                video_sec = frame_idx / max(1.0, float(src_fps))
-                ts_ms = int(video_sec * 1000)
-
-                payload = {
-                    "type": "tick",
-                    "tick_idx": tick_idx,
-                    "ts": ts_ms,
-                    "pct": result.get("pct", 0.0),
-                    "level": result.get("level", 0),
-                    "water": water,
-                    "risk": result.get("risk", {}),
-                    "params": params,
-                }
-
-                if session_id:
-                    try:
-                        save_detect_tick(
-                            session_id=session_id,
-                            ts_ms=ts_ms,
-                            video_sec=video_sec,
-                            result=result,
-                            water=water,
-                            risk=result.get("risk", {}),
-                        )
-                    except Exception as e:
-                        print("[DB] save_detect_tick error:", e)
-
-                t2 = time.perf_counter()
+                    last_params = params_now
+                ok = await ws_safe_send_bytes(ws, encode_tick(payload, mask_encoder))
+            else:
                 ok = await ws_safe_send(ws, payload)
-                send_ms = (time.perf_counter() - t2) * 1000.0
-                if not ok:
-                    session_status = "stopped"
-                    break
-
-                avg_read_ms = (1 - ema) * avg_read_ms + ema * read_ms
-                avg_infer_ms = (1 - ema) * avg_infer_ms + ema * infer_ms
-                avg_send_ms = (1 - ema) * avg_send_ms + ema * send_ms
-                if tick_idx % max(1, params["fps"]) == 0:
-                    print(
-                        f"[WS] fps={params['fps']} read={avg_read_ms:.1f}ms "
-                        f"infer={avg_infer_ms:.1f}ms send={avg_send_ms:.1f}ms "
-                        f"need_mask={need_mask}"
-                    )
-
-                tick_idx += 1
-                next_wall += tick_period
-                if next_wall < time.perf_counter() - tick_period:
-                    next_wall = time.perf_counter()
-
-            cap.release()
+            send_ms = (time.perf_counter() - t2) * 1000.0
+            if not ok:
+                session_status = "stopped"
+                break
+
+            avg_send_ms = (1 - ema) * avg_send_ms + ema * send_ms
+            if tick_idx % max(1, params_now["fps"]) == 0:
+                print(
+                    f"[WS{'-HLS' if is_hls else ''}] tick={tick_idx} send={avg_send_ms:.1f}ms "
+                    f"dropped={sub.dropped} reuse={sub.reuse_counts}"
+                )
+
+            sub.tick_idx += 1
 
     except WebSocketDisconnect:
         session_status = "stopped"
@@ -558,25 +413,20 @@ async def ws_realtime(ws: WebSocket):
         stop_flag = True
         recv_task.cancel()
 
-        # 关闭 ffmpeg 录制进程
+        # 退订：最后一个订阅者离开时共享循环会停掉解码进程
+        STREAM_HUB.unsubscribe(sub)
+        print(f"[WS] session end ticks={sub.tick_idx} reuse={sub.reuse_counts} dropped={sub.dropped}"
+              + (f" mask={mask_encoder.stats()}" if mask_encoder is not None else ""))
+
+        # 关闭 ffmpeg 录制进程 / 从共享分段拼出本会话录像
         if record_proc is not None:
-            try:
-                record_proc.terminate()
-                record_proc.wait(timeout=3)
-                print("[REC] ffmpeg record stop, path =", record_path)
-            except Exception as e:
-                print("[REC] ffmpeg terminate error:", e)
-                try:
-                    record_proc.kill()
-                except Exception:
-                    pass
-
-        # 关闭 HLS ffmpeg 解码进程（start_ffmpeg_hls 用的那个 proc）
-        if "proc" in locals():
-            try:
-                proc.kill()
-            except Exception:
-                pass
+            stop_process(record_proc)
+            print("[REC] ffmpeg record stop, path =", record_path)
+        elif record_shared:
+            ok = await asyncio.get_event_loop().run_in_executor(
+                None, sub.stream.finish_recording, sub, record_path
+            )
+            print("[REC] shared segments concat", "ok" if ok else "failed", "=>", record_path)
 
         try:
             await ws.close()
@@ -584,14 +434,19 @@ async def ws_realtime(ws: WebSocket):
             pass
 
         # 结束时更新 detect_session 状态 & record_path
+        # 源没打开就结束时，录像文件可能根本没生成
+        if record_path and not Path(record_path).exists():
+            record_path = None
+
         if session_id:
+            # 先把本会话还在队列里的 tick 刷进库，再标记结束（导出紧跟其后也能读到完整数据）
+            await asyncio.get_event_loop().run_in_executor(None, TICK_WRITER.flush)
             try:
                 if record_path:
                     rel_path = str(Path(record_path).relative_to(RECORD_ROOT.parent))
-                    update_detect_session_record_path(session_id, rel_path)
+                    await run_db(update_detect_session_record_path, session_id, rel_path)
                     print("[DB] update_record_path:", rel_path)
-                finish_detect_session(session_id, session_status)
+                await run_db(finish_detect_session, session_id, session_status)
                 print("[DB] finish_detect_session", session_id, "=>", session_status)
             except Exception as e:
                 print("[DB] finish_detect_session error:", e)
-
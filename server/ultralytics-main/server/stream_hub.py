@@ -0,0 +1,556 @@
+# server/stream_hub.py  —— 按视频源共享的解码 + 推理循环
+#
+# 同一路摄像头被多个 /ws 连接同时观看时，只开一个解码（ffmpeg / OpenCV）
+# 和一次双模型推理，结果以 tick 事件的形式扇出给所有订阅者。
+# 订阅计数归零时自动停止该路循环。
+#
+# HLS 源默认只起一个 ffmpeg（HLS_TEE=1）：同一次拉流既 remux 成滚动分段 MP4，
+# 又输出 rawvideo 给推理；会话结束时把覆盖该会话时间段的分段无损拼成录像文件。
+import asyncio
+import hashlib
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import cv2
+
+from .adaptive import INFER_LOAD, AdaptiveController
+from .infer_dispatch import infer_dual_async, release_session
+from .infer_sched import InferRejected
+from .pipeline_dual import has_masks
+from .motion_gate import MotionGate
+from .utils.frame_reader import FrameReader
+from .utils.ffmpeg_io import (
+    concat_segments,
+    model_frame_size,
+    start_ffmpeg_hls,
+    start_ffmpeg_hls_tee,
+    stop_process,
+)
+
+HLS_TEE = (os.getenv("HLS_TEE", "1") == "1")
+HLS_SEGMENT_SEC = int(os.getenv("HLS_SEGMENT_SEC", "10"))
+# 没有会话在录制时，分段最多保留多久（秒）
+HLS_SEGMENT_KEEP_SEC = float(os.getenv("HLS_SEGMENT_KEEP_SEC", "600"))
+SEGMENT_ROOT = Path(__file__).resolve().parent / "records" / "_segments"
+_SEGMENT_NAME_FMT = "%Y%m%d_%H%M%S"
+
+# 只属于单个订阅者的参数（其余参数整路共享）
+SUBSCRIBER_KEYS = {"send_mask_every"}
+
+# 每个订阅者最多积压的 tick 数，超出丢最旧的，避免慢连接拖住整路
+SUBSCRIBER_QUEUE_SIZE = 2
+
+# tick 沿用上次推理结果的原因（见 CameraStream._infer）
+REUSE_MOTION = "motion"
+REUSE_CADENCE = "cadence"
+REUSE_SHED = "shed"
+REUSE_REASONS = (REUSE_MOTION, REUSE_CADENCE, REUSE_SHED)
+
+
+def is_hls_url(video_url: str) -> bool:
+    return video_url.startswith("http") and ".m3u8" in video_url.lower()
+
+
+class StreamSubscriber:
+    """
+    一个 WebSocket 对一路视频源的订阅：
+    - queue      : 收到的 tick / eof / error 事件
+    - params     : 仅本订阅者生效的参数（send_mask_every）
+    - tick_idx   : 本订阅者自己的 tick 计数
+    - mask_format: 本订阅者需要的掩膜格式
+    """
+
+    def __init__(self, stream: "CameraStream", params: dict, mask_format: str = "png"):
+        self.stream = stream
+        # 本连接要的掩膜格式：png（JSON 协议的 mask_png_b64）/ raw（二进制协议自己编码）
+        self.mask_format = mask_format
+        self.params = {k: params[k] for k in SUBSCRIBER_KEYS if k in params}
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.t_join = time.perf_counter()
+        self.tick_idx = 0
+        self.dropped = 0
+        # 收到的 tick 里沿用旧结果的次数，按原因分开计（见 REUSE_REASONS）
+        self.reuse_counts = {r: 0 for r in REUSE_REASONS}
+        self.rec_start: Optional[float] = None  # 从共享分段里录像时的起始墙钟时间
+
+    def mask_every(self) -> int:
+        """实际生效的掩膜间隔：本订阅者的 send_mask_every × 当前降级倍数（0 = 不发）"""
+        send_every = max(0, int(self.params.get("send_mask_every", 0)))
+        return send_every * self.stream.ctl.mask_scale
+
+    def wants_mask(self) -> bool:
+        """本订阅者的下一个 tick 是否需要掩膜"""
+        send_every = self.mask_every()
+        return send_every > 0 and self.tick_idx % send_every == 0
+
+    def push(self, event: dict) -> None:
+        """非阻塞投递，队列满时丢掉最旧的一条"""
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except asyncio.QueueFull:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except asyncio.QueueEmpty:
+                    pass
+
+    def close(self) -> None:
+        """唤醒正在等待 queue 的消费方"""
+        self.push({"type": "closed"})
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+    def merged_params(self) -> dict:
+        return {**self.stream.params, **self.params}
+
+
+class CameraStream:
+    """
+    一路视频源（以映射后的 video_url 为 key）的解码 + 推理循环。
+    """
+
+    def __init__(self, hub: "StreamHub", key: str, params: dict):
+        self.hub = hub
+        self.key = key
+        self.is_hls = is_hls_url(key)
+        # 整路共享参数：fps / conf / iou / imgsz ...
+        self.params = {k: v for k, v in params.items() if k not in SUBSCRIBER_KEYS}
+        self.subscribers: Set[StreamSubscriber] = set()
+        self.task: Optional[asyncio.Task] = None
+        # 已结束（eof / error / 被停掉）：从 hub 摘掉，不再接受新订阅者，即使还在等 ffmpeg 退出
+        self.closing = False
+        self._ended = False  # 是否已给订阅者发过 eof / error
+        self.t_start = time.perf_counter()
+        self.tick_idx = 0
+        # HLS 共享录像：分段目录（按源区分）+ 正在录制的订阅者（其起点之后的分段不会被清理）
+        self.segment_dir: Optional[Path] = None
+        if self.is_hls and HLS_TEE:
+            self.segment_dir = SEGMENT_ROOT / hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.recordings: Dict[StreamSubscriber, float] = {}
+        self._last_prune = 0.0
+        self.reader: Optional[FrameReader] = None
+        # 按推理耗时 / 全局负载自动调整 fps、掩膜间隔、imgsz
+        self.ctl = AdaptiveController()
+        # 静止画面复用上次结果
+        self.gate = MotionGate()
+        # 两个模型各自的节奏：最近一次真正跑出来的那一半结果 + 当时的 (tick_idx, 时间)
+        self._last_water: Optional[dict] = None
+        self._last_risk: Optional[dict] = None
+        self._water_at: Tuple[int, float] = (0, 0.0)
+        self._risk_at: Tuple[int, float] = (0, 0.0)
+
+    # ---------- 共享录像 ----------
+    def begin_recording(self, sub: StreamSubscriber) -> bool:
+        """
+        本订阅者从现在开始录像；没有共享分段（非 HLS / HLS_TEE=0）时返回 False，由调用方自己起录制进程
+        """
+        if self.segment_dir is None:
+            return False
+        sub.rec_start = time.time()
+        self.recordings[sub] = sub.rec_start
+        return True
+
+    def _segments(self) -> List[Tuple[Path, float]]:
+        """目录下的分段 (path, 开始时间戳)，按时间排序"""
+        items = []
+        if self.segment_dir is None or not self.segment_dir.exists():
+            return items
+        for p in self.segment_dir.glob("*.mp4"):
+            try:
+                items.append((p, datetime.strptime(p.stem, _SEGMENT_NAME_FMT).timestamp()))
+            except ValueError:
+                continue
+        items.sort(key=lambda x: x[1])
+        return items
+
+    def finish_recording(self, sub: StreamSubscriber, out_path: str) -> bool:
+        """
+        把 [rec_start, 现在] 覆盖到的分段无损拼成 out_path（阻塞，放线程池里调）
+        """
+        t_start = self.recordings.get(sub, sub.rec_start)
+        t_end = time.time()
+        try:
+            if t_start is None:
+                return False
+            segs = self._segments()
+            picked = []
+            for i, (path, seg_start) in enumerate(segs):
+                seg_end = segs[i + 1][1] if i + 1 < len(segs) else t_end
+                if seg_end > t_start and seg_start < t_end:
+                    picked.append((path, seg_start))
+            if not picked:
+                return False
+            inpoint = max(0.0, t_start - picked[0][1])
+            return concat_segments([p for p, _ in picked], out_path,
+                                   inpoint=inpoint, duration=t_end - t_start)
+        finally:
+            self.recordings.pop(sub, None)
+            sub.rec_start = None
+
+    def _prune_segments(self, force: bool = False) -> None:
+        """
+        删掉过期分段：早于 HLS_SEGMENT_KEEP_SEC，且早于所有正在录制的会话的起点
+        """
+        now = time.time()
+        if not force and now - self._last_prune < 30:
+            return
+        self._last_prune = now
+        keep_from = now - HLS_SEGMENT_KEEP_SEC
+        pinned = list(self.recordings.values())  # finish_recording 在线程池里改这个 dict
+        if pinned:
+            keep_from = min(keep_from, min(pinned))
+        segs = self._segments()
+        for i, (path, _) in enumerate(segs[:-1]):
+            if segs[i + 1][1] <= keep_from:  # 该段的结束时间 = 下一段的开始时间
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    # ---------- 订阅管理 ----------
+    def update_params(self, data: dict, sub: StreamSubscriber, allowed_keys) -> list:
+        """
+        set_params：订阅者级参数只改自己，其余参数对整路生效
+        """
+        updated = []
+        for key in allowed_keys:
+            if key not in data:
+                continue
+            target = sub.params if key in SUBSCRIBER_KEYS else self.params
+            default = target.get(key, data[key])
+            v = data[key]
+            target[key] = type(default)(v) if v is not None else default
+            updated.append(key)
+
+        self.params["fps"] = max(1, min(30, int(self.params["fps"])))
+        for key in ("water_every", "risk_every"):
+            self.params[key] = max(1, int(self.params.get(key) or 1))
+        return updated
+
+    def _fan_out(self, event: dict) -> None:
+        if event.get("type") in ("eof", "error"):
+            # 终止事件：马上从 hub 摘掉，之后进来的连接会新建一路，而不是加入这路正在收尾的流
+            self._ended = True
+            self.hub._forget(self)
+        for sub in list(self.subscribers):
+            sub.push(event)
+
+    def _mask_formats(self) -> tuple:
+        """下一个 tick 需要出哪些格式的掩膜（空 = 不需要掩膜）"""
+        return tuple(sorted({sub.mask_format for sub in self.subscribers if sub.wants_mask()}))
+
+    # ---------- 推理 ----------
+    async def _infer(self, frame, rgb: bool = False):
+        """
+        按当前工作点推理，并把耗时反馈给自适应控制器。返回 (result, reuse_reason)：
+        reuse_reason 为 None 表示本 tick 真正推理过；否则是沿用上次结果的原因
+          motion ：画面和上次推理时相比基本没变
+          cadence：按 water_every / risk_every 本 tick 两个模型都不用跑
+          shed   ：推理调度器 / worker 过载或出错，这帧被丢弃
+        还没有任何推理结果时被丢弃的帧返回 (None, "shed")，调用方不出 tick
+        """
+        eff = self.ctl.effective(self.params)
+        params = {
+            **self.params,
+            "imgsz_water": eff["imgsz_water"],
+            "imgsz_risk": eff["imgsz_risk"],
+        }
+        formats = self._mask_formats()
+        params["return_mask"] = bool(formats)
+        params["mask_formats"] = formats
+        cached = self.gate.check(frame, params, rgb=rgb)
+        if cached is not None:
+            return cached, REUSE_MOTION
+
+        # 按 water_every / risk_every 决定本 tick 跑哪个模型；要掩膜但上次积水结果没带掩膜时必须重跑
+        params["run_water"] = (
+            self._last_water is None
+            or self.tick_idx - self._water_at[0] >= int(self.params.get("water_every") or 1)
+            or (params["return_mask"] and not has_masks(self._last_water["water"], formats))
+        )
+        params["run_risk"] = (
+            self._last_risk is None
+            or self.tick_idx - self._risk_at[0] >= int(self.params.get("risk_every") or 1)
+        )
+        if not (params["run_water"] or params["run_risk"]):
+            return self._merged(), REUSE_CADENCE
+
+        t0 = time.perf_counter()
+        try:
+            with INFER_LOAD.track():
+                partial = await infer_dual_async(frame, params, rgb=rgb, key=self.key)
+        except InferRejected:
+            # 推理调度器过载 / process 后端 worker 挂掉或报错，这帧被丢弃：本 tick 沿用上次结果，别让整路流断掉。
+            # 丢弃前的等待不是推理耗时，不喂给自适应控制器（积压由 INFER_LOAD 的压力反映）；
+            # 一次都还没推理成功时没有可沿用的结果，不能编一个 pct=0 / level=0 的 tick 出去
+            merged = self._merged()
+            return (merged or None), REUSE_SHED
+        self.ctl.observe((time.perf_counter() - t0) * 1000.0, int(self.params["fps"]))
+
+        now = time.perf_counter()
+        if "water" in partial:
+            self._last_water = {"pct": partial["pct"], "water": partial["water"]}
+            self._water_at = (self.tick_idx, now)
+        if "level" in partial:
+            self._last_risk = {"level": partial["level"], "risk": partial["risk"]}
+            self._risk_at = (self.tick_idx, now)
+        result = self._merged()
+        self.gate.update(result, params)
+        return result, None
+
+    def _merged(self) -> dict:
+        return {**(self._last_water or {}), **(self._last_risk or {})}
+
+    def _stale(self) -> dict:
+        """两半结果各自已经沿用了多少个 tick / 毫秒（0 = 本 tick 刚算的）"""
+        now = time.perf_counter()
+        return {
+            "water": {"ticks": self.tick_idx - self._water_at[0],
+                      "ms": int((now - self._water_at[1]) * 1000)},
+            "risk": {"ticks": self.tick_idx - self._risk_at[0],
+                     "ms": int((now - self._risk_at[1]) * 1000)},
+        }
+
+    # ---------- 主循环 ----------
+    async def run(self):
+        try:
+            if self.is_hls:
+                await self._run_hls()
+            else:
+                await self._run_opencv()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print("[HUB] stream runtime error:", self.key, e)
+            self._fan_out({"type": "error", "msg": str(e)})
+        finally:
+            self.hub._forget(self)
+            # 还有订阅者却没收到终止事件（例如解码循环意外退出）：补一个 eof，别让它们一直等
+            if self.subscribers and not self._ended:
+                self._fan_out({"type": "eof"})
+            release_session(self.key)
+
+    async def _run_hls(self):
+        # ffmpeg 直接输出 RGB、且尺寸就是模型 letterbox 后的大小：
+        # 推理前不再 cvtColor，ultralytics 也不用再缩放（之后改 imgsz 只是多一次 resize）
+        width, height = model_frame_size(max(int(self.params.get("imgsz_water") or 640),
+                                             int(self.params.get("imgsz_risk") or 640)))
+        if self.segment_dir is not None:
+            self.segment_dir.mkdir(parents=True, exist_ok=True)
+            proc = start_ffmpeg_hls_tee(self.key, width, height,
+                                        str(self.segment_dir), HLS_SEGMENT_SEC, pix_fmt="rgb24")
+        else:
+            proc = start_ffmpeg_hls(self.key, width, height, pix_fmt="rgb24")
+        if proc.stdout is None:
+            self._fan_out({"type": "error", "msg": "ffmpeg start failed"})
+            return
+        print("[HLS] using ffmpeg pipeline:", self.key, "tee =>", self.segment_dir)
+
+        # 读 stdout 在后台线程里做，这里只取最新一帧（推理慢时中间的帧直接丢掉）
+        reader = self.reader = FrameReader(proc, width, height).start()
+        avg_read_ms = avg_infer_ms = 0.0
+        ema = 0.2
+        next_wall = time.perf_counter()
+        try:
+            while self.subscribers:
+                # 按当前有效 fps 限速（读线程一直在读，醒来拿到的就是最新帧）
+                fps = self.ctl.effective(self.params)["fps"]
+                now = time.perf_counter()
+                if now < next_wall:
+                    await asyncio.sleep(next_wall - now)
+
+                t0 = time.perf_counter()
+                lease = await reader.get()
+                if lease is None:
+                    self._fan_out({"type": "eof"})
+                    break
+                read_ms = (time.perf_counter() - t0) * 1000.0
+
+                t1 = time.perf_counter()
+                # 推理线程直接读这块环形缓冲，只有 await 正常返回后才归还。
+                # 被取消（最后一个订阅者退订）时执行器线程可能还在读它：不归还，读线程就不会覆盖，
+                # 流随即关闭、reader 整体丢弃；推理抛异常时线程已结束，循环也随之退出
+                result, reason = await self._infer(lease.frame, rgb=True)
+                reader.release(lease)
+                infer_ms = (time.perf_counter() - t1) * 1000.0
+
+                if result is not None:
+                    self._fan_out({
+                        "type": "tick",
+                        "result": result,
+                        # 帧从管道读出的时刻（而不是推理完成的时刻），直播流时间戳更准
+                        "wall": lease.ts,
+                        "video_sec": None,  # 直播流：时间戳由订阅者按自己的加入时间计算
+                        "frame_idx": lease.seq,
+                        "op": self.ctl.snapshot(self.params),
+                        "reused": reason is not None,  # True = 沿用上次推理结果
+                        "reuse_reason": reason,        # motion / cadence / shed（见 _infer）
+                        "stale": self._stale(),
+                    })
+
+                avg_read_ms = (1 - ema) * avg_read_ms + ema * read_ms
+                avg_infer_ms = (1 - ema) * avg_infer_ms + ema * infer_ms
+                if self.tick_idx % fps == 0:
+                    print(
+                        f"[HUB-HLS] subs={len(self.subscribers)} fps~{fps}/{self.params['fps']} "
+                        f"level={self.ctl.level} wait={avg_read_ms:.1f}ms infer={avg_infer_ms:.1f}ms "
+                        f"skipped={reader.frames_dropped}"
+                    )
+                self.tick_idx += 1
+                self._prune_segments()
+                next_wall += 1.0 / fps
+                if next_wall < time.perf_counter() - 1.0 / fps:
+                    next_wall = time.perf_counter()
+        finally:
+            reader.close()
+            # terminate 让 ffmpeg 正常收尾当前分段（分段是 fragmented MP4，被 kill 也可读）
+            await asyncio.get_running_loop().run_in_executor(None, stop_process, proc, 2.0)
+            self._prune_segments(force=True)
+
+    async def _run_opencv(self):
+        cap = cv2.VideoCapture(self.key)
+        if not cap.isOpened():
+            self._fan_out({"type": "error", "msg": "video open failed"})
+            return
+
+        src_fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        next_wall = time.perf_counter()
+        try:
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
+        except Exception:
+            pass
+
+        avg_read_ms = avg_infer_ms = 0.0
+        ema = 0.2
+        frame_idx = 0
+        try:
+            while self.subscribers:
+                fps = self.ctl.effective(self.params)["fps"]
+                tick_period = 1.0 / fps
+                frames_per_tick = max(1, int(round(src_fps / fps)))
+
+                # 1) 按墙钟限速
+                now = time.perf_counter()
+                if now < next_wall:
+                    await asyncio.sleep(next_wall - now)
+
+                # 2) 丢帧
+                t0 = time.perf_counter()
+                eof = False
+                for _ in range(max(0, frames_per_tick - 1)):
+                    if not cap.grab():
+                        eof = True
+                        break
+                    frame_idx += 1
+                if not eof:
+                    ok, frame = cap.read()
+                    frame_idx += 1
+                    eof = not ok
+                if eof:
+                    self._fan_out({"type": "eof"})
+                    break
+                read_ms = (time.perf_counter() - t0) * 1000.0
+
+                # 3) 推理
+                t1 = time.perf_counter()
+                result, reason = await self._infer(frame)
+                infer_ms = (time.perf_counter() - t1) * 1000.0
+
+                if result is not None:
+                    self._fan_out({
+                        "type": "tick",
+                        "result": result,
+                        "wall": time.perf_counter(),
+                        "video_sec": frame_idx / max(1.0, float(src_fps)),
+                        "frame_idx": frame_idx,
+                        "op": self.ctl.snapshot(self.params),
+                        "reused": reason is not None,  # True = 沿用上次推理结果
+                        "reuse_reason": reason,        # motion / cadence / shed（见 _infer）
+                        "stale": self._stale(),
+                    })
+
+                avg_read_ms = (1 - ema) * avg_read_ms + ema * read_ms
+                avg_infer_ms = (1 - ema) * avg_infer_ms + ema * infer_ms
+                if self.tick_idx % max(1, fps) == 0:
+                    print(
+                        f"[HUB] subs={len(self.subscribers)} fps={fps}/{self.params['fps']} level={self.ctl.level} "
+                        f"read={avg_read_ms:.1f}ms infer={avg_infer_ms:.1f}ms"
+                    )
+
+                self.tick_idx += 1
+                next_wall += tick_period
+                if next_wall < time.perf_counter() - tick_period:
+                    next_wall = time.perf_counter()
+        finally:
+            cap.release()
+
+
+class StreamHub:
+    """
+    video_url → CameraStream 的注册表，带引用计数的启动 / 停止
+    """
+
+    def __init__(self):
+        self._streams: Dict[str, CameraStream] = {}
+
+    def subscribe(self, video_url: str, params: dict, mask_format: str = "png") -> StreamSubscriber:
+        """
+        订阅一路视频源：已有循环则直接加入（沿用该路当前参数），否则新建并启动
+        mask_format：本连接要的掩膜格式（见 StreamSubscriber）
+        """
+        stream = self._streams.get(video_url)
+        if stream is not None and (stream.closing or stream.task is None or stream.task.done()):
+            # 正在收尾的流（已 eof / 已停）不能再加入
+            self._forget(stream)
+            stream = None
+        if stream is None:
+            stream = CameraStream(self, video_url, params)
+            self._streams[video_url] = stream
+            sub = StreamSubscriber(stream, params, mask_format)
+            stream.subscribers.add(sub)
+            stream.task = asyncio.create_task(stream.run())
+            print("[HUB] start stream:", video_url)
+        else:
+            sub = StreamSubscriber(stream, params, mask_format)
+            stream.subscribers.add(sub)
+            print("[HUB] join stream:", video_url, "subs =", len(stream.subscribers))
+        return sub
+
+    def unsubscribe(self, sub: StreamSubscriber) -> None:
+        stream = sub.stream
+        stream.subscribers.discard(sub)
+        if not stream.subscribers and stream.task is not None and not stream.task.done():
+            # 最后一个订阅者离开：停掉解码 + 推理；立即摘掉，收尾期间的新订阅会另起一路
+            self._forget(stream)
+            stream.task.cancel()
+            print("[HUB] stop stream:", stream.key)
+
+    def _forget(self, stream: CameraStream) -> None:
+        stream.closing = True
+        if self._streams.get(stream.key) is stream:
+            del self._streams[stream.key]
+
+    def stats(self) -> list:
+        return [
+            {
+                "source": s.key,
+                "subscribers": len(s.subscribers),
+                "ticks": s.tick_idx,
+                "recording": len(s.recordings),
+                "reader": s.reader.stats() if s.reader is not None else None,
+                "op": s.ctl.snapshot(s.params),
+                "motion": s.gate.stats(),
+                "uptime_sec": round(time.perf_counter() - s.t_start, 1),
+            }
+            for s in self._streams.values()
+        ]
+
+
+# 进程内唯一的 hub
+STREAM_HUB = StreamHub()
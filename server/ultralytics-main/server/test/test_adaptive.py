@@ -0,0 +1,67 @@
+import pytest
+
+from server import adaptive
+from server.adaptive import ADAPTIVE_DOWN_TICKS, ADAPTIVE_UP_TICKS, LADDER, AdaptiveController, InferLoad
+
+
+@pytest.fixture
+def load(monkeypatch):
+    """替换全局负载，返回可改的压力值"""
+    value = {"pressure": 0.0}
+    fake = InferLoad()
+    fake.set_source(lambda: value["pressure"])
+    monkeypatch.setattr(adaptive, "INFER_LOAD", fake)
+    monkeypatch.setattr(adaptive, "ADAPTIVE", True)
+    return value
+
+
+def _feed(ctl, n, infer_ms, fps=10):
+    for _ in range(n):
+        ctl.observe(infer_ms, fps)
+
+
+def test_degrade_when_infer_exceeds_period(load):
+    ctl = AdaptiveController()
+    # 10 fps → 周期 100ms；连续 ADAPTIVE_UP_TICKS 次超时才降一级
+    _feed(ctl, ADAPTIVE_UP_TICKS - 1, 300)
+    assert ctl.level == 0
+    _feed(ctl, 1, 300)
+    assert ctl.level == 1
+    assert ctl.effective({"fps": 10})["fps"] == round(10 * LADDER[1][0])
+
+
+def test_restore_after_sustained_headroom(load):
+    ctl = AdaptiveController()
+    _feed(ctl, ADAPTIVE_UP_TICKS * 2, 300)
+    assert ctl.level == 2
+    # 推理变快：连续 ADAPTIVE_DOWN_TICKS 次有余量才升一级
+    _feed(ctl, 200, 5)
+    assert ctl.level == 0
+
+
+def test_backend_backlog_degrades_and_blocks_restore(load):
+    ctl = AdaptiveController()
+    load["pressure"] = 2.0
+    _feed(ctl, ADAPTIVE_UP_TICKS, 5)
+    assert ctl.level == 1
+    # 积压还在：推理本身再快也不恢复
+    _feed(ctl, ADAPTIVE_DOWN_TICKS * 3, 5)
+    assert ctl.level >= 1
+    load["pressure"] = 0.0
+    _feed(ctl, ADAPTIVE_DOWN_TICKS * len(LADDER), 5)
+    assert ctl.level == 0
+
+
+def test_many_streams_without_backlog_do_not_degrade(load):
+    # 后端没有排队时，同时开着的摄像头再多也不算拥挤
+    ctls = [AdaptiveController() for _ in range(16)]
+    adaptive.INFER_LOAD.inflight = 16
+    for ctl in ctls:
+        _feed(ctl, ADAPTIVE_UP_TICKS * 4, 20)
+    assert all(ctl.level == 0 for ctl in ctls)
+
+
+def test_inflight_fallback_without_source():
+    lo = InferLoad(capacity=4)
+    lo.inflight = 2
+    assert lo.pressure() == 0.5
@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pymysql")
+pytest.importorskip("anyio")
+
+from server import database
+from server.database import ConnectionPool, PoolTimeout
+
+
+class _Conn:
+    def __init__(self, n):
+        self.n = n
+        self.open = True
+        self.rollbacks = 0
+        self.pings = 0
+        self.ping_ok = True
+        self.rollback_ok = True
+
+    def rollback(self):
+        self.rollbacks += 1
+        if not self.rollback_ok:
+            raise RuntimeError("lost connection")
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if not self.ping_ok:
+            raise RuntimeError("gone away")
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def conns(monkeypatch):
+    made = []
+
+    def connect(**kw):
+        made.append(_Conn(len(made)))
+        return made[-1]
+
+    monkeypatch.setattr(database.pymysql, "connect", connect)
+    return made
+
+
+def _pool(**kw):
+    kw.setdefault("max_size", 2)
+    kw.setdefault("timeout", 0.2)
+    kw.setdefault("max_lifetime", 0)
+    kw.setdefault("ping_idle", 60)
+    return ConnectionPool({}, **kw)
+
+
+def test_release_rolls_back_and_reuses(conns):
+    pool = _pool()
+    c1 = pool.acquire()
+    c1.close()
+    assert conns[0].rollbacks == 1
+    c2 = pool.acquire()
+    assert c2.n == 0 and pool.created == 1
+    # close 两次只归还一次
+    c2.close()
+    c2.close()
+    assert pool.stats()["idle"] == 1 and pool.stats()["size"] == 1
+
+
+def test_checkout_waits_then_times_out(conns):
+    pool = _pool(max_size=1)
+    held = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.timeouts == 1
+
+    # 别的线程归还后，等待中的借用者拿到同一条连接
+    threading.Timer(0.05, held.close).start()
+    assert pool.acquire().n == 0
+    assert pool.created == 1
+
+
+def test_failed_rollback_drops_connection(conns):
+    pool = _pool()
+    c = pool.acquire()
+    conns[0].rollback_ok = False
+    c.close()
+    assert not conns[0].open
+    assert pool.stats()["size"] == 0 and pool.stats()["idle"] == 0
+    assert pool.acquire().n == 1
+
+
+def test_closed_or_discarded_connections_free_their_slot(conns):
+    pool = _pool(max_size=1)
+    c = pool.acquire()
+    c.discard()
+    assert not conns[0].open and pool.stats()["size"] == 0
+    c = pool.acquire()
+    conns[1].open = False   # 服务端断开
+    c.close()
+    assert pool.stats()["size"] == 0
+    assert pool.acquire().n == 2
+
+
+def test_idle_connection_is_pinged_before_checkout(conns):
+    pool = _pool(ping_idle=0)
+    pool.acquire().close()
+    conns[0].ping_ok = False
+    c = pool.acquire()
+    assert c.n == 1 and conns[0].pings == 1 and not conns[0].open
+    assert pool.ping_failures == 1
+
+
+def test_expired_connection_is_recycled(conns):
+    pool = _pool(max_lifetime=10)
+    c = pool.acquire()
+    c._entry.created -= 11
+    c.close()
+    assert not conns[0].open and pool.recycled == 1
+    assert pool.acquire().n == 1
+
+
+def test_failed_connect_releases_reserved_slot(conns, monkeypatch):
+    pool = _pool(max_size=1)
+
+    def boom(**kw):
+        raise RuntimeError("refused")
+
+    monkeypatch.setattr(database.pymysql, "connect", boom)
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    assert pool.stats()["size"] == 0
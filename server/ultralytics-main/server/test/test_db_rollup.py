@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("pymysql")
+
+from server.db_rollup import aggregate_ticks, bucket_start, upsert_rollups
+
+
+def _ts(*args):
+    return datetime(*args).timestamp()
+
+
+def test_bucket_start_truncates_to_granularity():
+    ts = _ts(2024, 6, 1, 10, 37, 42) + 0.5
+    assert bucket_start(ts, "minute") == datetime(2024, 6, 1, 10, 37)
+    assert bucket_start(ts, "hour") == datetime(2024, 6, 1, 10, 0)
+
+
+def test_aggregate_per_bucket_and_session():
+    ticks = [
+        (1, "cam-a", _ts(2024, 6, 1, 10, 0, 5), 10, 1),
+        (1, "cam-a", _ts(2024, 6, 1, 10, 0, 59), 30, 3),
+        (1, "cam-a", _ts(2024, 6, 1, 10, 1, 0), 20, 0),
+        (2, "cam-b", _ts(2024, 6, 1, 10, 0, 30), 50, 2),
+    ]
+    rows = {(r[0], r[1], r[2]): r for r in aggregate_ticks(ticks)}
+    assert len(rows) == 5   # 3 个分钟桶 + 2 个小时桶
+
+    m = rows[("minute", datetime(2024, 6, 1, 10, 0), 1)]
+    assert m == ("minute", datetime(2024, 6, 1, 10, 0), 1, "cam-a", 2, 40.0, 10, 30, 3)
+    assert rows[("minute", datetime(2024, 6, 1, 10, 1), 1)][4:] == (1, 20.0, 20, 20, 0)
+
+    h = rows[("hour", datetime(2024, 6, 1, 10, 0), 1)]
+    assert h[4:] == (3, 60.0, 10, 30, 3)
+    assert rows[("hour", datetime(2024, 6, 1, 10, 0), 2)][3:] == ("cam-b", 1, 50.0, 50, 50, 2)
+
+
+def test_aggregate_empty_camera_and_input():
+    assert aggregate_ticks([]) == []
+    rows = aggregate_ticks([(3, None, _ts(2024, 1, 1), 0, 0)])
+    assert {r[3] for r in rows} == {""}
+    assert all(isinstance(r[5], float) for r in rows)
+
+
+class _Cursor:
+    def __init__(self, log):
+        self.log = log
+
+    def executemany(self, sql, rows):
+        self.log.append((sql, list(rows)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Conn:
+    def __init__(self):
+        self.log = []
+        self.commits = 0
+
+    def cursor(self):
+        return _Cursor(self.log)
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_upsert_rollups_accumulates_in_one_statement():
+    conn = _Conn()
+    rows = aggregate_ticks([(1, "c", _ts(2024, 6, 1, 10, 0, 1), 5, 1)])
+    assert upsert_rollups(conn, rows) == 2
+    assert conn.commits == 1 and len(conn.log) == 1
+    sql, sent = conn.log[0]
+    assert sent == rows
+    assert "ON DUPLICATE KEY UPDATE" in sql and "n = n + VALUES(n)" in sql
+
+
+def test_upsert_rollups_skips_empty_batch():
+    conn = _Conn()
+    assert upsert_rollups(conn, []) == 0
+    assert conn.log == [] and conn.commits == 0
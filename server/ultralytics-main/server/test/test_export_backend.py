@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("pymysql")
+
+from server.utils import export_video
+from server.utils.export_video import resolve_backend
+from server.utils.tick_overlay import TickOverlay
+
+
+def _ticks(n):
+    return [TickOverlay(t=float(i), water_polys=[], risk_boxes=[]) for i in range(n)]
+
+
+@pytest.fixture
+def has_ffmpeg(monkeypatch):
+    monkeypatch.setattr(export_video, "ffmpeg_available", lambda: True)
+    monkeypatch.setattr(export_video, "EXPORT_FILTER_MAX_TPS", 0.5)
+    monkeypatch.setattr(export_video, "EXPORT_FILTER_MAX_TICKS", 2000)
+
+
+@pytest.mark.parametrize("backend", ["ffmpeg", "filter", "opencv"])
+def test_explicit_backend_is_kept(has_ffmpeg, backend):
+    assert resolve_backend(backend, _ticks(500), 10.0) == backend
+
+
+def test_auto_picks_filter_for_sparse_ticks(has_ffmpeg):
+    # 0.5 tick/s 以内走 filter
+    assert resolve_backend("auto", _ticks(5), 10.0) == "filter"
+    assert resolve_backend("auto", _ticks(6), 10.0) == "ffmpeg"
+
+
+def test_auto_falls_back_to_pipe(has_ffmpeg):
+    # tick 太多（滤镜表达式会过长）或时长未知
+    assert resolve_backend("auto", _ticks(2001), 100000.0) == "ffmpeg"
+    assert resolve_backend("auto", _ticks(1), 0.0) == "ffmpeg"
+
+
+@pytest.mark.parametrize("backend", ["auto", "ffmpeg", "filter"])
+def test_without_ffmpeg_everything_is_opencv(monkeypatch, backend):
+    monkeypatch.setattr(export_video, "ffmpeg_available", lambda: False)
+    assert resolve_backend(backend, _ticks(1), 10.0) == "opencv"
+
+
+def test_unknown_backend_raises(has_ffmpeg):
+    with pytest.raises(ValueError):
+        resolve_backend("gstreamer", _ticks(1), 10.0)
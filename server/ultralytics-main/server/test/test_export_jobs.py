@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("pymysql")
+
+from server import export_jobs
+from server.export_jobs import ExportJob, ExportJobManager
+
+
+@pytest.fixture
+def export_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_jobs, "EXPORT_DIR", tmp_path)
+    return tmp_path
+
+
+def _file(directory, name, size=1024, age=0.0):
+    p = directory / name
+    p.write_bytes(b"\0" * size)
+    t = time.time() - age
+    os.utime(p, (t, t))
+    return p
+
+
+def _done_job(mgr, path, finished_ago=0.0):
+    job = ExportJob(id=path.stem, session_id=1, cache_key=path.stem, options={},
+                    out_path=str(path), status="done", progress=1.0,
+                    finished_at=time.time() - finished_ago)
+    mgr._jobs[job.id] = job
+    return job
+
+
+def test_superseded_file_removed(export_dir):
+    mgr = ExportJobManager(workers=1)
+    old = _file(export_dir, "cam_mask_v1_aaaa.mp4", age=60)
+    new = _file(export_dir, "cam_mask_v1_bbbb.mp4")
+    other = _file(export_dir, "cam_mask_v2_cccc.mp4")
+    mgr._evict(new)
+    assert not old.exists()
+    assert new.exists() and other.exists()
+
+
+def test_outputs_of_live_jobs_are_pinned(export_dir, monkeypatch):
+    monkeypatch.setattr(export_jobs, "EXPORT_CACHE_MAX_MB", 1.5 / 1024)   # 约 1.5 KB：只放得下一个文件
+    mgr = ExportJobManager(workers=1)
+    served = _file(export_dir, "cam_mask_v1_aaaa.mp4", age=120)
+    lru = _file(export_dir, "cam_mask_v2_bbbb.mp4", age=60)
+    new = _file(export_dir, "cam_mask_v3_cccc.mp4")
+    _done_job(mgr, served)
+
+    # 刚完成、客户端还没来取的 done 任务：同变体被取代 / 超出大小上限都不能删它的文件
+    mgr._evict(_file(export_dir, "cam_mask_v1_dddd.mp4"))
+    assert served.exists()
+    assert not lru.exists() and not new.exists()
+
+    # 任务过期（超过 EXPORT_JOB_TTL）后不再钉住
+    _done_job(mgr, served, finished_ago=export_jobs.EXPORT_JOB_TTL + 1)
+    mgr._evict(_file(export_dir, "cam_mask_v1_eeee.mp4"))
+    assert not served.exists()
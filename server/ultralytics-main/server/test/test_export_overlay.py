@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("pymysql")
+
+from server.utils.export_video import OverlayRenderer
+from server.utils.tick_overlay import TickOverlay
+
+
+def _reference_blend(frame, ov):
+    """改造前 draw_overlay_cv2 的逐帧实现（整帧 copy + 整帧 addWeighted），作为像素级对照"""
+    h, w = frame.shape[:2]
+    polys = []
+    for poly in ov.water_polys:
+        pts = [[int(max(0.0, min(1.0, float(x))) * w), int(max(0.0, min(1.0, float(y))) * h)]
+               for x, y in (pt[:2] for pt in poly)]
+        if pts:
+            polys.append(np.array(pts, dtype=np.int32))
+    if polys:
+        mask = frame.copy()
+        cv2.fillPoly(mask, polys, (255, 0, 0))
+        frame[:] = cv2.addWeighted(frame, 0.6, mask, 0.4, 0)
+        for p in polys:
+            cv2.polylines(frame, [p], isClosed=True, color=(255, 0, 0), thickness=2)
+    for box in ov.risk_boxes:
+        x1, y1, x2, y2 = (max(0.0, min(1.0, float(v))) for v in box[:4])
+        cv2.rectangle(frame, (int(x1 * w), int(y1 * h)), (int(x2 * w), int(y2 * h)), (0, 0, 255), 2)
+    texts = []
+    if ov.water_percent is not None:
+        texts.append(f"pct={ov.water_percent:.2f}%")
+    if ov.risk_level is not None:
+        texts.append(f"level={ov.risk_level}")
+    if texts:
+        cv2.putText(frame, "  ".join(texts), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2, cv2.LINE_AA)
+
+
+def _random_overlay(rng, n_polys, n_boxes):
+    polys = []
+    for _ in range(n_polys):
+        cx, cy = rng.uniform(-0.1, 1.1, size=2)
+        ang = np.sort(rng.uniform(0, 2 * np.pi, size=rng.integers(3, 12)))
+        r = rng.uniform(0.02, 0.3)
+        polys.append(np.stack([cx + r * np.cos(ang), cy + r * np.sin(ang)], axis=1).tolist())
+    boxes = []
+    for _ in range(n_boxes):
+        x1, y1 = rng.uniform(0, 0.8, size=2)
+        boxes.append([x1, y1, x1 + rng.uniform(0.01, 0.2), y1 + rng.uniform(0.01, 0.2), int(rng.integers(0, 6))])
+    return TickOverlay(t=0.0, water_polys=polys, risk_boxes=boxes,
+                       water_percent=float(rng.uniform(0, 100)), risk_level=int(rng.integers(0, 6)))
+
+
+@pytest.mark.parametrize("size", [(640, 360), (1280, 720), (1920, 1080)])
+@pytest.mark.parametrize("seed", range(5))
+def test_renderer_matches_per_frame_blend(size, seed):
+    w, h = size
+    rng = np.random.default_rng(seed)
+    ov = _random_overlay(rng, n_polys=int(rng.integers(0, 4)), n_boxes=int(rng.integers(0, 4)))
+    renderer = OverlayRenderer(w, h)
+    renderer.set_tick(ov)
+
+    # 同一个 tick 连着渲染几帧：缓存的缓冲区复用后结果也不能变
+    for _ in range(3):
+        frame = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+        expected = frame.copy()
+        _reference_blend(expected, ov)
+        renderer.render(frame)
+        np.testing.assert_array_equal(frame, expected)
+
+
+def test_no_tick_leaves_frame_untouched():
+    renderer = OverlayRenderer(64, 48)
+    renderer.set_tick(None)
+    frame = np.full((48, 64, 3), 7, np.uint8)
+    renderer.render(frame)
+    assert (frame == 7).all()
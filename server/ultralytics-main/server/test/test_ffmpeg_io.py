@@ -0,0 +1,90 @@
+import subprocess
+
+import pytest
+
+from server.utils import ffmpeg_io
+from server.utils.ffmpeg_io import concat_segments, model_frame_size, start_ffmpeg_hls_tee
+
+
+@pytest.mark.parametrize("imgsz,size", [
+    (640, (640, 360)),
+    (320, (320, 180)),
+    (416, (416, 234)),
+    (1280, (1280, 720)),
+    (None, (640, 360)),
+    (2, (2, 2)),
+])
+def test_model_frame_size(imgsz, size):
+    w, h = model_frame_size(imgsz)
+    assert (w, h) == size
+    # 长边等于 imgsz，高度取偶数（yuv / rawvideo 缩放要求）
+    assert h % 2 == 0 and h <= w
+
+
+class _Recorder:
+    def __init__(self, returncode=0):
+        self.cmds = []
+        self.returncode = returncode
+        self.list_text = None
+
+    def popen(self, cmd, **kw):
+        self.cmds.append(cmd)
+        return "proc"
+
+    def run(self, cmd, **kw):
+        self.cmds.append(cmd)
+        with open(cmd[cmd.index("-i") + 1], encoding="utf-8") as f:
+            self.list_text = f.read()
+        return subprocess.CompletedProcess(cmd, self.returncode, b"", b"boom")
+
+
+def _outputs(cmd):
+    """按输出切开参数：每个输出以 -map 开头，到输出路径为止"""
+    first = cmd.index("-map")
+    second = cmd.index("-map", cmd.index("-f", first) + 1)
+    return cmd[first:second], cmd[second:]
+
+
+def test_hls_tee_single_input_two_outputs(monkeypatch):
+    rec = _Recorder()
+    monkeypatch.setattr(ffmpeg_io.subprocess, "Popen", rec.popen)
+    assert start_ffmpeg_hls_tee("http://cam/x.m3u8", 640, 360, "/seg", segment_sec=6, pix_fmt="rgb24") == "proc"
+    cmd = rec.cmds[0]
+    assert cmd.count("-i") == 1 and cmd[cmd.index("-i") + 1] == "http://cam/x.m3u8"
+
+    record, raw = _outputs(cmd)
+    # 录像：stream copy 到按开始时间命名的分段，不重新编码
+    assert record[record.index("-c") + 1] == "copy"
+    assert "libx264" not in cmd
+    assert record[record.index("-segment_time") + 1] == "6"
+    assert record[-1] == "/seg/%Y%m%d_%H%M%S.mp4"
+    # 推理：缩放后的 rawvideo 写到 stdout
+    assert raw[raw.index("-pix_fmt") + 1] == "rgb24"
+    assert raw[raw.index("-vf") + 1] == "scale=640:360"
+    assert raw[-1] == "-"
+
+
+def test_concat_segments_list_and_trim(monkeypatch, tmp_path):
+    rec = _Recorder()
+    monkeypatch.setattr(ffmpeg_io.subprocess, "run", rec.run)
+    out = tmp_path / "out.mp4"
+    segs = [tmp_path / "a.mp4", tmp_path / "it's.mp4"]
+    assert concat_segments(segs, str(out), inpoint=2.5, duration=12.0)
+
+    lines = rec.list_text.splitlines()
+    assert lines[0] == "ffconcat version 1.0"
+    assert lines[1] == f"file '{segs[0]}'" and lines[2] == "inpoint 2.500"
+    assert lines[3] == "file '{}'".format(str(segs[1]).replace("'", "'\\''"))
+    cmd = rec.cmds[0]
+    assert cmd[cmd.index("-t") + 1] == "12.000" and cmd[cmd.index("-c") + 1] == "copy"
+    # 列表文件用完即删
+    assert not (tmp_path / "out.mp4.concat.txt").exists()
+
+
+def test_concat_segments_failure(monkeypatch, tmp_path):
+    rec = _Recorder(returncode=1)
+    monkeypatch.setattr(ffmpeg_io.subprocess, "run", rec.run)
+    assert not concat_segments([tmp_path / "a.mp4"], str(tmp_path / "o.mp4"))
+    assert "inpoint" not in rec.list_text and "-t" not in rec.cmds[0]
+    assert not concat_segments([], str(tmp_path / "o.mp4"))
+    assert len(rec.cmds) == 1
@@ -0,0 +1,81 @@
+import json
+
+import numpy as np
+import pytest
+
+from server.utils import geom_codec
+from server.utils.geom_codec import (
+    GeomOverflow,
+    decode_boxes,
+    decode_polys,
+    encode_boxes,
+    encode_polys,
+    to_json_text,
+    to_text,
+)
+
+POLYS = [
+    {"outer": [[0.1, 0.2], [0.9, 0.2], [0.9, 0.8], [0.1, 0.8]],
+     "holes": [[[0.4, 0.4], [0.6, 0.4], [0.5, 0.6]]]},
+    {"outer": [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]], "holes": []},
+]
+BOXES = [[0.1, 0.2, 0.3, 0.4, 3], [0.5, 0.5, 1.0, 1.0, 5]]
+_EPS = 1.0 / 65535
+
+
+def _close(got, want):
+    np.testing.assert_allclose(np.asarray(got, dtype=np.float64), np.asarray(want, dtype=np.float64), atol=_EPS)
+
+
+def _assert_polys_close(got, want):
+    assert len(got) == len(want)
+    for g, w in zip(got, want):
+        _close(g["outer"], w["outer"])
+        assert len(g["holes"]) == len(w["holes"])
+        for gh, wh in zip(g["holes"], w["holes"]):
+            _close(gh, wh)
+
+
+def test_polys_round_trip():
+    _assert_polys_close(decode_polys(to_text(encode_polys(POLYS))), POLYS)
+    _assert_polys_close(decode_polys(encode_polys(POLYS)), POLYS)
+
+
+def test_plain_point_lists_are_outer_rings():
+    got = decode_polys(encode_polys([POLYS[1]["outer"]]))
+    _assert_polys_close(got, [POLYS[1]])
+
+
+def test_boxes_round_trip():
+    got = decode_boxes(to_text(encode_boxes(BOXES)))
+    _close([b[:4] for b in got], [b[:4] for b in BOXES])
+    assert [b[4] for b in got] == [3, 5]
+
+
+def test_legacy_json_rows_still_decode():
+    assert decode_polys(json.dumps(POLYS)) == POLYS
+    assert decode_boxes(json.dumps(BOXES)) == BOXES
+    assert to_json_text(json.dumps(POLYS), "polys") == json.dumps(POLYS)
+    assert json.loads(to_json_text(to_text(encode_boxes(BOXES)), "boxes"))[1][4] == 5
+
+
+def test_empty_values():
+    assert encode_polys([]) is None and encode_boxes(None) is None
+    assert decode_polys(None) == [] and decode_boxes("") == []
+
+
+def test_point_count_overflow_raises():
+    ring = [[i / 70000, 0.5] for i in range(geom_codec._MAX_COUNT + 1)]
+    with pytest.raises(GeomOverflow):
+        encode_polys([{"outer": ring, "holes": []}])
+    # 刚好 65535 个点还能编码
+    ok = decode_polys(encode_polys([ring[:-1]]))
+    assert len(ok[0]["outer"]) == geom_codec._MAX_COUNT
+
+
+def test_polygon_and_box_count_overflow_raises():
+    tri = [[0.0, 0.0], [0.1, 0.0], [0.0, 0.1]]
+    with pytest.raises(GeomOverflow):
+        encode_polys([tri] * (geom_codec._MAX_COUNT + 1))
+    with pytest.raises(GeomOverflow):
+        encode_boxes([[0, 0, 0.1, 0.1, 1]] * (geom_codec._MAX_COUNT + 1))
@@ -0,0 +1,74 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("ultralytics")  # stream_hub → pipeline_dual 会加载模型依赖
+
+from server import stream_hub
+from server.stream_hub import CameraStream, StreamSubscriber
+
+URL = "http://cam/live.m3u8"
+
+
+@pytest.fixture
+def stream(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_hub, "SEGMENT_ROOT", tmp_path)
+    monkeypatch.setattr(stream_hub, "HLS_TEE", True)
+    s = CameraStream(None, URL, {"fps": 5})
+    s.segment_dir.mkdir(parents=True)
+    return s
+
+
+def _segment(stream, ts):
+    path = stream.segment_dir / (datetime.fromtimestamp(ts).strftime("%Y%m%d_%H%M%S") + ".mp4")
+    path.write_bytes(b"")
+    return path
+
+
+def test_non_hls_has_no_shared_segments(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_hub, "SEGMENT_ROOT", tmp_path)
+    s = CameraStream(None, "rtsp://cam/1", {"fps": 5})
+    assert s.segment_dir is None
+    assert not s.begin_recording(StreamSubscriber(s, {}))
+
+
+def test_finish_recording_picks_covering_segments(stream, monkeypatch):
+    now = int(time.time())
+    paths = [_segment(stream, now - 40 + 10 * i) for i in range(4)]   # -40 -30 -20 -10
+    (stream.segment_dir / "junk.mp4").write_bytes(b"")
+    calls = []
+    monkeypatch.setattr(stream_hub, "concat_segments",
+                        lambda segs, out, inpoint, duration: calls.append((segs, inpoint, duration)) or True)
+
+    sub = StreamSubscriber(stream, {})
+    assert stream.begin_recording(sub)
+    sub.rec_start = stream.recordings[sub] = now - 25.0
+    assert stream.finish_recording(sub, "out.mp4")
+
+    segs, inpoint, duration = calls[0]
+    # 起点落在 -30 那一段里：从它开始拼，段内跳过 5 s
+    assert segs == paths[1:]
+    assert inpoint == pytest.approx(5.0)
+    assert duration == pytest.approx(25.0, abs=1.0)
+    assert sub not in stream.recordings and sub.rec_start is None
+
+
+def test_prune_keeps_segments_pinned_by_recording(stream, monkeypatch):
+    monkeypatch.setattr(stream_hub, "HLS_SEGMENT_KEEP_SEC", 60)
+    now = int(time.time())
+    old = [_segment(stream, now - 600 + 100 * i) for i in range(6)]   # -600 ... -100
+    sub = StreamSubscriber(stream, {})
+    stream.begin_recording(sub)
+    stream.recordings[sub] = now - 350.0
+
+    stream._prune_segments(force=True)
+    # 结束早于 -350 的段删掉（-600、-500），-400 那段覆盖了录制起点要保留
+    assert [p.exists() for p in old] == [False, False, True, True, True, True]
+
+    stream.recordings.clear()
+    stream._prune_segments(force=True)
+    # 没人录制：结束时间早于 KEEP_SEC 的都删，最新一段总是保留
+    assert [os.path.exists(p) for p in old] == [False] * 5 + [True]
@@ -0,0 +1,159 @@
+import asyncio
+import io
+import json
+import zipfile
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("fastapi")
+pytest.importorskip("ultralytics")  # routes_infer → infer 会加载模型依赖
+
+from server import routes_infer
+
+
+class _Req:
+    def __init__(self, accept=""):
+        self.headers = {"accept": accept} if accept else {}
+        self.client = None
+
+
+class _Upload:
+    def __init__(self, filename, data: bytes):
+        self.filename = filename
+        self.file = io.BytesIO(data)
+
+
+class _Sched:
+    def __init__(self):
+        self.batches = []
+
+    async def run(self, priority, key, fn, *args):
+        self.batches.append(len(args[0]))
+        return fn(*args)
+
+
+def _png(w, h):
+    ok, buf = cv2.imencode(".png", np.full((h, w, 3), 128, np.uint8))
+    assert ok
+    return buf.tobytes()
+
+
+def _zip(entries):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def sched(monkeypatch):
+    s = _Sched()
+    monkeypatch.setattr(routes_infer, "INFER_SCHED", s)
+    monkeypatch.setattr(routes_infer, "IMAGE_BATCH", 2)
+    monkeypatch.setattr(
+        routes_infer, "infer_images",
+        lambda imgs, min_conf: [{"image_meta": {"width": im.shape[1], "height": im.shape[0]}, "objects": []}
+                                for im in imgs],
+    )
+    return s
+
+
+def _uploads():
+    return [
+        _Upload("a.png", _png(8, 4)),
+        _Upload("broken.jpg", b"not an image"),
+        _Upload("pack.zip", _zip([
+            ("dir/", b""),
+            ("dir/b.png", _png(6, 6)),
+            ("__MACOSX/dir/._b.png", b"junk"),
+            ("notes.txt", b"skip me"),
+            ("c.png", _png(2, 10)),
+        ])),
+        _Upload("d.png", _png(3, 3)),
+    ]
+
+
+def _call(files, stream=None, accept=""):
+    async def go():
+        resp = await routes_infer.api_infer_images(_Req(accept), files=files, min_conf=0.3, stream=stream)
+        if isinstance(resp, dict) or not hasattr(resp, "body_iterator"):
+            return resp, None
+        return resp, "".join([chunk async for chunk in resp.body_iterator])
+    return asyncio.run(go())
+
+
+EXPECTED = [
+    (0, "a.png", (8, 4)),
+    (1, "broken.jpg", None),
+    (2, "dir/b.png", (6, 6)),
+    (3, "c.png", (2, 10)),
+    (4, "d.png", (3, 3)),
+]
+
+
+def _check_images(items):
+    assert [(it["index"], it["name"]) for it in items] == [(i, n) for i, n, _ in EXPECTED]
+    for it, (_, _, size) in zip(items, EXPECTED):
+        if size is None:
+            assert it["error"] == "bad image" and "objects" not in it
+        else:
+            assert (it["image_meta"]["width"], it["image_meta"]["height"]) == size
+
+
+def test_ndjson_framing(sched):
+    files = _uploads()
+    cached = [f.file for f in files]
+    resp, body = _call(files, stream="ndjson")
+    assert resp.media_type == "application/x-ndjson"
+    assert body.endswith("\n")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert events[0] == {"type": "meta", "count": 5}
+    assert all(e["type"] == "image" for e in events[1:-1])
+    _check_images(events[1:-1])
+    assert events[-1] == {"type": "done", "images": 5, "failed": 1}
+    # 按 IMAGE_BATCH 分批，解不开的图不进模型
+    assert sched.batches == [1, 2, 1]
+    # 取下来的上传缓存在响应结束后关闭
+    assert all(f.closed for f in cached)
+
+
+def test_sse_framing(sched):
+    resp, body = _call(_uploads(), accept="text/event-stream")
+    assert resp.media_type == "text/event-stream"
+    blocks = body.split("\n\n")
+    assert blocks[-1] == ""
+    events = []
+    for block in blocks[:-1]:
+        event, data = block.split("\n")
+        payload = json.loads(data[len("data: "):])
+        assert event == f"event: {payload['type']}"
+        events.append(payload)
+    assert [e["type"] for e in events] == ["meta"] + ["image"] * 5 + ["done"]
+    _check_images(events[1:-1])
+
+
+def test_plain_json(sched):
+    out, _ = _call(_uploads())
+    assert out["count"] == 5
+    _check_images(out["images"])
+
+
+def test_oversized_image_is_per_item_error(sched, monkeypatch):
+    monkeypatch.setattr(routes_infer, "MAX_IMAGE_BYTES", 100)
+    out, _ = _call([_Upload("big.png", _png(64, 64)), _Upload("zip.zip", _zip([("big2.png", _png(64, 64))]))])
+    assert [it["error"].startswith("upload exceeds") for it in out["images"]] == [True, True]
+    assert sched.batches == []
+
+
+def test_request_level_errors(sched, monkeypatch):
+    resp, _ = _call([_Upload("x.zip", b"PK garbage")])
+    assert resp.status_code == 400
+    resp, _ = _call([_Upload("x.zip", _zip([("readme.txt", b"")]))])
+    assert resp.status_code == 400
+
+    monkeypatch.setattr(routes_infer, "MAX_IMAGES_COUNT", 3)
+    resp, _ = _call(_uploads())
+    assert resp.status_code == 413
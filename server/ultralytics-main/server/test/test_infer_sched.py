@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from server import infer_sched
+from server.infer_sched import PRIORITY_IMAGE, PRIORITY_LIVE, InferScheduler, InferShed
+
+
+def _blocked_scheduler():
+    """单线程调度器，唯一的线程被一个 image 任务占住，直到 release.set()"""
+    sched = InferScheduler(threads=1)
+    release = threading.Event()
+    blocker = sched.submit(PRIORITY_IMAGE, "blocker", release.wait, 5)
+    # 等线程真正开始跑 blocker，后面提交的任务才会排队
+    deadline = time.time() + 2
+    while not blocker.running() and time.time() < deadline:
+        time.sleep(0.005)
+    assert blocker.running()
+    return sched, release, blocker
+
+
+def _assert_alive(sched):
+    assert sched.submit(PRIORITY_IMAGE, "probe", lambda: 42).result(timeout=2) == 42
+    assert all(t.is_alive() for t in sched._workers)
+
+
+def test_cancel_then_expire(monkeypatch):
+    monkeypatch.setattr(infer_sched, "INFER_SCHED_LIVE_MAX_WAIT_MS", 50)
+    sched, release, blocker = _blocked_scheduler()
+
+    live = sched.submit(PRIORITY_LIVE, "cam", lambda: "never")
+    assert live.cancel()           # 流退订：wrap_future 连带取消排队中的任务
+    time.sleep(0.1)                # 排队超时，轮到它时会被当作过期帧丢弃
+    release.set()
+    blocker.result(timeout=2)
+
+    _assert_alive(sched)
+    assert sched.stats()[PRIORITY_LIVE]["shed"] == 1
+
+
+def test_cancel_then_shed(monkeypatch):
+    monkeypatch.setitem(infer_sched.INFER_SCHED_SESSION_QUEUE, PRIORITY_LIVE, 1)
+    sched, release, blocker = _blocked_scheduler()
+
+    old = sched.submit(PRIORITY_LIVE, "cam", lambda: "old")
+    assert old.cancel()
+    # 同会话新帧把已取消的旧帧挤掉，不能在 submit 里抛 InvalidStateError
+    new = sched.submit(PRIORITY_LIVE, "cam", lambda: "new")
+    release.set()
+
+    assert new.result(timeout=2) == "new"
+    _assert_alive(sched)
+
+
+def test_shed_still_reported_to_waiters(monkeypatch):
+    monkeypatch.setitem(infer_sched.INFER_SCHED_SESSION_QUEUE, PRIORITY_LIVE, 1)
+    sched, release, blocker = _blocked_scheduler()
+
+    old = sched.submit(PRIORITY_LIVE, "cam", lambda: "old")
+    new = sched.submit(PRIORITY_LIVE, "cam", lambda: "new")
+    with pytest.raises(InferShed):
+        old.result(timeout=2)
+    release.set()
+    assert new.result(timeout=2) == "new"
+
+
+def test_image_waits_for_external_live_backlog():
+    sched = InferScheduler(threads=1)
+    backlog = [3]
+    sched.set_live_backlog(lambda: backlog[0])
+
+    fut = sched.submit(PRIORITY_IMAGE, "upload", lambda: "done")
+    time.sleep(0.1)
+    # batch / process 后端还有实时帧在排队：image 不开始
+    assert not fut.done()
+    assert sched.stats()["live_backlog_external"] == 3
+
+    backlog[0] = 0
+    assert fut.result(timeout=2) == "done"
@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("fastapi")
+pytest.importorskip("ultralytics")  # routes_infer → infer 会加载模型依赖
+
+from server import routes_infer
+from server.infer_sched import InferRejected
+
+META = {"fps": 25, "duration_ms": 4000, "width": 64, "height": 48}
+
+
+class _Req:
+    def __init__(self, accept=""):
+        self.headers = {"accept": accept} if accept else {}
+        self.client = None
+
+
+class _Sampler:
+    """替代 VideoFrameSampler：按批吐出 (frame_idx, t_ms, frame)"""
+
+    def __init__(self, path, every_nth=5, seekable=True):
+        frames = [(i * every_nth, i * 200, np.zeros((2, 2, 3), np.uint8)) for i in range(5)]
+        self.batches = [frames[:2], frames[2:4], frames[4:]]
+        self.meta = META
+        self.closed = False
+        _Sampler.last = self
+
+    def next_batch(self, n):
+        return self.batches.pop(0) if self.batches else []
+
+    def close(self):
+        self.closed = True
+
+
+class _Sched:
+    def __init__(self, reject_first=0):
+        self.reject = reject_first
+        self.calls = 0
+
+    async def run(self, priority, key, fn, *args):
+        self.calls += 1
+        if self.reject:
+            self.reject -= 1
+            raise InferRejected("full", priority)
+        return fn(*args)
+
+
+@pytest.fixture
+def sched(monkeypatch):
+    s = _Sched()
+    monkeypatch.setattr(routes_infer, "INFER_SCHED", s)
+    monkeypatch.setattr(routes_infer, "VideoFrameSampler", _Sampler)
+    monkeypatch.setattr(routes_infer, "infer_frames",
+                        lambda frames, min_conf: [[{"cls": "water", "conf": min_conf}] for _ in frames])
+    return s
+
+
+def _run(fmt, accept=""):
+    async def go():
+        resp = await routes_infer._video_response(_Req(accept), "clip.mp4", 5, 0.5, fmt)
+        if isinstance(resp, dict) or not hasattr(resp, "body_iterator"):
+            return resp, None
+        return resp, "".join([chunk async for chunk in resp.body_iterator])
+    return asyncio.run(go())
+
+
+@pytest.mark.parametrize("stream,accept,fmt", [
+    ("ndjson", "", "ndjson"),
+    (" SSE ", "application/x-ndjson", "sse"),
+    (None, "text/event-stream, */*", "sse"),
+    (None, "application/x-ndjson", "ndjson"),
+    ("xml", "text/event-stream", None),
+    (None, "application/json", None),
+])
+def test_stream_format(stream, accept, fmt):
+    assert routes_infer._stream_format(stream, _Req(accept)) == fmt
+
+
+def test_ndjson_framing(sched):
+    resp, body = _run("ndjson")
+    assert resp.media_type == "application/x-ndjson"
+    assert resp.headers["X-Accel-Buffering"] == "no"
+    assert body.endswith("\n")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert events[0] == {"type": "meta", "video_meta": META}
+    frames = events[1:-1]
+    assert [e["type"] for e in frames] == ["frame"] * 5
+    assert [e["frame_idx"] for e in frames] == [0, 5, 10, 15, 20]
+    assert [e["t_ms"] for e in frames] == [0, 200, 400, 600, 800]
+    assert frames[0]["objects"] == [{"cls": "water", "conf": 0.5}]
+    assert events[-1] == {"type": "done", "frames": 5}
+    assert sched.calls == 3 and _Sampler.last.closed
+
+
+def test_sse_framing(sched):
+    resp, body = _run("sse")
+    assert resp.media_type == "text/event-stream"
+    blocks = body.split("\n\n")
+    assert blocks[-1] == ""
+    kinds = []
+    for block in blocks[:-1]:
+        event, data = block.split("\n")
+        assert event.startswith("event: ") and data.startswith("data: ")
+        payload = json.loads(data[len("data: "):])
+        assert payload["type"] == event[len("event: "):]
+        kinds.append(payload["type"])
+    assert kinds == ["meta"] + ["frame"] * 5 + ["done"]
+
+
+def test_plain_json_keeps_old_shape(sched):
+    out, _ = _run(None)
+    assert out["video_meta"] == META
+    assert [f["t_ms"] for f in out["frames"]] == [0, 200, 400, 600, 800]
+    assert set(out["frames"][0]) == {"t_ms", "objects"}
+    assert _Sampler.last.closed
+
+
+def test_busy_before_streaming_is_503(sched):
+    sched.reject = 1
+    resp, _ = _run("ndjson")
+    assert resp.status_code == 503 and resp.headers["Retry-After"]
+    assert _Sampler.last.closed
+
+
+def test_busy_after_first_batch_waits_and_retries(sched, monkeypatch):
+    async def no_sleep(_):
+        return None
+
+    monkeypatch.setattr(routes_infer.asyncio, "sleep", no_sleep)
+    real_run = sched.run
+
+    async def run(priority, key, fn, *args):
+        # 第二批第一次提交被拒，响应已经开始，只能等一会儿重试
+        if sched.calls == 1:
+            sched.reject = 1
+        return await real_run(priority, key, fn, *args)
+
+    sched.run = run
+    _, body = _run("ndjson")
+    events = [json.loads(line) for line in body.splitlines()]
+    assert events[-1] == {"type": "done", "frames": 5}
+    assert sched.calls == 4
@@ -0,0 +1,88 @@
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from server import infer_workers
+from server.infer_workers import InferWorkerPool, NoWorkerAvailable, _Worker
+
+
+class _FakeProc:
+    pid = 12345
+    exitcode = None
+
+    def __init__(self):
+        self.killed = False
+
+    def is_alive(self):
+        return not self.killed
+
+    def kill(self):
+        self.killed = True
+
+
+@pytest.fixture
+def worker():
+    """不起子进程：摆出 spawn() 之后的状态，返回的 child 管道端扮演 worker 进程"""
+    pool = InferWorkerPool(workers=1, slots=1)
+    w = _Worker(pool, 0, None)
+    parent, child = mp.Pipe()
+    w.proc, w.conn, w.alive, w.spawned_at = _FakeProc(), parent, True, time.perf_counter()
+    pool.workers.append(w)
+    threading.Thread(target=w._reader, args=(w.proc, parent), daemon=True).start()
+    yield pool, w, child
+    pool.closing = True
+    child.close()
+    w.shm.close()
+    w.shm.unlink()
+
+
+def _wait(cond, timeout=2.0):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.005)
+    assert cond()
+
+
+def test_not_routable_until_ready(worker):
+    pool, w, child = worker
+    with pytest.raises(NoWorkerAvailable):
+        pool._pick("cam")
+    assert pool.backlog() == 0
+    child.send(("ready", 4321))
+    _wait(lambda: w.ready)
+    assert pool._pick("cam") is w
+
+
+def test_slow_model_load_is_not_stuck(worker, monkeypatch):
+    pool, w, child = worker
+    monkeypatch.setattr(infer_workers, "INFER_WORKER_TIMEOUT_SEC", 0.05)
+    time.sleep(0.1)
+    w.check()                      # 还在加载模型：不受单帧超时约束
+    assert not w.proc.killed
+
+    monkeypatch.setattr(infer_workers, "INFER_WORKER_LOAD_TIMEOUT_SEC", 0.05)
+    w.check()
+    assert w.proc.killed
+
+
+def test_stuck_timer_starts_when_frame_starts(worker, monkeypatch):
+    pool, w, child = worker
+    monkeypatch.setattr(infer_workers, "INFER_WORKER_TIMEOUT_SEC", 0.2)
+    child.send(("ready", 4321))
+    _wait(lambda: w.ready)
+    frame = np.zeros((4, 4, 3), np.uint8)
+    w.submit(1, frame, {}, False)
+    w.submit(2, frame, {}, False)
+    time.sleep(0.15)
+    # 第 1 帧算完：第 2 帧从现在开始计时，之前排队的时间不算
+    child.send((1, True, {"pct": 1.0}))
+    _wait(lambda: w.inflight == 1)
+    time.sleep(0.1)
+    w.check()
+    assert not w.proc.killed
+    time.sleep(0.15)
+    w.check()
+    assert w.proc.killed
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("ultralytics")  # motion_gate → pipeline_dual 会加载模型依赖
+
+from server import motion_gate
+from server.motion_gate import MotionGate
+
+PARAMS = {"motion_gate": 0.02, "conf_water": 0.25, "imgsz_water": 640}
+
+
+def _frame(value=100):
+    return np.full((360, 640, 3), value, dtype=np.uint8)
+
+
+def _primed(params=PARAMS):
+    gate = MotionGate()
+    assert gate.check(_frame(), params) is None   # 还没有参考帧，必须推理
+    gate.update({"pct": 12.5}, params)
+    return gate
+
+
+def test_off_by_default():
+    assert motion_gate.MOTION_GATE == 0.0
+    params = dict(PARAMS)
+    params.pop("motion_gate")
+    gate = _primed(params)
+    assert gate.check(_frame(), params) is None
+    assert gate.skipped == 0
+
+
+def test_static_frame_reuses_result():
+    gate = _primed()
+    assert gate.check(_frame(), PARAMS) == {"pct": 12.5}
+    assert gate.stats()["skipped"] == 1
+
+
+def test_changed_frame_runs_inference():
+    gate = _primed()
+    frame = _frame()
+    frame[:, :320] = 250   # 半幅画面变了
+    assert gate.check(frame, PARAMS) is None
+    assert gate.last_score > PARAMS["motion_gate"]
+
+
+def test_result_params_change_runs_inference():
+    gate = _primed()
+    assert gate.check(_frame(), dict(PARAMS, conf_water=0.5)) is None
+
+
+def test_refresh_interval_forces_inference(monkeypatch):
+    gate = _primed()
+    monkeypatch.setattr(motion_gate, "MOTION_REFRESH_SEC", 0.0)
+    assert gate.check(_frame(), PARAMS) is None
+
+
+def test_missing_mask_runs_inference():
+    gate = _primed()
+    assert gate.check(_frame(), dict(PARAMS, return_mask=True, mask_formats=("png",))) is None
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException
+
+from server.utils import range_file
+from server.utils.range_file import range_file_response
+
+DATA = bytes(range(256)) * 40   # 10240 字节
+
+
+class _Req:
+    def __init__(self, range_header=None):
+        self.headers = {"range": range_header} if range_header is not None else {}
+
+
+def _body(resp):
+    it = resp.body_iterator
+    if hasattr(it, "__aiter__"):
+        async def collect():
+            return b"".join([chunk async for chunk in it])
+        return asyncio.run(collect())
+    return b"".join(it)
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "清晰 视频.mp4"
+    path.write_bytes(DATA)
+    return path
+
+
+def test_full_file_without_range(video):
+    resp = range_file_response(video, _Req(), filename=video.name)
+    assert resp.status_code == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert resp.headers["Content-Length"] == str(len(DATA))
+    assert "filename*=UTF-8''%E6%B8%85%E6%99%B0%20%E8%A7%86%E9%A2%91.mp4" in resp.headers["Content-Disposition"]
+    assert _body(resp) == DATA
+
+
+@pytest.mark.parametrize("header,start,end", [
+    ("bytes=0-0", 0, 0),
+    ("bytes=100-199", 100, 199),
+    ("bytes=10000-", 10000, len(DATA) - 1),
+    ("bytes=10000-99999", 10000, len(DATA) - 1),   # 越界的结尾截到文件末尾
+    ("bytes=-500", len(DATA) - 500, len(DATA) - 1),
+    ("bytes=-99999", 0, len(DATA) - 1),            # 后缀比文件长：整文件
+    (" bytes=5-9 ", 5, 9),
+])
+def test_partial_content(video, header, start, end):
+    resp = range_file_response(video, _Req(header))
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == f"bytes {start}-{end}/{len(DATA)}"
+    assert resp.headers["Content-Length"] == str(end - start + 1)
+    assert _body(resp) == DATA[start:end + 1]
+
+
+def test_large_range_is_streamed_in_chunks(video, monkeypatch):
+    monkeypatch.setattr(range_file, "CHUNK_SIZE", 1000)
+    chunks = list(range_file._iter_file(video, 500, 2500))
+    assert [len(c) for c in chunks] == [1000, 1000, 500]
+    assert b"".join(chunks) == DATA[500:3000]
+
+
+@pytest.mark.parametrize("header", ["bytes=10240-", "bytes=20000-30000", "bytes=9-5", "bytes=-0"])
+def test_unsatisfiable_range(video, header):
+    with pytest.raises(HTTPException) as exc:
+        range_file_response(video, _Req(header))
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+@pytest.mark.parametrize("header", ["bytes=-", "items=0-10", "bytes=0-10,20-30", "garbage"])
+def test_unparseable_range_falls_back_to_full_file(video, header):
+    resp = range_file_response(video, _Req(header))
+    assert resp.status_code == 200
+    assert _body(resp) == DATA
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pymysql")
+
+from fastapi import HTTPException
+
+from server import db_detect
+from server.routes_history import _parse_range
+
+
+def test_date_only_end_includes_whole_day():
+    assert _parse_range("2025-11-18", "2025-11-20") == (datetime(2025, 11, 18), datetime(2025, 11, 21))
+
+
+def test_datetime_end_is_exclusive_bound():
+    assert _parse_range("2025-11-18T08:00", "2025-11-18T10:30") == (
+        datetime(2025, 11, 18, 8, 0), datetime(2025, 11, 18, 10, 30))
+
+
+def test_sessions_fill_missing_side_with_same_day():
+    day = (datetime(2025, 11, 18), datetime(2025, 11, 19))
+    assert _parse_range("2025-11-18", None, same_day=True) == day
+    assert _parse_range(None, "2025-11-18", same_day=True) == day
+    assert _parse_range("2025-11-18T08:00", None, same_day=True) == (datetime(2025, 11, 18, 8, 0), day[1])
+    # trends：只传一边时另一边不限
+    assert _parse_range("2025-11-18", None) == (day[0], None)
+
+
+@pytest.mark.parametrize("bad", ["2025/11/18", "yesterday", "2025-13-01"])
+def test_unparseable_date_is_400(bad):
+    with pytest.raises(HTTPException) as e:
+        _parse_range(bad, None)
+    assert e.value.status_code == 400
+
+
+class _Cursor:
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        self.log.append((sql, list(params)))
+
+    def fetchall(self):
+        return []
+
+
+def test_tick_page_cursor_does_not_compare_client_floats(monkeypatch):
+    log = []
+
+    class _Conn:
+        def cursor(self):
+            return _Cursor(log)
+
+    @contextmanager
+    def fake_conn():
+        yield _Conn()
+
+    monkeypatch.setattr(db_detect, "get_conn", fake_conn)
+    db_detect.list_detect_ticks_page(7, None, 100)
+    db_detect.list_detect_ticks_page(7, 4567, 100)
+
+    first, nxt = log
+    assert first[1] == [7, 100]
+    sql, params = nxt
+    # 游标那一行的 video_sec 在库里现查，参数里只有整数
+    assert "SELECT video_sec AS cur_sec FROM detect_tick WHERE id = %s" in sql
+    assert params == [4567, 7, 7, 4567, 100]
+    assert all(isinstance(p, int) for p in params)
@@ -0,0 +1,122 @@
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("pymysql")
+
+from server import tick_writer
+from server.tick_writer import TickWriter
+
+
+class _Db:
+    """替换连接池和写库函数：记录每次刷盘写了哪些行，可以让写库卡住或报错"""
+
+    def __init__(self):
+        self.batches = []
+        self.rollups = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = 0
+
+    @contextmanager
+    def conn(self):
+        yield self
+
+    def save(self, conn, rows):
+        self.gate.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("db down")
+        self.batches.append(list(rows))
+        return len(rows)
+
+    def upsert(self, conn, rows):
+        self.rollups.extend(rows)
+        return len(rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = _Db()
+    monkeypatch.setattr(tick_writer, "pooled_conn", fake.conn)
+    monkeypatch.setattr(tick_writer, "save_detect_ticks", fake.save)
+    monkeypatch.setattr(tick_writer, "upsert_rollups", fake.upsert)
+    monkeypatch.setattr(tick_writer, "TICK_ROLLUP", True)
+    return fake
+
+
+def _enqueue(writer, i, session_id=1, **kw):
+    return writer.enqueue(session_id, i * 100, i * 0.1, {"pct": float(i), "level": i % 3}, {}, {}, **kw)
+
+
+def test_batches_by_size_then_flush_interval(db):
+    writer = TickWriter(batch_size=3, flush_ms=200)
+    db.gate.clear()   # 先攒着，让后台线程一次拿满一批
+    for i in range(7):
+        assert _enqueue(writer, i)
+    db.gate.set()
+    assert writer.flush(timeout=3)
+    assert sorted(len(b) for b in db.batches) == [1, 3, 3]
+    assert [row[2] for b in db.batches for row in b] == pytest.approx([i * 0.1 for i in range(7)])
+    assert writer.stats()["written"] == 7 and writer.stats()["backlog"] == 0
+    writer.stop()
+
+
+def test_partial_batch_written_after_flush_interval(db):
+    writer = TickWriter(batch_size=100, flush_ms=50)
+    _enqueue(writer, 1)
+    assert writer.flush(timeout=2)
+    assert [len(b) for b in db.batches] == [1]
+    writer.stop()
+
+
+def test_flush_error_drops_batch_and_recovers(db):
+    writer = TickWriter(batch_size=10, flush_ms=20)
+    db.fail = 1
+    _enqueue(writer, 1)
+    assert writer.flush(timeout=2)
+    assert writer.errors == 1 and writer.dropped == 1 and "db down" in writer.last_error
+
+    _enqueue(writer, 2)
+    assert writer.flush(timeout=2)
+    assert writer.written == 1
+    writer.stop()
+
+
+def test_full_queue_drops_new_ticks(db):
+    writer = TickWriter(batch_size=1, flush_ms=20, queue_max=1)
+    db.gate.clear()
+    assert _enqueue(writer, 1)
+    # 等后台线程把第 1 条取走、卡在写库上
+    for _ in range(100):
+        if writer._queue.qsize() == 0:
+            break
+        threading.Event().wait(0.01)
+    assert _enqueue(writer, 2)         # 占满队列
+    assert not _enqueue(writer, 3)     # 丢弃
+    assert writer.dropped == 1
+    db.gate.set()
+    assert writer.flush(timeout=2)
+    assert writer.written == 2
+    writer.stop()
+
+
+def test_rollup_buckets_use_session_start(db):
+    writer = TickWriter(batch_size=10, flush_ms=20)
+    started = 1_699_999_980.0   # 整分钟
+    writer.enqueue(5, 0, 59.9, {"pct": 10.0, "level": 1}, {}, {}, camera_id="cam", started_ts=started)
+    writer.enqueue(5, 0, 60.2, {"pct": 30.0, "level": 4}, {}, {}, camera_id="cam", started_ts=started)
+    assert writer.flush(timeout=2)
+    minutes = sorted(r for r in db.rollups if r[0] == "minute")
+    # FLOOR(video_sec)：59.9 s 在第一分钟，60.2 s 在第二分钟
+    assert [(r[4], r[6], r[8]) for r in minutes] == [(1, 10, 1), (1, 30, 4)]
+    hours = [r for r in db.rollups if r[0] == "hour"]
+    assert len(hours) == 1 and hours[0][4] == 2 and hours[0][3] == "cam"
+    writer.stop()
+
+
+def test_ticks_without_session_are_ignored(db):
+    writer = TickWriter()
+    assert not writer.enqueue(0, 0, 0.0, {}, {}, {})
+    assert writer.enqueued == 0
@@ -0,0 +1,116 @@
+import asyncio
+import io
+import tempfile
+
+import pytest
+
+from server.utils import upload_spool
+from server.utils.upload_spool import (
+    UploadTooLarge,
+    request_limit,
+    spool_stream,
+    spool_upload,
+    upload_view,
+)
+
+
+@pytest.fixture(autouse=True)
+def spool_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(upload_spool, "SPOOL_DIR", tmp_path / "spool")
+    monkeypatch.setattr(upload_spool, "UPLOAD_CHUNK", 1000)
+    return tmp_path / "spool"
+
+
+class _Upload:
+    """只实现 UploadFile.read(size)，记录读了多少次"""
+
+    def __init__(self, data: bytes):
+        self.buf = io.BytesIO(data)
+        self.reads = 0
+
+    async def read(self, size=-1):
+        self.reads += 1
+        return self.buf.read(size)
+
+
+def test_spool_upload_writes_in_chunks(spool_dir):
+    data = bytes(range(256)) * 20   # 5120 字节
+    up = _Upload(data)
+    path = asyncio.run(spool_upload(up, 10_000, ".mp4"))
+    assert path.parent == spool_dir and path.suffix == ".mp4"
+    assert path.read_bytes() == data
+    assert up.reads == 7   # 6 块 + 一次读到结尾
+
+
+def test_spool_upload_over_limit_stops_early_and_cleans_up(spool_dir):
+    up = _Upload(b"x" * 50_000)
+    with pytest.raises(UploadTooLarge) as exc:
+        asyncio.run(spool_upload(up, 2500, ".mp4"))
+    assert exc.value.status_code == 413 and exc.value.limit == 2500
+    # 超限的那一块就停，不会把整份读完；半截文件已删除
+    assert up.reads == 3
+    assert list(spool_dir.iterdir()) == []
+
+
+def test_spool_upload_cancelled_cleans_up(spool_dir):
+    class _Broken(_Upload):
+        async def read(self, size=-1):
+            if self.reads:
+                raise asyncio.CancelledError()
+            return await super().read(size)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(spool_upload(_Broken(b"y" * 5000), 10_000, ".ts"))
+    assert list(spool_dir.iterdir()) == []
+
+
+def test_spool_stream_keeps_file_for_caller(tmp_path):
+    async def chunks():
+        for part in (b"ab", b"", b"cd"):
+            yield part
+
+    path = tmp_path / "raw.ts"
+    assert asyncio.run(spool_stream(chunks(), path, 4)) == 4
+    assert path.read_bytes() == b"abcd"
+
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(spool_stream(chunks(), path, 3))
+    # 失败时由调用方清理
+    assert path.exists()
+
+
+def test_upload_view_in_memory():
+    f = io.BytesIO(b"hello")
+    f.seek(3)
+    with upload_view(f, 5) as view:
+        assert bytes(view) == b"hello"
+    with pytest.raises(UploadTooLarge):
+        with upload_view(f, 4):
+            pass
+    with upload_view(io.BytesIO(), 4) as view:
+        assert len(view) == 0
+
+
+def test_upload_view_spooled_to_disk():
+    # Starlette 上传缓存超过内存阈值后落盘：走 mmap
+    f = tempfile.SpooledTemporaryFile(max_size=10)
+    f.write(b"z" * 100)
+    f.seek(0)
+    assert not hasattr(f._file, "getbuffer")
+
+    class _UploadFile:
+        file = f
+
+    with upload_view(_UploadFile(), 100) as view:
+        assert view.readonly and bytes(view[:3]) == b"zzz" and len(view) == 100
+    with pytest.raises(UploadTooLarge):
+        with upload_view(_UploadFile(), 99):
+            pass
+    f.close()
+
+
+def test_request_limits_by_path():
+    assert request_limit("/api/infer/video/raw") == upload_spool.MAX_VIDEO_BYTES
+    assert request_limit("/api/infer/image/") > upload_spool.MAX_IMAGE_BYTES
+    assert request_limit("/api/infer/images") > upload_spool.MAX_IMAGES_BYTES
+    assert request_limit("/api/history/sessions") is None
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("ultralytics")
+
+from server.pipeline_dual import _water_mask_and_pct
+
+H, W = 720, 1280
+
+
+def _draw(mask, scale=1.0, top=0):
+    """一块矩形积水 + 一个圆形水坑（原图坐标 × scale，再下移 top 行补边）"""
+    def pt(x, y):
+        return int(round(x * scale)), int(round(y * scale)) + top
+    cv2.rectangle(mask, pt(320, 400), pt(959, 719), 1, thickness=-1)
+    cv2.circle(mask, pt(200, 200), int(round(90 * scale)), 1, thickness=-1)
+    return mask
+
+
+def _full_res_pct():
+    return float(_draw(np.zeros((H, W), np.uint8)).mean() * 100.0)
+
+
+def _result(data):
+    return SimpleNamespace(masks=SimpleNamespace(data=data[None], xy=None))
+
+
+def test_retina_mask_matches_full_resolution():
+    mask, pct, scale = _water_mask_and_pct(_result(_draw(np.zeros((H, W), np.float32))), H, W)
+    assert pct == pytest.approx(_full_res_pct())
+    assert mask.shape == (360, 640) and scale == 0.5
+
+
+def test_lowres_mask_coverage_close_to_full_resolution():
+    # 模型输出 384x640（letterbox：内容 360x640，上下各补 12 行）
+    data = _draw(np.zeros((384, 640), np.float32), scale=0.5, top=12)
+    mask, pct, _ = _water_mask_and_pct(_result(data), H, W)
+    assert abs(pct - _full_res_pct()) < 0.5
+    assert mask.shape == (360, 640)
+    # 补边裁掉后掩膜与原图对齐
+    ref = cv2.resize(_draw(np.zeros((H, W), np.uint8)) * 255, (640, 360), interpolation=cv2.INTER_AREA) > 127
+    assert np.mean((mask > 0) == ref) > 0.99
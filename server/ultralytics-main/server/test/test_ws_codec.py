@@ -0,0 +1,179 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from server.utils import ws_codec
+from server.utils.ws_codec import (
+    KIND_BOXES,
+    KIND_MASK,
+    KIND_MASK_DELTA,
+    KIND_POLYS,
+    MaskDeltaDecoder,
+    MaskDeltaEncoder,
+    decode_tick,
+    encode_tick,
+    rle_decode,
+    rle_encode,
+)
+
+# LEB128 参考值（与 web/src/utils/tickCodec.js 的 decodeMaskRle 逐字节一致）
+VARINTS = [
+    (0, b"\x00"),
+    (1, b"\x01"),
+    (127, b"\x7f"),
+    (128, b"\x80\x01"),
+    (300, b"\xac\x02"),
+    (16384, b"\x80\x80\x01"),
+    (1920 * 1080, b"\x80\xc8\x7e"),
+    (2 ** 32, b"\x80\x80\x80\x80\x10"),
+]
+
+
+@pytest.mark.parametrize("value,encoded", VARINTS)
+def test_varint_reference_bytes(value, encoded):
+    assert ws_codec._varint_encode(np.array([value])) == encoded
+    assert ws_codec._varint_decode(encoded).tolist() == [value]
+
+
+def test_varint_sequence_round_trip():
+    values = np.array([v for v, _ in VARINTS] * 3)
+    blob = ws_codec._varint_encode(values)
+    assert blob == b"".join(e for _, e in VARINTS) * 3
+    assert ws_codec._varint_decode(blob).tolist() == values.tolist()
+
+
+def test_rle_reference_bytes():
+    mask = np.array([[0, 0, 1], [1, 1, 0]], np.uint8)
+    # u16 h | u16 w | u8 首段取值 | 3B 保留 | 游程 2, 3, 1
+    blob = rle_encode(mask)
+    assert blob == b"\x02\x00\x03\x00\x00\x00\x00\x00" + b"\x02\x03\x01"
+    assert (rle_decode(blob) == mask * 255).all()
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (36, 64), (360, 640)])
+def test_rle_round_trip(shape):
+    rng = np.random.default_rng(0)
+    for fill in (0.0, 0.02, 0.5, 1.0):
+        mask = (rng.random(shape) < fill).astype(np.uint8)
+        out = rle_decode(rle_encode(mask))
+        assert out.shape == shape and out.dtype == np.uint8
+        assert ((out > 0) == (mask > 0)).all()
+
+
+def _blob_mask(h, w, cx, cy, r):
+    yy, xx = np.mgrid[:h, :w]
+    return (((xx - cx) ** 2 + (yy - cy) ** 2) <= r * r).astype(np.uint8)
+
+
+def _textured(h=90, w=160, seed=0):
+    """边缘很碎的积水掩膜：关键帧的 RLE 很长"""
+    return (np.random.default_rng(seed).random((h, w)) < 0.3).astype(np.uint8)
+
+
+def _nudge(mask, i):
+    """只改一小块：相邻两帧的差分很短"""
+    out = mask.copy()
+    out[10 + i:14 + i, 20:30] ^= 1
+    return out
+
+
+def test_mask_delta_round_trip():
+    enc, dec = MaskDeltaEncoder(keyframe_every=10), MaskDeltaDecoder()
+    kinds = []
+    base = _textured()
+    for i in range(12):
+        mask = _nudge(base, i)
+        kind, blob = enc.encode(mask)
+        kinds.append(kind)
+        assert ((dec.apply(kind, blob) > 0) == (mask > 0)).all()
+    # 第一帧和每 keyframe_every 帧一个关键帧，其余为差分
+    assert kinds[0] == KIND_MASK and kinds[10] == KIND_MASK
+    assert kinds.count(KIND_MASK_DELTA) == 10
+    assert enc.stats() == {"keyframes": 2, "deltas": 10}
+
+
+def test_mask_delta_falls_back_to_keyframe():
+    enc = MaskDeltaEncoder(keyframe_every=100)
+    enc.encode(_blob_mask(90, 160, 40, 45, 20))
+    # 画面突变：差分比关键帧还长
+    assert enc.encode(_textured(seed=1))[0] == KIND_MASK
+    assert enc.encode(_nudge(_textured(seed=1), 0))[0] == KIND_MASK_DELTA
+    # 尺寸变了 / 客户端要求关键帧
+    small = _textured(45, 80, seed=2)
+    assert enc.encode(small)[0] == KIND_MASK
+    enc.force_key = True
+    assert enc.encode(small)[0] == KIND_MASK
+    assert enc.encode(_nudge(small, 1))[0] == KIND_MASK_DELTA
+
+
+def test_mask_delta_needs_keyframe():
+    kind, blob = KIND_MASK_DELTA, rle_encode(np.zeros((4, 4), np.uint8))
+    with pytest.raises(ValueError):
+        MaskDeltaDecoder().apply(kind, blob)
+
+
+def _tick():
+    return {
+        "type": "tick",
+        "tick_idx": 3,
+        "ts": 1500,
+        "pct": 12.5,
+        "level": 2,
+        "water": {
+            "image_h": 90, "image_w": 160,
+            "polygons": [{"outer": [[0.1, 0.1], [0.5, 0.1], [0.5, 0.5]], "holes": []}],
+            "mask_raw": _blob_mask(90, 160, 80, 45, 20),
+        },
+        "risk": {"det": {"level_max": 2, "boxes_norm": [[0.1, 0.2, 0.3, 0.4, 2]]}},
+    }
+
+
+def test_frame_layout_matches_js_decoder():
+    frame = encode_tick(_tick())
+    # 按 tickCodec.js 的偏移手工解析：magic | u8 ver | u8 n | u32 header_len | header | sections
+    assert frame[:2] == b"FT" and frame[2] == ws_codec.VERSION
+    n_sections = frame[3]
+    (head_len,) = struct.unpack_from("<I", frame, 4)
+    header = json.loads(frame[8:8 + head_len].decode("utf-8"))
+    assert "polygons" not in header["water"] and "mask_raw" not in header["water"]
+    assert "boxes_norm" not in header["risk"]["det"]
+
+    pos, kinds = 8 + head_len, []
+    for _ in range(n_sections):
+        kinds.append(frame[pos])
+        assert frame[pos + 1:pos + 4] == b"\x00\x00\x00"
+        (length,) = struct.unpack_from("<I", frame, pos + 4)
+        pos += 8 + length
+    assert pos == len(frame)
+    assert kinds == [KIND_POLYS, KIND_MASK, KIND_BOXES]
+
+
+def test_tick_round_trip():
+    payload = _tick()
+    msg = decode_tick(encode_tick(payload))
+    assert msg["pct"] == 12.5 and msg["level"] == 2 and msg["tick_idx"] == 3
+    outer = np.asarray(msg["water"]["polygons"][0]["outer"])
+    np.testing.assert_allclose(outer, payload["water"]["polygons"][0]["outer"], atol=1 / 65535)
+    assert ((msg["water"]["mask"] > 0) == (payload["water"]["mask_raw"] > 0)).all()
+    assert msg["risk"]["det"]["boxes_norm"][0][4] == 2
+    assert msg["risk"]["det"]["level_max"] == 2
+
+
+def test_tick_round_trip_with_mask_delta():
+    enc, dec = MaskDeltaEncoder(), MaskDeltaDecoder()
+    base = _textured()
+    for i in range(3):
+        payload = _tick()
+        payload["water"]["mask_raw"] = _nudge(base, i)
+        msg = decode_tick(encode_tick(payload, enc), dec)
+        assert ((msg["water"]["mask"] > 0) == (payload["water"]["mask_raw"] > 0)).all()
+    assert enc.stats()["deltas"] == 2
+
+
+def test_png_mask_is_not_sent_in_binary_frames():
+    payload = _tick()
+    payload["water"]["mask_png_b64"] = "iVBORw0KGgo="
+    msg = decode_tick(encode_tick(payload))
+    assert "mask_png_b64" not in msg["water"]
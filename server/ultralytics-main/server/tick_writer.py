@@ -0,0 +1,192 @@
+# server/tick_writer.py  —— detect_tick 后台批量写库
+#
+# WS 循环里只做 enqueue（不碰数据库、不阻塞事件循环），
+# 后台线程攒够 TICK_BATCH_SIZE 条或等满 TICK_FLUSH_MS 毫秒后，
+# 用一条多值 INSERT（executemany）一次写入，连接从共享连接池借用。
+# 同一次刷盘里顺带把这批 tick 累加进 detect_rollup 的分钟 / 小时桶。
+import math
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+from .database import pooled_conn
+from .db_detect import build_tick_row, save_detect_ticks
+from .db_rollup import aggregate_ticks, upsert_rollups
+
+TICK_BATCH_SIZE = int(os.getenv("TICK_BATCH_SIZE", "200"))
+TICK_FLUSH_MS = float(os.getenv("TICK_FLUSH_MS", "500"))
+TICK_QUEUE_MAX = int(os.getenv("TICK_QUEUE_MAX", "20000"))
+TICK_ROLLUP = (os.getenv("TICK_ROLLUP", "1") == "1")
+
+
+class TickWriter:
+    """
+    enqueue() 线程安全、非阻塞；队列满时丢弃新 tick 并计数
+    """
+
+    def __init__(self,
+                 batch_size: int = TICK_BATCH_SIZE,
+                 flush_ms: float = TICK_FLUSH_MS,
+                 queue_max: int = TICK_QUEUE_MAX):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_ms) / 1000.0)
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, int(queue_max)))
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        # 统计
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.errors = 0
+        self.rollup_rows = 0
+        self.rollup_errors = 0
+        self.last_flush_ms = 0.0
+        self.last_error: Optional[str] = None
+
+    # ---------- 生产端 ----------
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="tick-writer", daemon=True)
+            self._thread.start()
+
+    def enqueue(self,
+                session_id: int,
+                ts_ms: int,
+                video_sec: float,
+                result: dict,
+                water: dict,
+                risk: dict,
+                camera_id: str = "",
+                started_ts: Optional[float] = None) -> bool:
+        """
+        started_ts：detect_session.started_at 的时间戳。预聚合按 started_at + FLOOR(video_sec) 分桶，
+        与 rebuild_session_rollups 从 detect_tick 重算的结果一致；拿不到时退回入队时间
+        """
+        if not session_id:
+            return False
+        self.start()
+        if started_ts is not None:
+            bucket_ts = started_ts + math.floor(video_sec)
+        else:
+            bucket_ts = time.time()
+        try:
+            self._queue.put_nowait((
+                (session_id, ts_ms, video_sec, result, water, risk),
+                camera_id,
+                bucket_ts,
+            ))
+            self.enqueued += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        等待队列里已有的 tick 全部写完（会话结束 / 进程退出时用）
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self._queue.unfinished_tasks == 0:
+                return True
+            time.sleep(0.02)
+        return False
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self.flush(timeout)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    # ---------- 后台线程 ----------
+    def _take_batch(self) -> list:
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.perf_counter() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> None:
+        rows = []
+        rollup_src = []
+        for args, camera_id, bucket_ts in batch:
+            try:
+                row = build_tick_row(*args)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = f"build_tick_row: {e}"
+                continue
+            rows.append(row)
+            # row: session_id, ts_ms, video_sec, water_percent, risk_level, ...
+            rollup_src.append((row[0], camera_id, bucket_ts, row[3], row[4]))
+        if not rows:
+            return
+
+        t0 = time.perf_counter()
+        try:
+            with pooled_conn() as conn:
+                self.written += save_detect_ticks(conn, rows)
+                self.flushes += 1
+                if TICK_ROLLUP:
+                    try:
+                        self.rollup_rows += upsert_rollups(conn, aggregate_ticks(rollup_src))
+                    except Exception as e:
+                        # 聚合失败不影响明细，事后可用 rebuild_session_rollups 补
+                        self.rollup_errors += 1
+                        self.last_error = f"rollup: {e}"
+        except Exception as e:
+            # 这一批丢掉，下一批重新借连接
+            self.errors += 1
+            self.dropped += len(rows)
+            self.last_error = str(e)
+            print("[DB] tick writer flush error:", e)
+        self.last_flush_ms = (time.perf_counter() - t0) * 1000.0
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "backlog": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "rollup_rows": self.rollup_rows,
+            "rollup_errors": self.rollup_errors,
+            "batch_size": self.batch_size,
+            "flush_ms": self.flush_interval * 1000.0,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "last_error": self.last_error,
+        }
+
+
+# 进程内唯一的写库线程
+TICK_WRITER = TickWriter()
@@ -1,83 +1,201 @@
 # server/export_video.py------导出带掩膜的视频
-from pathlib import Path
-from typing import List, Optional
+#
+# 三种后端：
+#   opencv : cv2.VideoCapture 解码 + mp4v 编码（旧实现，没有 ffmpeg 时兜底）
+#   ffmpeg : ffmpeg 多线程解码 → rawvideo 管道 → Python 叠加 → rawvideo 管道 → libx264
+#   filter : 每个 tick 只渲染一张透明叠加图，整段在 ffmpeg 的 overlay 滤镜里合成（tick 稀疏时最快）
+#   auto   : tick 稀疏用 filter，否则 ffmpeg；机器上没有 ffmpeg 时退回 opencv
+import os
+import tempfile
+from typing import Callable, List, Optional
 import cv2
 import numpy as np
 from ..database import get_conn
+from .ffmpeg_io import (
+    ffmpeg_available,
+    read_ffmpeg_frame_into,
+    start_ffmpeg_decoder,
+    start_ffmpeg_encoder,
+    start_ffmpeg_overlay,
+    stop_process,
+)
 from .tick_overlay import parse_tick_row, TickOverlay
 
+EXPORT_BACKENDS = ("auto", "ffmpeg", "filter", "opencv")
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast",
+                "medium", "slow", "slower", "veryslow")
+# 编码线程数，0 = ffmpeg 自动（按 CPU 核数）
+EXPORT_FFMPEG_THREADS = int(os.getenv("EXPORT_FFMPEG_THREADS", "0"))
+# auto 模式下：平均每秒 tick 数不超过该值、且总数不超过上限时走 filter
+EXPORT_FILTER_MAX_TPS = float(os.getenv("EXPORT_FILTER_MAX_TPS", "0.5"))
+EXPORT_FILTER_MAX_TICKS = int(os.getenv("EXPORT_FILTER_MAX_TICKS", "2000"))
+
+
+WATER_COLOR = (255, 0, 0)   # BGR: 蓝
+BOX_COLOR = (0, 0, 255)     # BGR: 红
+TEXT_COLOR = (0, 255, 0)
+FILL_ALPHA = 0.4
+
+
+def _norm_to_px(points, w: int, h: int) -> np.ndarray:
+    """归一化坐标 [[x,y],...] → 像素 int32 (N,2)，一次性向量化裁剪 + 缩放"""
+    arr = np.asarray([p[:2] for p in points if p is not None and len(p) >= 2], dtype=np.float32)
+    if arr.size == 0:
+        return arr.reshape(0, 2).astype(np.int32)
+    arr = np.clip(arr, 0.0, 1.0) * np.array([w, h], dtype=np.float32)
+    return arr.astype(np.int32)
+
+
+class OverlayRenderer:
+    """
+    按 tick 缓存的叠加层渲染器：
+    - set_tick() 时把多边形填充掩膜、描边 / 风险框预先栅格化到覆盖区域（bbox）里
+    - render() 每帧只在 bbox 内做一次 addWeighted + 两次按掩膜拷贝，再写一行文字
+    tick 不变的帧之间不重复做任何 Python 级循环，缓冲区也一直复用
+    """
+
+    def __init__(self, w: int, h: int):
+        self.w = w
+        self.h = h
+        self.ov: Optional[TickOverlay] = None
+        self.roi = None          # (x0, y0, x1, y1)
+        self.fill_mask = None    # bbox 内的填充区域 (bh, bw) uint8
+        self.stroke_mask = None  # bbox 内的描边 / 框 (bh, bw) uint8
+        self.stroke_color = None  # bbox 内描边颜色层 (bh, bw, 3)
+        self.fill_color = None   # bbox 大小的纯色层
+        self.blend_buf = None    # addWeighted 输出缓冲
+        self.text = None
+
+    def set_tick(self, ov: Optional[TickOverlay]) -> None:
+        self.ov = ov
+        self.roi = None
+        self.text = None
+        if ov is None:
+            return
+
+        w, h = self.w, self.h
+        polys = [p for p in (_norm_to_px(poly, w, h) for poly in ov.water_polys if poly) if len(p)]
+
+        boxes = []
+        if ov.risk_boxes:
+            arr = np.asarray([b[:4] for b in ov.risk_boxes if b and len(b) >= 4], dtype=np.float32)
+            if arr.size:
+                arr = np.clip(arr, 0.0, 1.0) * np.array([w, h, w, h], dtype=np.float32)
+                boxes = arr.astype(np.int32).tolist()
+
+        # ----- 左上角文字（每帧用 putText 画，保留抗锯齿） -----
+        texts = []
+        if ov.water_percent is not None:
+            texts.append(f"pct={ov.water_percent:.2f}%")
+        if ov.risk_level is not None:
+            texts.append(f"level={ov.risk_level}")
+        self.text = "  ".join(texts) if texts else None
+
+        if not polys and not boxes:
+            return
+
+        # ----- 覆盖区域：所有多边形 + 框的外接矩形（留出线宽） -----
+        pad = 2
+        xs, ys = [], []
+        for p in polys:
+            xs += [int(p[:, 0].min()), int(p[:, 0].max())]
+            ys += [int(p[:, 1].min()), int(p[:, 1].max())]
+        for x1, y1, x2, y2 in boxes:
+            xs += [x1, x2]
+            ys += [y1, y2]
+        x0 = max(0, min(xs) - pad)
+        y0 = max(0, min(ys) - pad)
+        x1 = min(w, max(xs) + pad + 1)
+        y1 = min(h, max(ys) + pad + 1)
+        if x1 <= x0 or y1 <= y0:
+            return
+        bw, bh = x1 - x0, y1 - y0
+        offset = np.array([x0, y0], dtype=np.int32)
+
+        fill = np.zeros((bh, bw), dtype=np.uint8)
+        stroke = np.zeros((bh, bw), dtype=np.uint8)
+        stroke_color = np.zeros((bh, bw, 3), dtype=np.uint8)
+        if polys:
+            local = [p - offset for p in polys]
+            cv2.fillPoly(fill, local, 255)
+            cv2.polylines(stroke, local, isClosed=True, color=255, thickness=2)
+            cv2.polylines(stroke_color, local, isClosed=True, color=WATER_COLOR, thickness=2)
+        for bx1, by1, bx2, by2 in boxes:
+            pt1, pt2 = (bx1 - x0, by1 - y0), (bx2 - x0, by2 - y0)
+            cv2.rectangle(stroke, pt1, pt2, 255, 2)
+            cv2.rectangle(stroke_color, pt1, pt2, BOX_COLOR, 2)
+
+        self.roi = (x0, y0, x1, y1)
+        self.fill_mask = fill if polys else None
+        self.stroke_mask = stroke
+        self.stroke_color = stroke_color
+        # 纯色层 / 混合缓冲按 bbox 尺寸复用，尺寸变了才重新分配
+        if self.fill_color is None or self.fill_color.shape[:2] != (bh, bw):
+            self.fill_color = np.empty((bh, bw, 3), dtype=np.uint8)
+            self.fill_color[:] = WATER_COLOR
+            self.blend_buf = np.empty((bh, bw, 3), dtype=np.uint8)
+
+    def render(self, frame) -> None:
+        if self.ov is None:
+            return
+
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            region = frame[y0:y1, x0:x1]
+            # ----- 掩膜多边形：半透明蓝色，只在 bbox 内混合 -----
+            # （cv2.copyTo 直接写回 frame 的 ROI 视图，不产生整帧拷贝）
+            if self.fill_mask is not None:
+                cv2.addWeighted(region, 1.0 - FILL_ALPHA, self.fill_color, FILL_ALPHA, 0, dst=self.blend_buf)
+                cv2.copyTo(self.blend_buf, self.fill_mask, region)
+            # ----- 多边形描边 + 风险框 -----
+            cv2.copyTo(self.stroke_color, self.stroke_mask, region)
+
+        if self.text:
+            cv2.putText(
+                frame,
+                self.text,
+                (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.8,
+                TEXT_COLOR,
+                2,
+                cv2.LINE_AA,
+            )
+
+    def layer_bgra(self) -> np.ndarray:
+        """
+        当前 tick 的整帧透明叠加层（BGRA，非预乘 alpha），给 ffmpeg overlay 滤镜用：
+        填充区 alpha = FILL_ALPHA，描边 / 框 / 文字不透明
+        """
+        layer = np.zeros((self.h, self.w, 4), dtype=np.uint8)
+        if self.ov is None:
+            return layer
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            region = layer[y0:y1, x0:x1]
+            if self.fill_mask is not None:
+                sel = self.fill_mask > 0
+                region[sel] = (*WATER_COLOR, int(round(255 * FILL_ALPHA)))
+            sel = self.stroke_mask > 0
+            region[sel, :3] = self.stroke_color[sel]
+            region[sel, 3] = 255
+        if self.text:
+            cv2.putText(layer, self.text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.8, (*TEXT_COLOR, 255), 2, cv2.LINE_AA)
+        return layer
+
 
 def draw_overlay_cv2(frame, ov: TickOverlay):
     """
     在单帧上画 water_polys + risk_boxes + 文本。
-    ov 水平是 TickOverlay。
+    ov 水平是 TickOverlay。（单帧用；整段导出请复用 OverlayRenderer）
     """
     if ov is None:
         return
-
     h, w = frame.shape[:2]
-
-    # ----- 掩膜多边形 -----
-    polys = []
-    for poly in ov.water_polys:
-        if not poly:
-            continue
-        pts = []
-        for pt in poly:
-            if pt is None or len(pt) < 2:
-                continue
-            nx = max(0.0, min(1.0, float(pt[0])))
-            ny = max(0.0, min(1.0, float(pt[1])))
-            x = int(nx * w)
-            y = int(ny * h)
-            pts.append([x, y])
-        if pts:
-            polys.append(pts)
-
-    if polys:
-        pts_arr = [np.array(p, dtype=np.int32) for p in polys]
-        # 半透明蓝色区域
-        mask = frame.copy()
-        cv2.fillPoly(mask, pts_arr, (255, 0, 0))  # BGR: 蓝
-        frame[:] = cv2.addWeighted(frame, 0.6, mask, 0.4, 0)
-
-        for p in pts_arr:
-            cv2.polylines(frame, [p], isClosed=True, color=(255, 0, 0), thickness=2)
-
-    # ----- 风险框 -----
-    for box in ov.risk_boxes:
-        if not box or len(box) < 4:
-            continue
-
-        nx1 = max(0.0, min(1.0, float(box[0])))
-        ny1 = max(0.0, min(1.0, float(box[1])))
-        nx2 = max(0.0, min(1.0, float(box[2])))
-        ny2 = max(0.0, min(1.0, float(box[3])))
-
-        x1 = int(nx1 * w)
-        y1 = int(ny1 * h)
-        x2 = int(nx2 * w)
-        y2 = int(ny2 * h)
-
-        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
-
-    # ----- 左上角文字 -----
-    texts = []
-    if ov.water_percent is not None:
-        texts.append(f"pct={ov.water_percent:.2f}%")
-    if ov.risk_level is not None:
-        texts.append(f"level={ov.risk_level}")
-    if texts:
-        cv2.putText(
-            frame,
-            "  ".join(texts),
-            (10, 30),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            0.8,
-            (0, 255, 0),
-            2,
-            cv2.LINE_AA,
-        )
+    renderer = OverlayRenderer(w, h)
+    renderer.set_tick(ov)
+    renderer.render(frame)
 
 
 def load_ticks_for_session(session_id: int) -> List[TickOverlay]:
@@ -105,18 +223,175 @@ def load_ticks_for_session(session_id: int) -> List[TickOverlay]:
         conn.close()
 
 
+def _probe(src_path: str):
+    cap = cv2.VideoCapture(src_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"无法打开视频: {src_path}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 5.0
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    finally:
+        cap.release()
+    return fps, w, h, total_frames
+
+
+def resolve_backend(backend: str, overlays: List[TickOverlay], duration: float) -> str:
+    """
+    auto → filter / ffmpeg；没有 ffmpeg 时一律退回 opencv
+    """
+    if backend not in EXPORT_BACKENDS:
+        raise ValueError(f"unknown export backend: {backend}")
+    if backend == "opencv" or not ffmpeg_available():
+        return "opencv"
+    if backend != "auto":
+        return backend
+    sparse = (
+        len(overlays) <= EXPORT_FILTER_MAX_TICKS
+        and duration > 0
+        and len(overlays) / duration <= EXPORT_FILTER_MAX_TPS
+    )
+    return "filter" if sparse else "ffmpeg"
+
+
 def export_video_with_ticks(
     session_id: int,
     src_path: str,
     out_path: str,
+    progress_cb: Optional[Callable[[float], None]] = None,
+    overlays: Optional[List[TickOverlay]] = None,
+    backend: str = "opencv",
+    preset: str = "veryfast",
+    crf: int = 23,
 ):
     """
     使用 detect_tick 表，而不是重跑模型。
+    progress_cb(0~1)：每处理一小段帧回调一次进度
+    overlays：调用方已经查好的 tick 可直接传入，避免重复查库
+    backend / preset / crf：见文件头说明；preset / crf 只对 ffmpeg / filter 生效
     """
-    overlays: List[TickOverlay] = load_ticks_for_session(session_id)
+    if overlays is None:
+        overlays = load_ticks_for_session(session_id)
     if not overlays:
         raise RuntimeError("该 session 没有 detect_tick 数据")
 
+    fps, w, h, total_frames = _probe(src_path)
+    duration = total_frames / fps if total_frames > 0 else 0.0
+    backend = resolve_backend(backend, overlays, duration)
+
+    if backend == "ffmpeg":
+        _export_ffmpeg_pipe(src_path, out_path, overlays, fps, w, h, total_frames,
+                            progress_cb, preset, crf)
+    elif backend == "filter":
+        _export_ffmpeg_filter(src_path, out_path, overlays, w, h, duration,
+                              progress_cb, preset, crf)
+    else:
+        _export_opencv(src_path, out_path, overlays, progress_cb)
+
+    if progress_cb is not None:
+        progress_cb(1.0)
+
+
+def _tick_frames(overlays: List[TickOverlay], fps: float):
+    """
+    逐帧给出应叠加的 tick 下标（t 之前最后一个 tick；第一个 tick 之前用第一个）
+    """
+    cur_idx = 0
+    n_tick = len(overlays)
+    frame_idx = 0
+    while True:
+        t = frame_idx / fps
+        while cur_idx + 1 < n_tick and overlays[cur_idx + 1].t <= t:
+            cur_idx += 1
+        yield cur_idx
+        frame_idx += 1
+
+
+def _export_ffmpeg_pipe(src_path, out_path, overlays, fps, w, h, total_frames,
+                        progress_cb, preset, crf):
+    """
+    解码、编码都交给 ffmpeg 子进程（各自多线程），Python 只负责在复用的帧缓冲上画叠加层
+    """
+    decoder = start_ffmpeg_decoder(src_path, w, h, threads=EXPORT_FFMPEG_THREADS)
+    encoder = start_ffmpeg_encoder(out_path, w, h, fps, preset=preset, crf=crf,
+                                   threads=EXPORT_FFMPEG_THREADS)
+    frame = np.empty((h, w, 3), dtype=np.uint8)
+    renderer = OverlayRenderer(w, h)
+    rendered_idx = -1
+    frame_idx = 0
+    try:
+        for cur_idx in _tick_frames(overlays, fps):
+            if not read_ffmpeg_frame_into(decoder, frame):
+                break
+            if cur_idx != rendered_idx:
+                renderer.set_tick(overlays[cur_idx])
+                rendered_idx = cur_idx
+            renderer.render(frame)
+            try:
+                encoder.stdin.write(memoryview(frame).cast("B"))
+            except BrokenPipeError:
+                break
+            frame_idx += 1
+            if progress_cb is not None and total_frames > 0 and frame_idx % 30 == 0:
+                progress_cb(min(1.0, frame_idx / total_frames))
+    finally:
+        stop_process(decoder)
+        try:
+            encoder.stdin.close()
+        except Exception:
+            pass
+
+    _, err = encoder.communicate()
+    if encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg 编码失败: {(err or b'').decode('utf-8', 'replace').strip()[-500:]}")
+    if frame_idx == 0:
+        raise RuntimeError(f"无法解码视频: {src_path}")
+
+
+def _export_ffmpeg_filter(src_path, out_path, overlays, w, h, duration,
+                          progress_cb, preset, crf):
+    """
+    每个 tick 渲染一张 PNG（透明底），写成 concat 列表（带每张的持续时间），
+    ffmpeg 解码 → overlay → 编码全程不经过 Python
+    """
+    renderer = OverlayRenderer(w, h)
+    with tempfile.TemporaryDirectory(prefix="export_ov_") as tmp:
+        lines = ["ffconcat version 1.0"]
+        for i, ov in enumerate(overlays):
+            renderer.set_tick(ov)
+            png = os.path.join(tmp, f"ov_{i:06d}.png")
+            cv2.imwrite(png, renderer.layer_bgra())
+            lines.append(f"file '{png}'")
+            # 第一张从 0 秒开始显示（和逐帧后端一致），最后一张一直持续到视频结束
+            start = 0.0 if i == 0 else max(0.0, ov.t)
+            end = overlays[i + 1].t if i + 1 < len(overlays) else max(duration, start + 1.0)
+            lines.append(f"duration {max(0.001, end - start):.6f}")
+        # concat 要求最后一项重复一次，最后一张的持续时间才会生效
+        lines.append(f"file '{png}'")
+        list_path = os.path.join(tmp, "overlays.ffconcat")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+        proc = start_ffmpeg_overlay(src_path, list_path, out_path, preset=preset, crf=crf,
+                                    threads=EXPORT_FFMPEG_THREADS)
+        try:
+            for line in proc.stdout:
+                key, _, value = line.strip().partition("=")
+                if key == "out_time_us" and progress_cb is not None and duration > 0:
+                    try:
+                        progress_cb(min(1.0, int(value) / 1e6 / duration))
+                    except ValueError:
+                        pass
+            _, err = proc.communicate()
+        except BaseException:
+            stop_process(proc)
+            raise
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg 合成失败: {(err or '').strip()[-500:]}")
+
+
+def _export_opencv(src_path, out_path, overlays, progress_cb):
     cap = cv2.VideoCapture(src_path)
     if not cap.isOpened():
         raise RuntimeError(f"无法打开视频: {src_path}")
@@ -124,6 +399,7 @@ def export_video_with_ticks(
     fps = cap.get(cv2.CAP_PROP_FPS) or 5.0
     w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
 
     fourcc = cv2.VideoWriter_fourcc(*"mp4v")
     writer = cv2.VideoWriter(out_path, fourcc, fps, (w, h))
@@ -131,29 +407,27 @@ def export_video_with_ticks(
         cap.release()
         raise RuntimeError(f"无法创建输出视频: {out_path}")
 
-    cur_idx = 0
-    n_tick = len(overlays)
     frame_idx = 0
+    renderer = OverlayRenderer(w, h)
+    rendered_idx = -1
+    frame = None  # cap.read 复用同一块帧缓冲
 
-    while True:
-        ok, frame = cap.read()
+    for cur_idx in _tick_frames(overlays, fps):
+        ok, frame = cap.read(frame)
         if not ok:
             break
 
-        # 当前帧时间（秒）
-        t = frame_idx / fps
-
-        # 找 t 之前最后一个 tick
-        while cur_idx + 1 < n_tick and overlays[cur_idx + 1].t <= t:
-            cur_idx += 1
-
-        ov: Optional[TickOverlay] = overlays[cur_idx] if n_tick > 0 else None
-        if ov:
-            draw_overlay_cv2(frame, ov)
+        # tick 变了才重新栅格化叠加层
+        if cur_idx != rendered_idx:
+            renderer.set_tick(overlays[cur_idx])
+            rendered_idx = cur_idx
+        renderer.render(frame)
 
         writer.write(frame)
         frame_idx += 1
 
+        if progress_cb is not None and total_frames > 0 and frame_idx % 30 == 0:
+            progress_cb(min(1.0, frame_idx / total_frames))
+
     cap.release()
     writer.release()
-
@@ -0,0 +1,278 @@
+# server/utils/ffmpeg_io.py  —— ffmpeg 子进程相关的小工具（拉流解码 / 录像 / 管道编码）
+from pathlib import Path
+from typing import Optional
+import shutil
+import subprocess
+import numpy as np
+
+# HLS 转帧的目标分辨率（可以按需调整）
+HLS_WIDTH = 640
+HLS_HEIGHT = 360
+
+
+def model_frame_size(imgsz: int) -> tuple:
+    """
+    按模型输入尺寸算 ffmpeg 输出帧大小：长边 = imgsz，宽高比同 HLS_WIDTH:HLS_HEIGHT，
+    这样 ultralytics letterbox 时不用再缩放（只补边到 32 的倍数）
+    """
+    imgsz = int(imgsz or HLS_WIDTH)
+    height = int(round(imgsz * HLS_HEIGHT / HLS_WIDTH / 2.0)) * 2
+    return imgsz, max(2, height)
+
+
+def start_ffmpeg_hls(url: str, width: int, height: int, pix_fmt: str = "bgr24") -> subprocess.Popen:
+    """
+    用 ffmpeg 拉取 HLS(m3u8)，输出 BGR24（或 pix_fmt 指定的 rgb24）rawvideo 到 stdout
+    ffmpeg -i <url> -f rawvideo -pix_fmt bgr24 -vf scale=WxH -
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-i", url,
+        "-an",  # 不要音频
+        "-f", "rawvideo",
+        "-pix_fmt", pix_fmt,
+        "-vf", f"scale={width}:{height}",
+        "-"
+    ]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def start_ffmpeg_hls_tee(url: str, width: int, height: int,
+                         segment_dir: str, segment_sec: int = 10,
+                         pix_fmt: str = "bgr24") -> subprocess.Popen:
+    """
+    一次拉流、两路输出（替代 start_ffmpeg_hls + start_ffmpeg_recorder 两个进程）：
+      1) 原始码流直接 remux（-c copy，不重新编码）成滚动的分段 MP4，
+         文件名为分段开始的本地时间 %Y%m%d_%H%M%S.mp4；分段用 fragmented MP4，
+         正在写的那一段也能被读取
+      2) 缩放后的 rawvideo（BGR24 / pix_fmt 指定的 rgb24）输出到 stdout 给推理用
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-i", url,
+        # ---- 输出 1：分段录像（stream copy）----
+        "-map", "0:v:0",
+        "-map", "0:a:0?",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", str(int(segment_sec)),
+        "-segment_format", "mp4",
+        "-segment_format_options", "movflags=+frag_keyframe+empty_moov+default_base_moof",
+        "-reset_timestamps", "1",
+        "-strftime", "1",
+        f"{segment_dir}/%Y%m%d_%H%M%S.mp4",
+        # ---- 输出 2：推理用 rawvideo ----
+        "-map", "0:v:0",
+        "-an",
+        "-f", "rawvideo",
+        "-pix_fmt", pix_fmt,
+        "-vf", f"scale={width}:{height}",
+        "-",
+    ]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+def concat_segments(segments: list, out_path: str, inpoint: float = 0.0,
+                    duration: Optional[float] = None, timeout: float = 600.0) -> bool:
+    """
+    把若干分段 MP4 无损拼接成一个文件（concat demuxer + -c copy + faststart）
+    inpoint：第一段内的起点（秒）；duration：输出总时长（秒）
+    stream copy 只能从关键帧切，起点会向前对齐到最近的关键帧
+    """
+    if not segments:
+        return False
+    list_path = f"{out_path}.concat.txt"
+    lines = ["ffconcat version 1.0"]
+    for i, seg in enumerate(segments):
+        lines.append("file '{}'".format(str(seg).replace("'", "'\\''")))
+        if i == 0 and inpoint > 0:
+            lines.append(f"inpoint {inpoint:.3f}")
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+    cmd = ["ffmpeg", "-loglevel", "error", "-y", "-f", "concat", "-safe", "0", "-i", list_path]
+    if duration is not None and duration > 0:
+        cmd += ["-t", f"{duration:.3f}"]
+    cmd += ["-c", "copy", "-movflags", "+faststart", out_path]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        if proc.returncode != 0:
+            print("[REC] concat error:", proc.stderr.decode("utf-8", "replace").strip()[-300:])
+        return proc.returncode == 0
+    except Exception as e:
+        print("[REC] concat error:", e)
+        return False
+    finally:
+        try:
+            Path(list_path).unlink()
+        except Exception:
+            pass
+
+
+def start_ffmpeg_recorder(input_url: str, out_path: str, fps: Optional[float] = None) -> subprocess.Popen:
+    """
+    用 ffmpeg 录制一份 H.264 + AAC 的 MP4 文件
+
+    示例等价命令：
+    ffmpeg -y -i <input> -r <fps?> -c:v libx264 -pix_fmt yuv420p -c:a aac -b:a 128k -movflags +faststart out.mp4
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-y",               # 覆盖已有文件
+        "-i", input_url,
+    ]
+
+    # 可选：根据参数控制输出帧率（和前端设置的 fps 对齐）
+    if fps and fps > 0:
+        cmd += ["-r", str(float(fps))]
+
+    cmd += [
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac",
+        "-b:a", "128k",
+        "-movflags", "+faststart",
+        out_path,
+    ]
+
+    # 录制只要后台安静跑，不需要 stdout/stderr
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def start_ffmpeg_decoder(path: str, width: int, height: int, threads: int = 0) -> subprocess.Popen:
+    """
+    用 ffmpeg（多线程）解码本地视频文件，输出 BGR24 rawvideo 到 stdout，
+    帧按原样逐帧输出（不补帧、不丢帧），尺寸强制为 width x height
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-threads", str(int(threads)),
+        "-i", path,
+        "-an",
+        "-vsync", "passthrough",
+        "-vf", f"scale={width}:{height}",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-",
+    ]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            bufsize=width * height * 3)
+
+
+def _x264_args(preset: str, crf: int, threads: int) -> list:
+    return [
+        "-c:v", "libx264",
+        "-preset", str(preset),
+        "-crf", str(int(crf)),
+        "-threads", str(int(threads)),
+        "-pix_fmt", "yuv420p",
+        "-movflags", "+faststart",
+        "-f", "mp4",
+    ]
+
+
+# yuv420p 要求宽高为偶数
+_EVEN_SCALE = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+
+def start_ffmpeg_encoder(out_path: str, width: int, height: int, fps: float,
+                         preset: str = "veryfast", crf: int = 23, threads: int = 0) -> subprocess.Popen:
+    """
+    从 stdin 读 BGR24 rawvideo，用 libx264 编成浏览器可直接播放的 MP4（faststart）
+
+    示例等价命令：
+    ffmpeg -f rawvideo -pix_fmt bgr24 -s WxH -r <fps> -i - -c:v libx264 -preset <p> -crf <q> -movflags +faststart out.mp4
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-y",
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-s", f"{width}x{height}",
+        "-r", str(float(fps)),
+        "-i", "-",
+        "-vf", _EVEN_SCALE,
+    ] + _x264_args(preset, crf, threads) + [out_path]
+    # stderr 只在 loglevel=error 时有少量输出，结束后读出来用于报错
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def start_ffmpeg_overlay(src_path: str, concat_list: str, out_path: str,
+                         preset: str = "veryfast", crf: int = 23, threads: int = 0) -> subprocess.Popen:
+    """
+    整段在 ffmpeg 里合成：源视频 + 一组带透明通道的叠加图（concat 列表，每张图带持续时间），
+    overlay 滤镜在每个时刻取最近一张叠加图。进度以 key=value 形式写到 stdout（-progress）
+    """
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-y",
+        "-nostats",
+        "-progress", "pipe:1",
+        "-threads", str(int(threads)),
+        "-i", src_path,
+        "-f", "concat", "-safe", "0", "-i", concat_list,
+        "-filter_complex", f"[0:v][1:v]overlay=0:0:eof_action=repeat:format=auto,{_EVEN_SCALE}[v]",
+        "-map", "[v]",
+        "-an",
+    ] + _x264_args(preset, crf, threads) + [out_path]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def read_ffmpeg_frame_into(proc: subprocess.Popen, buf: np.ndarray) -> bool:
+    """
+    从 ffmpeg stdout 读一帧 rawvideo 直接写进已分配好的 buf（C 连续 uint8），不产生新数组
+    """
+    if proc.stdout is None:
+        return False
+    view = memoryview(buf).cast("B")
+    got, total = 0, view.nbytes
+    while got < total:
+        n = proc.stdout.readinto(view[got:])
+        if not n:
+            return False
+        got += n
+    return True
+
+
+def read_ffmpeg_frame(proc: subprocess.Popen, width: int, height: int):
+    """
+    从 ffmpeg stdout 读一帧 rawvideo，返回 (ok, frame)
+    """
+    frame_size = width * height * 3
+    if proc.stdout is None:
+        return False, None
+    data = proc.stdout.read(frame_size)
+    if not data or len(data) < frame_size:
+        return False, None
+    frame = np.frombuffer(data, dtype=np.uint8)
+    if frame.size != frame_size:
+        return False, None
+    frame = frame.reshape((height, width, 3))
+    return True, frame
+
+
+def stop_process(proc: Optional[subprocess.Popen], timeout: float = 3.0) -> None:
+    """
+    先 terminate 等待退出，超时再 kill；任何异常都吞掉
+    """
+    if proc is None:
+        return
+    try:
+        proc.terminate()
+        proc.wait(timeout=timeout)
+    except Exception:
+        try:
+            proc.kill()
+        except Exception:
+            pass
@@ -0,0 +1,128 @@
+# server/utils/frame_reader.py  —— ffmpeg rawvideo 管道的后台读帧线程
+#
+# 阻塞的 stdout.read 放到独立线程里做，事件循环只 await “最新一帧”：
+#   - 预分配 slots 块帧缓冲（环形），读线程用 readinto 直接写进空闲的那块
+#   - 只保留最新一帧：消费方来不及取时，旧帧直接被覆盖（drop-oldest）并计数
+#   - 消费方拿到的是租借（lease）的缓冲，release 之前读线程不会覆盖它
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from .ffmpeg_io import read_ffmpeg_frame_into
+
+
+@dataclass
+class FrameLease:
+    frame: np.ndarray   # 指向环形缓冲的视图，release 后不要再用
+    seq: int            # 读到的第几帧（从 1 开始）
+    ts: float           # 读完这一帧时的 time.perf_counter()
+    slot: int
+
+
+class FrameReader:
+    def __init__(self, proc, width: int, height: int, slots: int = 3, channels: int = 3):
+        self.proc = proc
+        self.width = width
+        self.height = height
+        # 至少 3 块：一块正在写、一块是已发布的最新帧、一块被消费方租着
+        self._bufs = [np.empty((height, width, channels), dtype=np.uint8) for _ in range(max(3, slots))]
+        self._lock = threading.Lock()
+        self._latest: Optional[FrameLease] = None
+        self._leased: set = set()
+        self._consumed_seq = 0
+        self._seq = 0
+        self._eof = False
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+
+        # 统计
+        self.frames_read = 0
+        self.frames_dropped = 0  # 还没被取走就被更新的一帧覆盖掉的帧数
+
+    # ---------- 读线程 ----------
+    def start(self) -> "FrameReader":
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._thread = threading.Thread(target=self._run, name="ffmpeg-reader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _free_slot(self) -> int:
+        with self._lock:
+            busy = set(self._leased)
+            if self._latest is not None:
+                busy.add(self._latest.slot)
+        for i in range(len(self._bufs)):
+            if i not in busy:
+                return i
+        raise RuntimeError("no free frame slot")  # slots >= 3 且只有一个消费方时不会发生
+
+    def _run(self) -> None:
+        try:
+            while not self._stop:
+                slot = self._free_slot()
+                if not read_ffmpeg_frame_into(self.proc, self._bufs[slot]):
+                    break
+                now = time.perf_counter()
+                with self._lock:
+                    self._seq += 1
+                    if self._latest is not None and self._latest.seq > self._consumed_seq:
+                        self.frames_dropped += 1
+                    self._latest = FrameLease(self._bufs[slot], self._seq, now, slot)
+                self.frames_read += 1
+                self._notify()
+        except Exception as e:
+            print("[READER] ffmpeg read error:", e)
+        finally:
+            self._eof = True
+            self._notify()
+
+    def _notify(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    # ---------- 消费方（事件循环里调用） ----------
+    async def get(self) -> Optional[FrameLease]:
+        """
+        等待并租借比上次取走的更新的最新一帧；流结束返回 None
+        """
+        while True:
+            with self._lock:
+                latest = self._latest
+                if latest is not None and latest.seq > self._consumed_seq:
+                    self._consumed_seq = latest.seq
+                    self._leased.add(latest.slot)
+                    return latest
+            if self._eof:
+                return None
+            self._event.clear()
+            # clear 之后再检查一次，避免错过 clear 前刚到的通知
+            with self._lock:
+                fresh = self._latest is not None and self._latest.seq > self._consumed_seq
+            if not fresh and not self._eof:
+                await self._event.wait()
+
+    def release(self, lease: Optional[FrameLease]) -> None:
+        if lease is None:
+            return
+        with self._lock:
+            self._leased.discard(lease.slot)
+
+    def close(self) -> None:
+        """读线程阻塞在 read 上，进程退出（stdout 关闭）后自然结束"""
+        self._stop = True
+
+    def stats(self) -> dict:
+        return {
+            "frames_read": self.frames_read,
+            "frames_dropped": self.frames_dropped,
+            "eof": self._eof,
+        }
@@ -0,0 +1,183 @@
+# server/utils/geom_codec.py  —— detect_tick 几何数据的紧凑编码
+#
+# 多边形 / 风险框的坐标本来就是 0~1 的归一化值，量化成 uint16（精度 1/65535，
+# 1080p 下远小于一个像素）后按小端打包，再 base64 成 "q16:..." 文本存进原来的
+# TEXT 列。解码函数同时兼容旧的 JSON 文本行，调用方不用区分。
+#
+# 二进制布局（全部为 little-endian uint16）：
+#   多边形: "FP" ver | n_polys | { n_rings | { n_pts | x0 y0 x1 y1 ... } * n_rings } * n_polys
+#           每个多边形第一个 ring 是 outer，其余为 holes
+#   风险框: "FB" ver | n_boxes | { x1 y1 x2 y2 level } * n_boxes
+# 各个计数都是 uint16，超过 65535 时编码函数抛 GeomOverflow，调用方改存 / 改发 JSON。
+import base64
+import json
+import struct
+from typing import List, Optional, Union
+
+import numpy as np
+
+TEXT_PREFIX = "q16:"
+POLY_MAGIC = b"FP"
+BOX_MAGIC = b"FB"
+VERSION = 1
+_HEADER = struct.Struct("<2sBx")  # magic, version, pad（对齐到 uint16）
+_Q = 65535.0
+_MAX_COUNT = 0xFFFF
+
+
+class GeomOverflow(ValueError):
+    """多边形 / 环 / 点 / 框的个数超出 uint16，放不进紧凑编码"""
+
+
+def _count(n: int, what: str) -> np.ndarray:
+    if n > _MAX_COUNT:
+        raise GeomOverflow(f"too many {what} for q16 encoding: {n} > {_MAX_COUNT}")
+    return np.array([n], dtype="<u2")
+
+
+def _quantize(points) -> np.ndarray:
+    arr = np.asarray(points, dtype=np.float64).reshape(-1)
+    return np.clip(np.rint(arr * _Q), 0, _Q).astype("<u2")
+
+
+def _dequantize(arr: np.ndarray) -> list:
+    return (arr.astype(np.float64) / _Q).tolist()
+
+
+# ---------- 编码 ----------
+def encode_polys(polys: list) -> Optional[bytes]:
+    """
+    polys: mask_to_polygons 的输出 [{"outer": [[x,y],...], "holes": [[[x,y],...], ...]}, ...]
+           也接受纯点列表 [[[x,y],...], ...]（视为只有 outer）
+    """
+    if not polys:
+        return None
+    parts: List[np.ndarray] = [_count(len(polys), "polygons")]
+    for poly in polys:
+        if isinstance(poly, dict):
+            rings = [poly.get("outer") or []] + list(poly.get("holes") or [])
+        else:
+            rings = [poly]
+        parts.append(_count(len(rings), "rings"))
+        for ring in rings:
+            parts.append(_count(len(ring), "points"))
+            if len(ring):
+                parts.append(_quantize([pt[:2] for pt in ring]))
+    return _HEADER.pack(POLY_MAGIC, VERSION) + np.concatenate(parts).tobytes()
+
+
+def encode_boxes(boxes: list) -> Optional[bytes]:
+    """
+    boxes: [[x1, y1, x2, y2, level], ...]，坐标 0~1
+    """
+    if not boxes:
+        return None
+    head = _count(len(boxes), "boxes")
+    arr = np.asarray([list(b[:5]) + [0] * (5 - len(b[:5])) for b in boxes], dtype=np.float64)
+    body = np.empty(arr.shape, dtype="<u2")
+    body[:, :4] = _quantize(arr[:, :4]).reshape(-1, 4)
+    body[:, 4] = np.clip(arr[:, 4], 0, _Q).astype("<u2")
+    return _HEADER.pack(BOX_MAGIC, VERSION) + head.tobytes() + body.tobytes()
+
+
+def to_text(blob: Optional[bytes]) -> Optional[str]:
+    """二进制 → 可存进 TEXT 列的 "q16:<base64>" """
+    if blob is None:
+        return None
+    return TEXT_PREFIX + base64.b64encode(blob).decode("ascii")
+
+
+# ---------- 解码 ----------
+def _as_blob(raw: Union[str, bytes, bytearray, memoryview, None]) -> Optional[bytes]:
+    """是紧凑编码就返回二进制，否则返回 None（交给 JSON 兜底）"""
+    if raw is None:
+        return None
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw)
+        if raw[:2] in (POLY_MAGIC, BOX_MAGIC):
+            return raw
+        if not raw.startswith(TEXT_PREFIX.encode("ascii")):
+            return None
+        raw = raw.decode("ascii")
+    if isinstance(raw, str) and raw.startswith(TEXT_PREFIX):
+        return base64.b64decode(raw[len(TEXT_PREFIX):])
+    return None
+
+
+def _load_json(raw) -> list:
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode("utf-8")
+    parsed = json.loads(raw)
+    return parsed if isinstance(parsed, list) else []
+
+
+def is_compact(raw) -> bool:
+    try:
+        return _as_blob(raw) is not None
+    except Exception:
+        return False
+
+
+def decode_polys(raw) -> list:
+    """
+    返回与旧 JSON 相同的结构 [{"outer": [...], "holes": [...]}, ...]；旧 JSON 行原样解析
+    """
+    if not raw:
+        return []
+    blob = _as_blob(raw)
+    if blob is None:
+        return _load_json(raw)
+
+    magic, version = _HEADER.unpack_from(blob, 0)
+    if magic != POLY_MAGIC or version != VERSION:
+        raise ValueError("bad polygon blob header")
+    data = np.frombuffer(blob, dtype="<u2", offset=_HEADER.size)
+
+    pos = 0
+    n_polys = int(data[pos])
+    pos += 1
+    polys = []
+    for _ in range(n_polys):
+        n_rings = int(data[pos])
+        pos += 1
+        rings = []
+        for _ in range(n_rings):
+            n_pts = int(data[pos])
+            pos += 1
+            coords = data[pos:pos + 2 * n_pts]
+            pos += 2 * n_pts
+            rings.append(np.asarray(_dequantize(coords)).reshape(-1, 2).tolist())
+        if rings:
+            polys.append({"outer": rings[0], "holes": rings[1:]})
+    return polys
+
+
+def decode_boxes(raw) -> list:
+    """
+    返回 [[x1, y1, x2, y2, level], ...]；旧 JSON 行原样解析
+    """
+    if not raw:
+        return []
+    blob = _as_blob(raw)
+    if blob is None:
+        return _load_json(raw)
+
+    magic, version = _HEADER.unpack_from(blob, 0)
+    if magic != BOX_MAGIC or version != VERSION:
+        raise ValueError("bad box blob header")
+    data = np.frombuffer(blob, dtype="<u2", offset=_HEADER.size)
+    n = int(data[0])
+    body = data[1:1 + 5 * n].reshape(n, 5)
+    coords = body[:, :4].astype(np.float64) / _Q
+    return [c + [int(lv)] for c, lv in zip(coords.tolist(), body[:, 4].tolist())]
+
+
+def to_json_text(raw, kind: str) -> Optional[str]:
+    """
+    紧凑编码的行转回旧的 JSON 文本（给只认 JSON 的前端用）；旧行原样返回
+    kind: "polys" / "boxes"
+    """
+    if not raw or not is_compact(raw):
+        return raw
+    value = decode_polys(raw) if kind == "polys" else decode_boxes(raw)
+    return json.dumps(value, ensure_ascii=False)
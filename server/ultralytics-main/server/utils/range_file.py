@@ -0,0 +1,60 @@
+# server/utils/range_file.py  —— 支持 HTTP Range 的文件响应（视频拖动 / 断点续传）
+import os
+import re
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+CHUNK_SIZE = 1024 * 1024
+
+
+def _iter_file(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def range_file_response(path: Path, request: Request,
+                        media_type: str = "video/mp4",
+                        filename: Optional[str] = None) -> StreamingResponse:
+    """
+    带 Range 头时返回 206 + Content-Range，只读请求的那一段；否则整文件 200
+    """
+    size = os.path.getsize(path)
+    headers = {"Accept-Ranges": "bytes"}
+    if filename:
+        headers["Content-Disposition"] = f"inline; filename*=UTF-8''{quote(filename)}"
+
+    range_header = request.headers.get("range")
+    m = _RANGE_RE.fullmatch(range_header.strip()) if range_header else None
+    if not m or (not m.group(1) and not m.group(2)):
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_iter_file(path, 0, size), media_type=media_type, headers=headers)
+
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:
+        # bytes=-N：最后 N 个字节
+        start = max(0, size - int(m.group(2)))
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range Not Satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+
+    length = end - start + 1
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(_iter_file(path, start, length), status_code=206,
+                             media_type=media_type, headers=headers)
@@ -1,7 +1,7 @@
 # server/tick_overlay.py 处理视频
 from dataclasses import dataclass
-from typing import List, Optional
-import json
+from typing import Optional
+from .geom_codec import decode_polys, decode_boxes
 
 
 @dataclass
@@ -25,17 +25,16 @@ def parse_tick_row(row) -> TickOverlay:
     # video_sec 如果是毫秒就 /1000.0，这里先按“秒”写
     t = float(_get(row, "video_sec", 0.0))
 
+    # water_polys / risk_boxes 可能是旧的 JSON 文本，也可能是 q16 紧凑编码，decode_* 两种都认
     water_polys = []
     raw_wp = _get(row, "water_polys")
     if raw_wp:
         try:
-            parsed = json.loads(raw_wp)
-            if isinstance(parsed, list):
-                for item in parsed:
-                    if isinstance(item, dict) and "outer" in item:
-                        water_polys.append(item["outer"])
-                    elif isinstance(item, list):
-                        water_polys.append(item)
+            for item in decode_polys(raw_wp):
+                if isinstance(item, dict) and "outer" in item:
+                    water_polys.append(item["outer"])
+                elif isinstance(item, list):
+                    water_polys.append(item)
         except Exception:
             pass
 
@@ -43,9 +42,7 @@ def parse_tick_row(row) -> TickOverlay:
     raw_rb = _get(row, "risk_boxes")
     if raw_rb:
         try:
-            parsed = json.loads(raw_rb)
-            if isinstance(parsed, list):
-                risk_boxes = parsed
+            risk_boxes = decode_boxes(raw_rb)
         except Exception:
             pass
 
@@ -0,0 +1,169 @@
+# server/utils/upload_spool.py  —— 上传文件的流式落盘 / 零拷贝读取
+#
+# - 大小限制：app 中间件先按 Content-Length 拒绝（还没读请求体），
+#   分块读的过程中再按实际字节数兜底（chunked 上传没有 Content-Length）
+# - 视频：分块写进 spool 目录，读写都放到线程里做，不占事件循环
+# - 图片：不再 await file.read() 复制一份，直接拿上传缓存的 memoryview（内存里）或 mmap（已落盘）
+import asyncio
+import mmap
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Iterator, Optional, Union
+
+SPOOL_DIR = Path(os.getenv("UPLOAD_SPOOL_DIR") or (Path(tempfile.gettempdir()) / "upload_spool"))
+UPLOAD_CHUNK = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+MAX_IMAGE_BYTES = int(float(os.getenv("UPLOAD_MAX_IMAGE_MB", "20")) * 1024 * 1024)
+MAX_VIDEO_BYTES = int(float(os.getenv("UPLOAD_MAX_VIDEO_MB", "2048")) * 1024 * 1024)
+# 批量图片接口：整个请求（多文件 / zip）的总大小与图片张数上限
+MAX_IMAGES_BYTES = int(float(os.getenv("UPLOAD_MAX_IMAGES_MB", "1024")) * 1024 * 1024)
+MAX_IMAGES_COUNT = int(os.getenv("UPLOAD_MAX_IMAGES_COUNT", "10000"))
+# multipart 边界 / 其它表单字段的余量
+_FORM_SLACK = 64 * 1024
+
+# 不依赖文件尾部索引、可以边收边解码的容器（mp4 的 moov 常在文件尾，不在此列）
+PROGRESSIVE_SUFFIXES = {".ts", ".m2ts", ".mts", ".mkv", ".webm", ".flv", ".mjpeg", ".mjpg", ".h264", ".264"}
+
+# 各上传接口的请求体上限（中间件按路径查）
+REQUEST_LIMITS = {
+    "/api/infer/image": MAX_IMAGE_BYTES + _FORM_SLACK,
+    "/api/infer/images": MAX_IMAGES_BYTES + _FORM_SLACK,
+    "/api/infer/video": MAX_VIDEO_BYTES + _FORM_SLACK,
+    "/api/infer/video/raw": MAX_VIDEO_BYTES,
+}
+
+
+class UploadTooLarge(Exception):
+    """上传超过大小限制，status_code 给路由 / 中间件用"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"upload exceeds {limit / (1024 * 1024):.0f} MB")
+        self.limit = limit
+        self.status_code = 413
+
+
+def request_limit(path: str) -> Optional[int]:
+    return REQUEST_LIMITS.get(path.rstrip("/"))
+
+
+def is_progressive(suffix: str) -> bool:
+    return suffix.lower() in PROGRESSIVE_SUFFIXES
+
+
+def spool_path(suffix: str) -> Path:
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    return SPOOL_DIR / f"{uuid.uuid4().hex}{suffix}"
+
+
+def remove_quietly(path: Union[str, Path, None]) -> None:
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print("[UPLOAD] remove spool file error:", path, e)
+
+
+async def _write_chunks(chunks: AsyncIterator[bytes], path: Path, max_bytes: int) -> int:
+    loop = asyncio.get_running_loop()
+    # path 可能是命名管道：open 会阻塞到读端打开，所以也放到线程里
+    f = await loop.run_in_executor(None, open, path, "wb")
+    total = 0
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            await loop.run_in_executor(None, f.write, chunk)
+    finally:
+        try:
+            await loop.run_in_executor(None, f.close)
+        except BrokenPipeError:
+            pass
+    return total
+
+
+async def _upload_chunks(upload) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def spool_upload(upload, max_bytes: int, suffix: str) -> Path:
+    """
+    multipart 的 UploadFile 分块拷进 spool 目录，超限立即中止并删掉半截文件
+    """
+    path = spool_path(suffix)
+    try:
+        await _write_chunks(_upload_chunks(upload), path, max_bytes)
+    except BaseException:
+        remove_quietly(path)
+        raise
+    return path
+
+
+async def spool_stream(chunks: AsyncIterator[bytes], path: Path, max_bytes: int) -> int:
+    """
+    原始请求体（request.stream()）写到 path（普通文件或命名管道），返回字节数；
+    失败时不删文件，由调用方统一清理
+    """
+    return await _write_chunks(chunks, path, max_bytes)
+
+
+def abort_fifo(path: Path) -> None:
+    """读端没能打开命名管道时，用非阻塞方式开一下再关，让阻塞在 open 上的写端退出"""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        os.close(fd)
+    except OSError:
+        pass
+
+
+@contextmanager
+def upload_view(upload, max_bytes: int) -> Iterator[memoryview]:
+    """
+    不复制整个上传内容，直接给出只读 memoryview：
+    Starlette 的上传缓存（SpooledTemporaryFile）还在内存里时用 getbuffer，已落盘时 mmap。
+    upload 可以是 UploadFile，也可以是已经从 UploadFile 上取下来的缓存文件本身。
+    with 块里用完即弃，不要把基于它的 numpy 数组带出去
+    """
+    f = getattr(upload, "file", upload)
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    if size > max_bytes:
+        raise UploadTooLarge(max_bytes)
+    if size == 0:
+        yield memoryview(b"")
+        return
+
+    raw = getattr(f, "_file", f)
+    if hasattr(raw, "getbuffer"):
+        view = raw.getbuffer()
+        try:
+            yield view
+        finally:
+            try:
+                view.release()
+            except BufferError:
+                pass
+        return
+
+    mm = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        yield view
+    finally:
+        try:
+            view.release()
+            mm.close()
+        except BufferError:
+            pass
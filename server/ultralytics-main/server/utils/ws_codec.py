@@ -0,0 +1,260 @@
+# server/utils/ws_codec.py  —— /ws 的二进制 tick 帧
+#
+# 客户端在启动包里带 "protocol": "bin1" 时启用，否则一直用 JSON（老前端不受影响）。
+# 二进制帧（little-endian）：
+#   "FT" | u8 version | u8 n_sections | u32 header_len | header（紧凑 JSON，UTF-8）
+#   { u8 kind | 3B 保留 | u32 len | payload } * n_sections
+# kind：
+#   1 POLYS  water.polygons，geom_codec 的多边形二进制（uint16 量化）
+#   2 BOXES  risk.det.boxes_norm，geom_codec 的风险框二进制
+#   3 MASK   water 掩膜，行优先 RLE：u16 h | u16 w | u8 首段取值(0/1) | 3B 保留 | LEB128 游程长度...
+#   4 MASK_DELTA  与本连接上一次发出的掩膜逐像素 XOR 后的 RLE（布局同 MASK），
+#                 只在启动包带 "mask_delta": true 时出现；每 MASK_KEYFRAME_EVERY 次或差分不划算时发完整 MASK
+# header 即 JSON 协议的 tick 去掉上面几类字段后的其余部分；params 只在变化时才带。
+import json
+import os
+import struct
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from . import geom_codec
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BIN = "bin1"
+PROTOCOLS = (PROTOCOL_BIN, PROTOCOL_JSON)
+
+MAGIC = b"FT"
+VERSION = 1
+KIND_POLYS = 1
+KIND_BOXES = 2
+KIND_MASK = 3
+KIND_MASK_DELTA = 4
+
+# 差分掩膜：每发多少次掩膜强制一个关键帧
+MASK_KEYFRAME_EVERY = int(os.getenv("WS_MASK_KEYFRAME_EVERY", "30"))
+
+_FRAME_HEAD = struct.Struct("<2sBBI")
+_SECTION_HEAD = struct.Struct("<B3xI")
+_MASK_HEAD = struct.Struct("<HHB3x")
+
+
+def negotiate(requested: Union[str, List[str], None]) -> str:
+    """
+    requested：启动包里的 protocol（字符串或按偏好排序的列表），返回服务端选定的协议
+    """
+    if isinstance(requested, str):
+        requested = [requested]
+    for p in requested or []:
+        if p in PROTOCOLS:
+            return p
+    return PROTOCOL_JSON
+
+
+# ---------- LEB128 变长整数（向量化） ----------
+def _varint_encode(values: np.ndarray) -> bytes:
+    v = np.asarray(values, dtype=np.uint64)
+    if v.size == 0:
+        return b""
+    nbytes = np.ones(v.size, dtype=np.int64)
+    t = v >> np.uint64(7)
+    while np.any(t):
+        nbytes += (t > 0)
+        t >>= np.uint64(7)
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    offsets = np.concatenate(([0], np.cumsum(nbytes)[:-1]))
+    rem = v.copy()
+    for k in range(int(nbytes.max())):
+        sel = nbytes > k
+        byte = (rem[sel] & np.uint64(0x7F)).astype(np.uint8)
+        more = (nbytes[sel] > k + 1).astype(np.uint8) << 7
+        out[offsets[sel] + k] = byte | more
+        rem[sel] >>= np.uint64(7)
+    return out.tobytes()
+
+
+def _varint_decode(buf: bytes) -> np.ndarray:
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    values = np.zeros(ends.size, dtype=np.int64)
+    for k in range(int((ends - starts).max()) + 1):
+        idx = starts + k
+        sel = idx <= ends
+        values[sel] |= (data[idx[sel]].astype(np.int64) & 0x7F) << (7 * k)
+    return values
+
+
+# ---------- 掩膜 RLE ----------
+def rle_encode(mask: np.ndarray) -> bytes:
+    """HxW 掩膜（非 0 即前景）→ MASK section payload"""
+    h, w = mask.shape[:2]
+    flat = mask.reshape(-1) > 0
+    if flat.size == 0:
+        return _MASK_HEAD.pack(h, w, 0)
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], change, [flat.size]))
+    return _MASK_HEAD.pack(h, w, int(flat[0])) + _varint_encode(np.diff(bounds))
+
+
+def rle_decode(payload: bytes) -> np.ndarray:
+    """MASK section payload → HxW 的 0/255 uint8 掩膜"""
+    h, w, first = _MASK_HEAD.unpack_from(payload, 0)
+    runs = _varint_decode(payload[_MASK_HEAD.size:])
+    values = (np.arange(runs.size) + first) % 2
+    return (np.repeat(values, runs).astype(np.uint8) * 255).reshape(h, w)
+
+
+# ---------- 掩膜差分（关键帧 + XOR） ----------
+class MaskDeltaEncoder:
+    """
+    每个连接一个：记住上一次发出去的掩膜，之后只发 XOR 差分
+    连续两帧积水区域只差边缘几个像素，差分的 RLE 通常只有关键帧的几分之一
+    """
+
+    def __init__(self, keyframe_every: int = MASK_KEYFRAME_EVERY):
+        self.keyframe_every = max(1, int(keyframe_every))
+        self._prev: Optional[np.ndarray] = None   # 上次发出的掩膜（bool）
+        self._since_key = 0
+        self._key_len = 0
+        self.force_key = False                    # 客户端请求 / 丢帧后置 True，下一次发关键帧
+
+        # 统计
+        self.keyframes = 0
+        self.deltas = 0
+
+    def encode(self, mask: np.ndarray) -> Tuple[int, bytes]:
+        """返回 (section kind, payload)"""
+        cur = mask > 0
+        if not (self.force_key or self._prev is None or self._prev.shape != cur.shape
+                or self._since_key + 1 >= self.keyframe_every):
+            blob = rle_encode(cur ^ self._prev)
+            # 变化太大（切镜头 / 灯光突变）时差分反而更长，直接发关键帧
+            if len(blob) < self._key_len:
+                self._prev = cur
+                self._since_key += 1
+                self.deltas += 1
+                return KIND_MASK_DELTA, blob
+
+        blob = rle_encode(cur)
+        self._prev = cur
+        self._since_key = 0
+        self._key_len = len(blob)
+        self.force_key = False
+        self.keyframes += 1
+        return KIND_MASK, blob
+
+    def stats(self) -> dict:
+        return {"keyframes": self.keyframes, "deltas": self.deltas}
+
+
+class MaskDeltaDecoder:
+    """MaskDeltaEncoder 的对端：按顺序喂入 MASK / MASK_DELTA section，得到完整掩膜"""
+
+    def __init__(self):
+        self._prev: Optional[np.ndarray] = None
+
+    def apply(self, kind: int, payload: bytes) -> np.ndarray:
+        """返回 0/255 的 uint8 掩膜"""
+        mask = rle_decode(payload)
+        if kind == KIND_MASK_DELTA:
+            if self._prev is None or self._prev.shape != mask.shape:
+                raise ValueError("mask delta without a keyframe")
+            mask = np.bitwise_xor(self._prev, mask)
+        self._prev = mask
+        return mask
+
+
+# ---------- tick 帧 ----------
+def _split_tick(payload: dict, mask_encoder: Optional[MaskDeltaEncoder] = None) -> Tuple[dict, list]:
+    """把几何 / 掩膜字段从 payload 里拿出来，返回 (header, sections)"""
+    header = dict(payload)
+    sections = []
+
+    water = dict(header.get("water") or {})
+    polys = water.pop("polygons", None)
+    mask = water.pop("mask_raw", None)
+    water.pop("mask_png_b64", None)
+    header["water"] = water
+    if polys:
+        try:
+            sections.append((KIND_POLYS, geom_codec.encode_polys(polys)))
+        except geom_codec.GeomOverflow:
+            water["polygons"] = polys   # 个数超出 uint16：留在 JSON 头里原样发
+    if mask is not None:
+        if mask_encoder is not None:
+            sections.append(mask_encoder.encode(mask))
+        else:
+            sections.append((KIND_MASK, rle_encode(mask)))
+
+    risk = dict(header.get("risk") or {})
+    det = risk.get("det")
+    if det and det.get("boxes_norm"):
+        try:
+            blob = geom_codec.encode_boxes(det["boxes_norm"])
+        except geom_codec.GeomOverflow:
+            blob = None   # 同上，留在 JSON 头里
+        if blob is not None:
+            det = dict(det)
+            det.pop("boxes_norm")
+            sections.append((KIND_BOXES, blob))
+            risk["det"] = det
+    header["risk"] = risk
+    return header, sections
+
+
+def encode_tick(payload: dict, mask_encoder: Optional[MaskDeltaEncoder] = None) -> bytes:
+    """
+    mask_encoder：传入则掩膜按关键帧 + 差分发送（本连接的 MaskDeltaEncoder）
+    """
+    header, sections = _split_tick(payload, mask_encoder)
+    head = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    parts = [_FRAME_HEAD.pack(MAGIC, VERSION, len(sections), len(head)), head]
+    for kind, blob in sections:
+        parts.append(_SECTION_HEAD.pack(kind, len(blob)))
+        parts.append(blob)
+    return b"".join(parts)
+
+
+def decode_tick(frame: bytes, mask_decoder: Optional[MaskDeltaDecoder] = None) -> dict:
+    """
+    encode_tick 的逆过程（Python 客户端 / 调试用），还原成 JSON 协议的字段结构；
+    掩膜以 water.mask（0/255 的 numpy 数组）给出
+    mask_decoder：连接开了 mask_delta 时必须传，同一连接的帧要按顺序解
+    """
+    magic, version, n_sections, head_len = _FRAME_HEAD.unpack_from(frame, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("bad tick frame header")
+    pos = _FRAME_HEAD.size
+    msg = json.loads(frame[pos:pos + head_len].decode("utf-8"))
+    pos += head_len
+
+    water = msg.setdefault("water", {})
+    risk = msg.setdefault("risk", {})
+    water.setdefault("polygons", [])
+    for _ in range(n_sections):
+        kind, length = _SECTION_HEAD.unpack_from(frame, pos)
+        pos += _SECTION_HEAD.size
+        blob = bytes(frame[pos:pos + length])
+        pos += length
+        if kind == KIND_POLYS:
+            water["polygons"] = geom_codec.decode_polys(blob)
+        elif kind == KIND_BOXES:
+            risk.setdefault("det", {})["boxes_norm"] = geom_codec.decode_boxes(blob)
+        elif kind in (KIND_MASK, KIND_MASK_DELTA):
+            if mask_decoder is not None:
+                water["mask"] = mask_decoder.apply(kind, blob)
+            elif kind == KIND_MASK:
+                water["mask"] = rle_decode(blob)
+            else:
+                raise ValueError("mask delta needs a MaskDeltaDecoder")
+    return msg
+
+
+def encoded_size(payload: dict, protocol: str) -> Optional[int]:
+    """调试用：同一个 tick 在某协议下的字节数"""
+    if protocol == PROTOCOL_BIN:
+        return len(encode_tick(payload))
+    return len(json.dumps(payload).encode("utf-8"))
@@ -0,0 +1,118 @@
+// /ws 二进制 tick 帧（protocol: 'bin1'）的解码，布局见 server/utils/ws_codec.py
+// 解出来的结构和 JSON 协议的 tick 一致，掩膜换成 water.mask = { width, height, data }（data 为 0/1）
+// 开了 mask_delta 时同一连接要共用一个 createMaskState() 按顺序解（差分帧依赖上一次的掩膜）
+
+export const TICK_PROTOCOL = 'bin1'
+
+const KIND_POLYS = 1
+const KIND_BOXES = 2
+const KIND_MASK = 3
+const KIND_MASK_DELTA = 4
+const Q = 65535
+
+// geom_codec 多边形："FP" ver pad | n_polys | { n_rings | { n_pts | x y ... } } ...
+function decodePolys (view, offset, length) {
+  let pos = offset + 4
+  const u16 = () => { const v = view.getUint16(pos, true); pos += 2; return v }
+  const polys = []
+  const nPolys = u16()
+  for (let i = 0; i < nPolys; i++) {
+    const rings = []
+    const nRings = u16()
+    for (let r = 0; r < nRings; r++) {
+      const nPts = u16()
+      const ring = new Array(nPts)
+      for (let k = 0; k < nPts; k++) ring[k] = [u16() / Q, u16() / Q]
+      rings.push(ring)
+    }
+    if (rings.length) polys.push({ outer: rings[0], holes: rings.slice(1) })
+  }
+  return polys
+}
+
+// geom_codec 风险框："FB" ver pad | n | { x1 y1 x2 y2 level } ...
+function decodeBoxes (view, offset) {
+  let pos = offset + 4
+  const n = view.getUint16(pos, true); pos += 2
+  const boxes = new Array(n)
+  for (let i = 0; i < n; i++) {
+    const b = []
+    for (let k = 0; k < 5; k++) { b.push(view.getUint16(pos, true)); pos += 2 }
+    boxes[i] = [b[0] / Q, b[1] / Q, b[2] / Q, b[3] / Q, b[4]]
+  }
+  return boxes
+}
+
+// 掩膜 RLE：u16 h | u16 w | u8 首段取值 | 3B 保留 | LEB128 游程长度 ...
+export function decodeMaskRle (bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength)
+  const height = view.getUint16(0, true)
+  const width = view.getUint16(2, true)
+  let value = view.getUint8(4)
+  const data = new Uint8Array(width * height)
+  let pos = 8
+  let out = 0
+  while (pos < bytes.length) {
+    let run = 0
+    let shift = 0
+    let b
+    do {
+      b = bytes[pos++]
+      run += (b & 0x7f) * 2 ** shift
+      shift += 7
+    } while (b & 0x80)
+    if (value) data.fill(1, out, out + run)
+    out += run
+    value ^= 1
+  }
+  return { width, height, data }
+}
+
+export function createMaskState () {
+  return { prev: null }
+}
+
+// 关键帧 / 差分帧 → 完整掩膜；没有参考帧时抛错（调用方发 mask_keyframe 请求关键帧）
+function applyMask (kind, mask, state) {
+  if (kind === KIND_MASK_DELTA) {
+    const prev = state && state.prev
+    if (!prev || prev.width !== mask.width || prev.height !== mask.height) {
+      throw new Error('mask delta without a keyframe')
+    }
+    const data = mask.data
+    for (let i = 0; i < data.length; i++) data[i] ^= prev.data[i]
+  }
+  if (state) state.prev = mask
+  return mask
+}
+
+export function decodeTick (buffer, maskState = null) {
+  const view = new DataView(buffer)
+  if (view.getUint8(0) !== 0x46 || view.getUint8(1) !== 0x54) {
+    throw new Error('bad tick frame')
+  }
+  const nSections = view.getUint8(3)
+  const headLen = view.getUint32(4, true)
+  let pos = 8
+  const msg = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, pos, headLen)))
+  pos += headLen
+
+  msg.water = msg.water || {}
+  msg.risk = msg.risk || {}
+  msg.water.polygons = msg.water.polygons || []
+  for (let i = 0; i < nSections; i++) {
+    const kind = view.getUint8(pos)
+    const len = view.getUint32(pos + 4, true)
+    pos += 8
+    if (kind === KIND_POLYS) {
+      msg.water.polygons = decodePolys(view, pos, len)
+    } else if (kind === KIND_BOXES) {
+      msg.risk.det = msg.risk.det || {}
+      msg.risk.det.boxes_norm = decodeBoxes(view, pos)
+    } else if (kind === KIND_MASK || kind === KIND_MASK_DELTA) {
+      msg.water.mask = applyMask(kind, decodeMaskRle(new Uint8Array(buffer, pos, len)), maskState)
+    }
+    pos += len
+  }
+  return msg
+}